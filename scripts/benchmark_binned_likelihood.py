@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the duplicate-weighted and binned likelihoods against the point-level one.
+
+The script first reports, for each bundled dataset in full, how many distinct (X, Y, T)
+tuples its events collapse into (event_store.collapse_duplicates). Then, for each dataset
+and model, the same seeded event subset is fitted by SVI with the point-level likelihood and
+with each mode (same steps, learning rate and PRNG key):
+
+- 'dedup': one weighted row per distinct (X, Y, T) tuple (weight_col="weight")
+- 'binned': the count-weighted bins of binned_likelihood.py (LGCP only; binning is not
+  exact for the Hawkes models, so they skip this mode)
+
+and the script reports:
+
+- the number of events, of rows the likelihood visits and the compression (events per row)
+- the time of one jitted loss + gradient evaluation of the full likelihood and the speedup
+- the wall time of the SVI fits and the speedup
+- the expected AIC of both posteriors under the point-level likelihood, and the expected AIC
+  of the point-level posterior under the mode's likelihood (identical, since both modes are
+  exact)
+- the posterior means of the scalar parameters of both fits
+
+The Hawkes likelihood depends on the order of events with equal times (bstpp lets earlier
+rows excite later ones), so the point-level table is sorted by (T, X, Y), the order of
+the collapsed rows.
+
+    python benchmark_binned_likelihood.py --datasets london ebola --models lgcp coxhawkes --events 5000
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+SCALARS = ("a_0", "alpha", "beta", "sigmax_2")
+MODES = ("dedup", "binned")
+
+
+def main():
+    import benchmark_suite
+    from event_store import collapse_duplicates
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--datasets", nargs="+", default=list(benchmark_suite.DATASETS),
+                        choices=list(benchmark_suite.DATASETS))
+    parser.add_argument("--models", nargs="+", default=["lgcp", "coxhawkes"], choices=benchmark_suite.MODELS)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--steps", type=int, default=3000)
+    parser.add_argument("--lr", type=float, default=0.02)
+    parser.add_argument("--subsample-size", type=int, default=512)
+    parser.add_argument("--num-samples", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=5)
+    opts = parser.parse_args()
+
+    import matplotlib
+    matplotlib.use("Agg")
+    from benchmark_truncated_kernel import grad_time, expected_aic
+
+    print("=== Distinct (X, Y, T) tuples ===")
+    for dataset in opts.datasets:
+        events_all = benchmark_suite.load_dataset(f"{benchmark_suite.DATA_DIR}/{benchmark_suite.DATASETS[dataset][0]}")
+        n_unique = len(collapse_duplicates(events_all))
+        print(f"{dataset}: {len(events_all)} events, {n_unique} distinct tuples ({len(events_all)/n_unique:.2f}x)")
+
+    rows = []
+    for dataset in opts.datasets:
+        file, t_pad, bbox_pad = benchmark_suite.DATASETS[dataset]
+        events_df = benchmark_suite.load_dataset(f"{benchmark_suite.DATA_DIR}/{file}", opts.events)
+        grid_bounds, T_max = benchmark_suite.domain(events_df, t_pad, bbox_pad)
+        # tie order of collapse_duplicates, so the Hawkes likelihoods of both tables agree exactly
+        events_df = events_df.sort_values(["T", "X", "Y"]).reset_index(drop=True)
+        collapsed = collapse_duplicates(events_df)
+        for model_name in opts.models:
+            modes = {"dedup": (collapsed, dict(weight_col="weight")),
+                     "binned": (events_df, dict(binned=True))}
+
+            def build(subsample_size, mode=None):
+                data, kwargs = modes[mode] if mode else (events_df, {})
+                return benchmark_suite.build_model(model_name, data, grid_bounds, T_max, subsample_size, **kwargs)
+
+            def fit(mode=None):
+                model = build(opts.subsample_size, mode)
+                start = time.time()
+                model.run_svi(num_steps=opts.steps, lr=opts.lr, num_samples=opts.num_samples, plot_loss=False)
+                return model, time.time() - start
+
+            point_model = build(None)
+            point_s = grad_time(point_model, opts.repeats)
+            point_fit, point_fit_s = fit()
+            point_aic = expected_aic(point_model, point_fit.samples)
+            for mode in opts.modes:
+                if mode == "binned" and model_name != "lgcp":
+                    continue
+                model = build(None, mode)
+                n_rows = len(model.args["t_events"])
+                mode_s = grad_time(model, opts.repeats)
+                mode_fit, mode_fit_s = fit(mode)
+                row = {"dataset": dataset, "model": model_name, "mode": mode, "n_events": len(events_df),
+                       "rows": n_rows, "compression": len(events_df)/n_rows, "point_grad_ms": point_s*1000,
+                       "mode_grad_ms": mode_s*1000, "grad_speedup": point_s/mode_s, "point_fit_s": point_fit_s,
+                       "mode_fit_s": mode_fit_s, "fit_speedup": point_fit_s/mode_fit_s, "point_aic": point_aic,
+                       "mode_fit_aic": expected_aic(point_model, mode_fit.samples),
+                       "point_draws_mode_aic": expected_aic(model, point_fit.samples)}
+                for k in SCALARS:
+                    if k in point_fit.samples:
+                        row[f"{k}_point"] = float(np.mean(point_fit.samples[k]))
+                        row[f"{k}_mode"] = float(np.mean(mode_fit.samples[k]))
+                rows.append(row)
+                print(row)
+
+    print("\n=== Weighted vs point-level likelihood ===")
+    print(pd.DataFrame(rows).set_index(["dataset", "model", "mode"]).round(4).T.to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Scaling benchmark for the minibatched London fits.
+
+Fits the minibatched models of the London script on random subsets of
+london_covid_events.csv and reports wall-clock time and peak RSS. --models picks from
+lgcp, hawkes (constant background), coxhawkes (Cox-Hawkes background) and their
+covariate versions lgcp_cov and coxhawkes_cov, which use the 2 km covariate grid of
+london_covid_covariates.csv as the London script does; the default is the three
+models that script fits.
+SVI runs on the minibatch likelihood (--sizes); MCMC runs short NUTS chains on the
+exact likelihood (--mcmc-sizes) and also reports the time per gradient evaluation,
+i.e. per leapfrog step. Every (method, model, size) triple runs in a fresh interpreter
+so peak RSS is not shared between runs. The log-log slope of fit time (SVI) or time
+per gradient (MCMC) against event count is printed at the end: ~1 means linear,
+~2 quadratic. The MCMC sizes show what MCMC_SUBSET_SIZE of the London script and
+mcmc_subset_size of london_pipeline.toml can afford.
+
+    python benchmark_london_scaling.py --sizes 10000 20000 36000 --steps 500
+    python benchmark_london_scaling.py --methods mcmc --mcmc-sizes 2500 5000 10000 20000
+    python benchmark_london_scaling.py --models lgcp hawkes coxhawkes --sizes 10000
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EVENTS_PATH = os.path.join(HERE, "..", "datasets", "london_covid_events.csv")
+COVARIATES_PATH = os.path.join(HERE, "..", "datasets", "london_covid_covariates.csv")
+COVARIATE_COLUMNS = ['popdensity', 'covid_deaths', 'popn', 'houseprice']
+MODELS = ["lgcp", "hawkes", "coxhawkes", "lgcp_cov", "coxhawkes_cov"]
+
+
+def run_single(events_path, method, model_name, n_events, steps, subsample_size, num_samples,
+               num_warmup=50, mcmc_samples=50, covariates_path=COVARIATES_PATH):
+    import resource
+    import matplotlib
+    matplotlib.use("Agg")
+    import numpyro.distributions as dist
+    from fit_telemetry import FitTelemetry
+    from scalable_models import Minibatch_LGCP_Model, Minibatch_Hawkes_Model
+
+    events_df = pd.read_csv(events_path)
+    if n_events < len(events_df):
+        events_df = events_df.sample(n=n_events, random_state=42)
+    events_df = events_df.sort_values(["T", "X", "Y"]).reset_index(drop=True)
+
+    x_min, x_max = events_df["X"].min() - 0.005, events_df["X"].max() + 0.005
+    y_min, y_max = events_df["Y"].min() - 0.005, events_df["Y"].max() + 0.005
+    grid_bounds = np.array([[x_min, x_max], [y_min, y_max]])
+    T_max = events_df["T"].max() + 7
+    priors = {
+        "a_0": dist.Normal(1, 10),
+        "alpha": dist.Beta(20, 60),
+        "beta": dist.HalfNormal(2.0),
+        "sigmax_2": dist.HalfNormal(0.25),
+    }
+
+    start = time.time()
+    kwargs = dict(subsample_size=subsample_size, **priors)
+    if model_name.endswith("_cov"):
+        # same covariate grid and cell size as the London script
+        import geopandas as gpd
+        from covariate_grid import covariate_grid
+        covariates = pd.read_csv(covariates_path).drop_duplicates(subset=["X", "Y"]).reset_index(drop=True)
+        kwargs.update(spatial_cov=covariate_grid(covariates, 2000, crs="EPSG:4326", grid_crs="EPSG:27700"),
+                      cov_names=COVARIATE_COLUMNS)
+        events_df = gpd.GeoDataFrame(events_df, geometry=gpd.points_from_xy(events_df.X, events_df.Y),
+                                     crs="EPSG:4326")
+    if model_name.startswith("lgcp"):
+        if model_name.endswith("_cov"):
+            kwargs.update(cov_grid_size=(0.5, 0.5))
+        model = Minibatch_LGCP_Model(events_df, grid_bounds, T_max, **kwargs)
+    else:
+        model = Minibatch_Hawkes_Model(events_df, grid_bounds, T_max, cox_background=model_name.startswith("cox"),
+                                       **kwargs)
+    build_s = time.time() - start
+
+    result = {"method": method, "model": model_name, "n_events": len(events_df), "build_s": build_s}
+    start = time.time()
+    if method == "svi":
+        model.run_svi(num_steps=steps, lr=0.02, num_samples=num_samples, plot_loss=False)
+        fit_s = time.time() - start
+        result.update(steps=steps, subsample_size=subsample_size, s_per_step=fit_s / steps)
+    else:
+        # leapfrog counts and compile time come from the sampler's num_steps field
+        fit_kwargs = dict(num_warmup=num_warmup, num_samples=mcmc_samples, num_chains=1)
+        with FitTelemetry(os.devnull, model_name, "mcmc", fit_kwargs=fit_kwargs) as telemetry:
+            model.run_mcmc(**fit_kwargs)
+        fit_s = time.time() - start
+        summary = telemetry.summary
+        result.update(num_warmup=num_warmup, num_samples=mcmc_samples, leapfrog_steps=summary["leapfrog_steps"],
+                      compile_s=summary["compile_s"], ms_per_grad=1e3 / summary["leapfrog_per_s"])
+    result.update(fit_s=fit_s, peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", default=EVENTS_PATH)
+    parser.add_argument("--methods", nargs="+", default=["svi", "mcmc"], choices=["svi", "mcmc"])
+    parser.add_argument("--covariates", default=COVARIATES_PATH)
+    parser.add_argument("--models", nargs="+", default=["lgcp_cov", "coxhawkes_cov", "hawkes"], choices=MODELS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10000, 20000, 36000])
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--subsample-size", type=int, default=512)
+    parser.add_argument("--num-samples", type=int, default=100)
+    parser.add_argument("--mcmc-sizes", nargs="+", type=int, default=[2500, 5000, 10000])
+    parser.add_argument("--num-warmup", type=int, default=50)
+    parser.add_argument("--mcmc-samples", type=int, default=50)
+    parser.add_argument("--single", nargs=3, metavar=("METHOD", "MODEL", "N_EVENTS"), help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.single:
+        result = run_single(opts.events, opts.single[0], opts.single[1], int(opts.single[2]), opts.steps,
+                            opts.subsample_size, opts.num_samples, opts.num_warmup, opts.mcmc_samples, opts.covariates)
+        print("RESULT " + json.dumps(result))
+        return
+
+    results = []
+    for method in opts.methods:
+        for model_name in opts.models:
+            for n in opts.sizes if method == "svi" else opts.mcmc_sizes:
+                cmd = [sys.executable, os.path.abspath(__file__), "--events", opts.events, "--covariates", opts.covariates,
+                       "--steps", str(opts.steps), "--subsample-size", str(opts.subsample_size),
+                       "--num-samples", str(opts.num_samples), "--num-warmup", str(opts.num_warmup),
+                       "--mcmc-samples", str(opts.mcmc_samples), "--single", method, model_name, str(n)]
+                out = subprocess.run(cmd, capture_output=True, text=True, cwd=HERE)
+                lines = [l for l in out.stdout.splitlines() if l.startswith("RESULT ")]
+                if out.returncode != 0 or not lines:
+                    print(out.stderr[-2000:])
+                    raise RuntimeError(f"{method} benchmark run failed for {model_name} at {n} events")
+                results.append(json.loads(lines[-1][len("RESULT "):]))
+                r = results[-1]
+                if method == "svi":
+                    rate = f"{r['s_per_step'] * 1000:.1f} ms/step"
+                else:
+                    rate = f"{r['ms_per_grad']:.1f} ms/gradient over {r['leapfrog_steps']} leapfrog steps"
+                print(f"{method:>4} {r['model']:>13} {r['n_events']:>7d} events: fit {r['fit_s']:8.1f}s "
+                      f"({rate}), build {r['build_s']:.1f}s, peak RSS {r['peak_rss_mb']:.0f} MB")
+
+    print("\n=== Scaling exponent (SVI fit time, MCMC time per gradient ~ N^k) ===")
+    df = pd.DataFrame(results)
+    for (method, model_name), g in df.groupby(["method", "model"]):
+        if len(g) > 1:
+            cost = g["fit_s"] if method == "svi" else g["ms_per_grad"]
+            k = np.polyfit(np.log(g["n_events"]), np.log(cost), 1)[0]
+            peak = g.sort_values("n_events")["peak_rss_mb"]
+            print(f"{method} {model_name}: k = {k:.2f}, peak RSS {peak.iloc[0]:.0f} -> {peak.iloc[-1]:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
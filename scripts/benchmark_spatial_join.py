@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of event-to-covariate-cell assignment: gpd.sjoin against CellIndex.
+
+Synthetic events are drawn uniformly over the bounding box of the London covariate
+cells. For each size the script times the sjoin used by
+london_covid_descriptive_analysis.py (including building the events GeoDataFrame),
+the STRtree build, the bulk CellIndex query, and reloading the stored index and ids.
+It also checks that both methods assign every event to the same cell.
+
+    python benchmark_spatial_join.py --sizes 36000 1000000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from covariate_grid import covariate_grid
+from spatial_index import CellIndex, assign_cells
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COVARIATES_PATH = os.path.join(HERE, "..", "datasets", "london_covid_covariates.csv")
+
+
+def timed(f, *args, **kwargs):
+    start = time.time()
+    out = f(*args, **kwargs)
+    return out, time.time() - start
+
+
+def run(covariates_gdf, n_events, work_dir, seed=0):
+    rng = np.random.default_rng(seed)
+    x_min, y_min, x_max, y_max = covariates_gdf.total_bounds
+    events_df = pd.DataFrame({"X": rng.uniform(x_min, x_max, n_events),
+                              "Y": rng.uniform(y_min, y_max, n_events),
+                              "T": np.sort(rng.uniform(0, 140, n_events))})
+
+    def sjoin():
+        events_gdf = gpd.GeoDataFrame(events_df, geometry=gpd.points_from_xy(events_df["X"], events_df["Y"]),
+                                      crs="EPSG:4326")
+        return gpd.sjoin(events_gdf, covariates_gdf, how="left", predicate="within")
+
+    joined, sjoin_s = timed(sjoin)
+    index_path = os.path.join(work_dir, "cells.idx")
+    ids_path = os.path.join(work_dir, f"cells_{n_events}.npz")
+    for path in (index_path, ids_path):
+        if os.path.exists(path):
+            os.remove(path)
+    index, build_s = timed(CellIndex.cached, covariates_gdf, index_path)
+    ids, query_s = timed(assign_cells, events_df, index, ids_path)
+    index, reload_index_s = timed(CellIndex.cached, covariates_gdf, index_path)
+    _, reload_ids_s = timed(assign_cells, events_df, index, ids_path)
+
+    # sjoin returns one row per (event, cell) match; keep the lowest cell like CellIndex
+    sjoin_ids = joined["index_right"].fillna(-1).astype(int).groupby(level=0).min().values
+    return {
+        "n_events": n_events,
+        "sjoin_s": sjoin_s,
+        "index_build_s": build_s,
+        "bulk_query_s": query_s,
+        "reload_s": reload_index_s + reload_ids_s,
+        "speedup": sjoin_s / (build_s + query_s),
+        "speedup_cached": sjoin_s / (reload_index_s + reload_ids_s),
+        "agree": bool((sjoin_ids == ids).all()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--covariates", default=COVARIATES_PATH)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[36000, 1000000])
+    opts = parser.parse_args()
+
+    covariates_df = pd.read_csv(opts.covariates).drop_duplicates(subset=["X", "Y"]).reset_index(drop=True)
+    covariates_gdf = covariate_grid(covariates_df, 2000, crs="EPSG:4326", grid_crs="EPSG:27700")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = pd.DataFrame([run(covariates_gdf, n, work_dir) for n in opts.sizes])
+    print(results.round(3).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
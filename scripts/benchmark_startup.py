@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark for the analysis entry points.
+
+Each run starts a fresh interpreter with ``python -X importtime`` and reports the
+import time, the wall time and which heavy dependencies (JAX, numpyro, bstpp, ArviZ,
+geopandas, ...) were loaded. Two kinds of runs are measured:
+
+- pipeline stages: run_pipeline.py on a small subset of the London events, one stage
+  per interpreter (cli is ``--help``, i.e. just the module imports)
+- script headers: the import block at the top of each notebook-style analysis script
+
+A descriptive-only run (the eda stage or london_covid_descriptive_analysis.py) should
+not load JAX, numpyro or bstpp.
+
+    python benchmark_startup.py
+    python benchmark_startup.py --stages eda --no-scripts
+"""
+
+import argparse
+import ast
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(HERE, "..", "datasets")
+SCRIPTS = ["london_covid_descriptive_analysis.py", "final_london_covid_bstpp_analysis.py",
+           "ebola_bstpp_analysis.py"]
+HEAVY = ["jax", "numpyro", "bstpp", "arviz", "geopandas", "pyarrow", "scipy", "seaborn", "sklearn"]
+
+# small enough that the fit and compare stages take about a minute on one core
+BENCHMARK_CONFIG = """
+[paths]
+events = "{data_dir}/london_covid_events.csv"
+covariates = "{data_dir}/london_covid_covariates.csv"
+output_dir = "{output_dir}"
+
+[data]
+subset_size = {subset_size}
+
+[fit]
+svi_steps = 100
+workers = 1
+intensity_frames = 0
+
+[[models]]
+model = "lgcp_cov"
+method = "svi"
+
+[compare]
+draws = 20
+"""
+
+
+def parse_importtime(stderr):
+    """
+    Total import time and top-level packages from the output of ``python -X importtime``.
+
+    Returns
+    -------
+    (float, set of str): seconds spent in top-level imports and the names of all imported modules
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), len(name) - len(name.lstrip()), name.strip()))
+    if not rows:
+        return 0., set()
+    top = min(indent for _, indent, _ in rows)
+    return sum(c for c, indent, _ in rows if indent == top) / 1e6, {name for _, _, name in rows}
+
+
+def timed_run(args, label):
+    """Run ``python -X importtime *args`` in a fresh interpreter and summarize its imports."""
+    start = time.time()
+    out = subprocess.run([sys.executable, "-X", "importtime", *args], capture_output=True, text=True, cwd=HERE,
+                         env=dict(os.environ, MPLBACKEND="Agg"))
+    wall_s = time.time() - start
+    if out.returncode != 0:
+        print(out.stdout[-2000:], out.stderr[-2000:])
+        raise RuntimeError(f"{label} failed")
+    import_s, modules = parse_importtime(out.stderr)
+    return {"run": label, "import_s": import_s, "wall_s": wall_s,
+            "heavy_loaded": ",".join(m for m in HEAVY if m in modules) or "-"}
+
+
+def header_imports(script):
+    """Source of the import statements at the top of a script, up to its first other statement."""
+    with open(os.path.join(HERE, script)) as f:
+        source = f.read()
+    header = []
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            header.append(ast.get_source_segment(source, node))
+        elif isinstance(node, ast.Try) and all(isinstance(n, (ast.Import, ast.ImportFrom)) for n in node.body):
+            header.append(ast.get_source_segment(source, node))
+        elif not (isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant)):
+            break
+    return "\n".join(header)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", nargs="*", default=["cli", "eda", "fit", "compare"],
+                        choices=["cli", "eda", "fit", "compare"])
+    parser.add_argument("--subset-size", type=int, default=500)
+    parser.add_argument("--no-scripts", action="store_true", help="skip the script header imports")
+    opts = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        config = os.path.join(work_dir, "benchmark.toml")
+        with open(config, "w") as f:
+            f.write(BENCHMARK_CONFIG.format(data_dir=os.path.abspath(DATA_DIR), subset_size=opts.subset_size,
+                                            output_dir=os.path.join(work_dir, "out")))
+        for stage in opts.stages:
+            args = ["run_pipeline.py", "--help"] if stage == "cli" else ["run_pipeline.py", config, "--stages", stage,
+                                                                        "--force"]
+            results.append(timed_run(args, f"stage {stage}"))
+            r = results[-1]
+            print(f"{r['run']:>45}: imports {r['import_s']:6.2f}s, wall {r['wall_s']:6.1f}s, "
+                  f"loaded {r['heavy_loaded']}")
+
+    if not opts.no_scripts:
+        for script in SCRIPTS:
+            results.append(timed_run(["-c", header_imports(script)], f"header {script}"))
+            r = results[-1]
+            print(f"{r['run']:>45}: imports {r['import_s']:6.2f}s, wall {r['wall_s']:6.1f}s, "
+                  f"loaded {r['heavy_loaded']}")
+
+    print("\n=== Startup summary ===")
+    print(pd.DataFrame(results).round(2).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Reproducible performance benchmark of the LGCP, Hawkes and Cox-Hawkes models.
+
+Cases:
+
+- the bundled datasets (london_covid_events.csv and ebola_sierraleone_2014_processed.csv),
+  subsampled to --events with a fixed seed: SVI and, unless --no-mcmc, a short NUTS run
+- synthetic datasets of increasing size (--synthetic-sizes), simulated from the posterior
+  mean of a pilot SVI fit of each model on the London subset by synthetic_events.py, with
+  the background level a_0 shifted so that the expected number of events matches the target
+  size: SVI only, since NUTS evaluates the exact O(N^2) likelihood
+- fine spatial grids (--grid-sizes): the LGCP and Cox-Hawkes models on the London subset with
+  the reduced-rank 'hsgp' spatial field of lowrank_gp.py on n x n computational grids, SVI
+  only; compare their steps/s, ms per ELBO evaluation and peak RSS with the 25 x 25 VAE field
+  of the bundled-dataset cases
+
+Every fit runs in a fresh interpreter with the minibatched models of scalable_models.py and
+fixed PRNG keys, and reports:
+
+- SVI: time to ELBO convergence, the first step at which the smoothed loss has made
+  --converge-frac of its total improvement, as execution time (converge_s) and including
+  initialization and compilation (converge_wall_s); steps/s and ms per ELBO evaluation
+- MCMC: minimum bulk and tail ESS per second over the sampled parameters, max R-hat and
+  leapfrog steps per second
+- both: compile and execute time and peak RSS of the fit (see fit_telemetry.py)
+
+Results are appended as JSON lines to --results, one record per fit, tagged with a run id,
+the git commit, package versions and host, and compared with the previous run of the same
+cases. Synthetic datasets are seeded, written once to <results dir>/synthetic and reused
+by later runs, since the pilot fit is the slow part of their simulation; each record
+carries a hash of its X/Y/T data, and ratios are only shown for cases on identical data.
+
+    python benchmark_suite.py --label "baseline"
+    python benchmark_suite.py --datasets london --models hawkes --no-mcmc --synthetic-sizes 1000 4000
+    python benchmark_suite.py --datasets --models lgcp coxhawkes --synthetic-sizes --grid-sizes 25 50 100 200
+    python benchmark_suite.py --compare-only RUN_A RUN_B
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(HERE, "..", "datasets")
+RESULTS_PATH = os.path.join(HERE, "..", "results", "benchmarks", "benchmark_suite.jsonl")
+
+# file, days added after the last event for T_max, and the spatial padding of each dataset's script
+DATASETS = {
+    "london": ("london_covid_events.csv", 7., 0.005),
+    "ebola": ("ebola_sierraleone_2014_processed.csv", 1., None),  # None: 1% of the extent
+}
+MODELS = ("lgcp", "hawkes", "coxhawkes")
+
+# case fields that must match for two records to be compared
+CASE_KEYS = ["dataset", "model", "method", "n_events", "data_sha", "settings"]
+# metric: True if higher is better
+METRICS = {"converge_s": False, "converge_wall_s": False, "steps_per_s": True, "ms_per_elbo": False,
+           "min_ess_bulk_per_s": True, "min_ess_tail_per_s": True, "leapfrog_per_s": True,
+           "compile_s": False, "peak_rss_mb": False}
+# ratios beyond this factor in the wrong direction are reported as regressions
+REGRESSION_RATIO = 1.1
+
+
+def load_dataset(path, n_events=None, seed=42):
+    """X/Y/T events of a CSV, optionally a seeded random subset of n_events, sorted by (T, X, Y)."""
+    events_df = pd.read_csv(path, usecols=["X", "Y", "T"])
+    if n_events and n_events < len(events_df):
+        events_df = events_df.sample(n=n_events, random_state=seed)
+    return events_df.sort_values(["T", "X", "Y"]).reset_index(drop=True)
+
+
+def domain(events_df, t_padding=7., bbox_padding=0.005):
+    """Spatial bounds and T_max around the events, as in the analysis scripts."""
+    x_min, x_max = events_df["X"].min(), events_df["X"].max()
+    y_min, y_max = events_df["Y"].min(), events_df["Y"].max()
+    pad_x = 0.01 * (x_max - x_min) if bbox_padding is None else bbox_padding
+    pad_y = 0.01 * (y_max - y_min) if bbox_padding is None else bbox_padding
+    return np.array([[x_min - pad_x, x_max + pad_x], [y_min - pad_y, y_max + pad_y]]), events_df["T"].max() + t_padding
+
+
+def data_sha(events_df):
+    """Short hash of the X/Y/T values, identifying the data a benchmark ran on."""
+    values = pd.util.hash_pandas_object(events_df[["X", "Y", "T"]], index=False).values
+    return hashlib.sha256(values.tobytes()).hexdigest()[:12]
+
+
+def build_model(model_name, events_df, grid_bounds, T_max, subsample_size, **field):
+    import numpyro.distributions as dist
+    from scalable_models import Minibatch_LGCP_Model, Minibatch_Hawkes_Model
+
+    priors = {"a_0": dist.Normal(1, 10), "alpha": dist.Beta(20, 60), "beta": dist.HalfNormal(2.0),
+              "sigmax_2": dist.HalfNormal(0.25)}
+    if model_name == "lgcp":
+        return Minibatch_LGCP_Model(events_df, grid_bounds, T_max, subsample_size=subsample_size, **field, **priors)
+    return Minibatch_Hawkes_Model(events_df, grid_bounds, T_max, subsample_size=subsample_size,
+                                  cox_background=model_name == "coxhawkes", **field, **priors)
+
+
+def elbo_convergence(losses, frac=0.95, window=None):
+    """
+    First step at which the smoothed loss has made frac of its total improvement.
+
+    Parameters
+    ----------
+    losses: array
+        SVI loss per step.
+    frac: float
+    window: int or None
+        Moving-average window; defaults to 2% of the steps (at least 10).
+
+    Returns
+    -------
+    int: 1-based step
+    """
+    losses = pd.Series(np.asarray(losses, dtype=float)).ffill()
+    window = window or max(len(losses) // 50, 10)
+    smooth = losses.rolling(window, min_periods=1).mean().values
+    start, end = smooth[0], smooth[-1]
+    if not start > end:
+        return len(losses)
+    return int(np.argmax(smooth - end <= (1 - frac) * (start - end))) + 1
+
+
+def run_single(case):
+    """Fit one case in this interpreter and return its metrics."""
+    import matplotlib
+    matplotlib.use("Agg")
+    from fit_telemetry import FitTelemetry
+
+    events_df = load_dataset(case["path"], case["n_events"], case["seed"])
+    grid_bounds, T_max = domain(events_df, case["t_padding"], case["bbox_padding"])
+    field = {k: case[k] for k in ("spatial_gp", "n_xy", "num_basis") if k in case}
+    model = build_model(case["model"], events_df, grid_bounds, T_max, case["subsample_size"], **field)
+    label = f"{case['dataset']}/{case['model']}"
+    out = {"n_events": len(events_df), "data_sha": data_sha(events_df)}
+
+    if case["method"] == "svi":
+        fit_kwargs = dict(num_steps=case["steps"], lr=case["lr"], num_samples=case["num_samples"], plot_loss=False)
+        with FitTelemetry(case["telemetry"], label, "svi", model=model, fit_kwargs=fit_kwargs) as telemetry:
+            model.run_svi(**fit_kwargs)
+        summary = telemetry.summary
+        step = elbo_convergence(model.svi_results.losses, case["converge_frac"])
+        step_s = summary["ms_per_step"] / 1e3
+        out.update(converge_step=step, converge_s=step * step_s,
+                   converge_wall_s=telemetry.phases["svi_init"]["seconds"] + summary["first_step_s"]
+                   + (step - 1) * step_s,
+                   final_loss=float(np.nanmean(np.asarray(model.svi_results.losses)[-max(case["steps"] // 50, 10):])))
+    else:
+        from mcmc_chains import chain_diagnostics
+        fit_kwargs = dict(num_warmup=case["num_warmup"], num_samples=case["num_samples"], num_chains=1)
+        with FitTelemetry(case["telemetry"], label, "mcmc", model=model, fit_kwargs=fit_kwargs) as telemetry:
+            model.run_mcmc(**fit_kwargs)
+        summary = telemetry.summary
+        diagnostics = chain_diagnostics(model, summary["wall_s"])
+        out.update(min_ess_bulk_per_s=diagnostics["ess_bulk_per_s"].min(),
+                   min_ess_tail_per_s=diagnostics["ess_tail_per_s"].min(), max_r_hat=diagnostics["r_hat"].max(),
+                   leapfrog_per_s=summary["leapfrog_per_s"], mean_tree_size=summary["mean_tree_size"])
+    out.update({k: summary.get(k) for k in ("wall_s", "compile_s", "execute_s", "steps_per_s", "ms_per_elbo",
+                                            "grad_evals", "peak_rss_mb")})
+    return out
+
+
+def simulate_datasets(model_name, sizes, base, out_dir, pilot_steps, seed):
+    """
+    Write synthetic datasets of the given sizes simulated from a pilot fit of model_name on base.
+
+    The pilot posterior means are used as parameters of synthetic_events.simulate_stpp, with
+    a_0 shifted so that the expected number of events is size.
+
+    Returns
+    -------
+    dict: size -> CSV path
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    from synthetic_events import pilot_parameters, simulate_stpp
+
+    events_df = load_dataset(base["path"], base["n_events"], seed)
+    grid_bounds, T_max = domain(events_df, base["t_padding"], base["bbox_padding"])
+    model = build_model(model_name, events_df, grid_bounds, T_max, base["subsample_size"])
+    model.run_svi(num_steps=pilot_steps, lr=0.02, num_samples=100, plot_loss=False)
+    pilot = pilot_parameters(model)
+
+    paths = {}
+    for size in sizes:
+        sample = simulate_stpp(model.args["model"], pilot, T_max, grid_bounds, n_events=size, seed=seed)
+        path = os.path.join(out_dir, f"{model_name}_{size}_seed{seed}.csv")
+        sample.to_csv(path, index=False)
+        paths[size] = path
+        print(f"[SIMULATED] {model_name}: {len(sample)} events (target {size}) -> {path}")
+    return paths
+
+
+def environment():
+    """Git commit and package versions the benchmark ran with."""
+    from importlib.metadata import version, PackageNotFoundError
+
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], capture_output=True, text=True, cwd=HERE).stdout.strip() or None
+        except OSError:
+            return None
+
+    versions = {}
+    for package in ("jax", "jaxlib", "numpyro", "bstpp", "numpy"):
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return {"git_commit": git("rev-parse", "--short", "HEAD"), "git_dirty": bool(git("status", "--porcelain", ".")),
+            "python": platform.python_version(), "versions": versions, "host": platform.node(),
+            "cpus": os.cpu_count()}
+
+
+def load_results(path):
+    with open(path) as f:
+        return pd.json_normalize([json.loads(line) for line in f if line.strip()])
+
+
+def compare_runs(results, baseline, current):
+    """
+    Ratio current / baseline of each metric for the cases both runs share.
+
+    Returns
+    -------
+    pd.DataFrame: one row per case; ratios > 1 are better for the *_per_s metrics, worse for the others.
+    """
+    base = results[results["run_id"] == baseline].drop_duplicates(CASE_KEYS, keep="last")
+    new = results[results["run_id"] == current].drop_duplicates(CASE_KEYS, keep="last")
+    merged = base.merge(new, on=CASE_KEYS, suffixes=("_base", ""))
+    out = merged[["dataset", "model", "method", "n_events"]].copy()
+    for metric in METRICS:
+        if f"{metric}_base" in merged:
+            out[f"{metric}_ratio"] = merged[metric] / merged[f"{metric}_base"]
+    return out.dropna(axis=1, how="all")
+
+
+def print_comparison(results, baseline, current):
+    table = compare_runs(results, baseline, current)
+    if table.empty:
+        print(f"\nNo cases on identical data shared with run {baseline}")
+        return
+    print(f"\n=== Run {current} / run {baseline} (higher is better for *_per_s) ===")
+    print(table.round(3).to_string(index=False))
+    for metric, higher_is_better in METRICS.items():
+        ratio = table.get(f"{metric}_ratio")
+        if ratio is None:
+            continue
+        worse = table[(ratio < 1 / REGRESSION_RATIO) if higher_is_better else (ratio > REGRESSION_RATIO)]
+        for _, row in worse.iterrows():
+            print(f"[REGRESSION] {row['dataset']}/{row['model']} ({row['method']}): {metric} x{row[f'{metric}_ratio']:.2f}")
+
+
+def _child(flag, payload):
+    """Run this script with flag payload in a fresh interpreter and return its RESULT."""
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), flag, json.dumps(payload)],
+                         capture_output=True, text=True, cwd=HERE, env=dict(os.environ, MPLBACKEND="Agg"))
+    lines = [l for l in out.stdout.splitlines() if l.startswith("RESULT ")]
+    if out.returncode != 0 or not lines:
+        print(out.stderr[-2000:])
+        return None
+    return json.loads(lines[-1][len("RESULT "):])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--datasets", nargs="*", default=list(DATASETS), choices=list(DATASETS))
+    parser.add_argument("--models", nargs="+", default=list(MODELS), choices=MODELS)
+    parser.add_argument("--events", type=int, default=2000, help="events subsampled from each bundled dataset")
+    parser.add_argument("--synthetic-sizes", nargs="*", type=int, default=[2000, 8000, 32000])
+    parser.add_argument("--grid-sizes", nargs="*", type=int, default=[],
+                        help="grid sides of the 'hsgp' spatial field cases (LGCP and Cox-Hawkes only)")
+    parser.add_argument("--num-basis", type=int, default=20, help="basis functions per axis of the 'hsgp' field")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--steps", type=int, default=2000)
+    parser.add_argument("--lr", type=float, default=0.02)
+    parser.add_argument("--subsample-size", type=int, default=512)
+    parser.add_argument("--num-samples", type=int, default=100, help="posterior draws of the SVI fits")
+    parser.add_argument("--converge-frac", type=float, default=0.95)
+    parser.add_argument("--no-mcmc", action="store_true")
+    parser.add_argument("--mcmc-warmup", type=int, default=100)
+    parser.add_argument("--mcmc-samples", type=int, default=200)
+    parser.add_argument("--pilot-steps", type=int, default=2000)
+    parser.add_argument("--results", default=RESULTS_PATH, help="JSONL file the records are appended to")
+    parser.add_argument("--label", default="", help="free-text tag stored with the run, e.g. a version")
+    parser.add_argument("--baseline", help="run id to compare with; defaults to the previous run")
+    parser.add_argument("--compare-only", nargs=2, metavar=("BASELINE", "RUN"), help="only compare two stored runs")
+    parser.add_argument("--single", help=argparse.SUPPRESS)
+    parser.add_argument("--simulate", help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.single:
+        print("RESULT " + json.dumps(run_single(json.loads(opts.single)), default=float))
+        return
+    if opts.simulate:
+        job = json.loads(opts.simulate)
+        paths = simulate_datasets(job["model"], job["sizes"], job["base"], job["out_dir"], job["pilot_steps"],
+                                  job["seed"])
+        print("RESULT " + json.dumps(paths))
+        return
+    if opts.compare_only:
+        print_comparison(load_results(opts.results), *opts.compare_only)
+        return
+
+    results_dir = os.path.dirname(os.path.abspath(opts.results))
+    synthetic_dir = os.path.join(results_dir, "synthetic")
+    os.makedirs(synthetic_dir, exist_ok=True)
+    settings = dict(seed=opts.seed, steps=opts.steps, lr=opts.lr, subsample_size=opts.subsample_size,
+                    num_samples=opts.num_samples, converge_frac=opts.converge_frac, num_warmup=opts.mcmc_warmup,
+                    mcmc_samples=opts.mcmc_samples, telemetry=os.path.join(results_dir, "benchmark_telemetry.jsonl"))
+    datasets = {name: dict(path=os.path.join(DATA_DIR, file), n_events=opts.events, t_padding=t_pad,
+                           bbox_padding=bbox_pad, subsample_size=opts.subsample_size)
+                for name, (file, t_pad, bbox_pad) in DATASETS.items()}
+
+    cases = []
+    for dataset in opts.datasets:
+        for model_name in opts.models:
+            cases.append(dict(datasets[dataset], dataset=dataset, model=model_name, method="svi"))
+            if not opts.no_mcmc:
+                cases.append(dict(datasets[dataset], dataset=dataset, model=model_name, method="mcmc"))
+    for model_name in opts.models if opts.synthetic_sizes else []:
+        paths = {size: os.path.join(synthetic_dir, f"{model_name}_{size}_seed{opts.seed}.csv")
+                 for size in opts.synthetic_sizes}
+        missing = [size for size, path in paths.items() if not os.path.exists(path)]
+        if missing:
+            _child("--simulate", dict(model=model_name, sizes=missing, base=datasets["london"], out_dir=synthetic_dir,
+                                      pilot_steps=opts.pilot_steps, seed=opts.seed))
+        for size, path in paths.items():
+            if os.path.exists(path):
+                cases.append(dict(datasets["london"], dataset=f"synthetic_{size}", model=model_name, method="svi",
+                                  path=path, n_events=None))
+            else:
+                print(f"[SKIPPED] synthetic {model_name} {size}: simulation failed")
+    for n_xy in opts.grid_sizes:
+        for model_name in [m for m in opts.models if m != "hawkes"]:
+            cases.append(dict(datasets["london"], dataset=f"london_hsgp_{n_xy}", model=model_name, method="svi",
+                              spatial_gp="hsgp", n_xy=n_xy, num_basis=opts.num_basis))
+
+    run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    env = environment()
+    print(f"Benchmark run {run_id} at {env['git_commit']}{' (dirty)' if env['git_dirty'] else ''}: {len(cases)} fits")
+    for case in cases:
+        case = dict(case, **settings)
+        # the MCMC draws are set separately from the posterior draws of SVI
+        case_settings = {k: case[k] for k in ("seed", "steps", "lr", "subsample_size", "num_samples", "converge_frac",
+                                              "spatial_gp", "n_xy", "num_basis") if k in case}
+        if case["method"] == "mcmc":
+            case.update(num_samples=opts.mcmc_samples)
+            case_settings = {k: case[k] for k in ("seed", "num_warmup", "num_samples")}
+        metrics = _child("--single", case)
+        if metrics is None:
+            print(f"[FAILED] {case['dataset']}/{case['model']} ({case['method']})")
+            continue
+        record = dict(run_id=run_id, label=opts.label, created=time.time(), dataset=case["dataset"],
+                      model=case["model"], method=case["method"],
+                      settings=json.dumps(case_settings, sort_keys=True), **metrics, **env)
+        with open(opts.results, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+        summary = (f"converged at step {metrics['converge_step']} ({metrics['converge_s']:.1f}s), "
+                   f"{metrics['steps_per_s']:.1f} steps/s" if case["method"] == "svi" else
+                   f"min ESS/s {metrics['min_ess_bulk_per_s']:.2f}, {metrics['leapfrog_per_s']:.0f} leapfrog/s")
+        print(f"{case['dataset']:>16} {case['model']:>9} {case['method']:>4} {metrics['n_events']:>6d} events: "
+              f"{summary}, compile {metrics['compile_s']:.1f}s, peak RSS {metrics['peak_rss_mb']:.0f} MB")
+
+    results = load_results(opts.results)
+    print(f"\nResults appended to {opts.results}")
+    previous = [r for r in results.sort_values("created")["run_id"].unique() if r != run_id]
+    baseline = opts.baseline or (previous[-1] if previous else None)
+    if baseline is not None:
+        print_comparison(results, baseline, run_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the truncated-kernel Hawkes likelihood against the dense one.
+
+For each event count, a minibatched pilot SVI fit provides posterior samples. The
+pilot gives the cutoffs and the draws at which both likelihoods are compared. The
+script reports for every tolerance:
+
+- the number of pairs kept, against the N(N-1)/2 pairs of the dense sum
+- the time of one jitted loss + gradient evaluation and the speedup over dense
+- the expected AIC on the pilot draws, and its deviation from the dense value
+
+Cutoffs from the priors ("prior" rows) are shown for comparison.
+
+    python benchmark_truncated_kernel.py --sizes 2000 5000 --tols 1e-2 1e-3 1e-4
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EVENTS_PATH = os.path.join(HERE, "..", "datasets", "london_covid_events.csv")
+
+
+def grad_time(model, repeats):
+    """Seconds per jitted evaluation of the potential energy and its gradient."""
+    import jax
+    from numpyro.infer.util import initialize_model
+    info = initialize_model(jax.random.PRNGKey(0), model.model, model_args=(model.args,))
+    value_and_grad = jax.jit(jax.value_and_grad(info.potential_fn))
+    params = info.param_info.z
+    jax.block_until_ready(value_and_grad(params))
+    start = time.time()
+    for _ in range(repeats):
+        jax.block_until_ready(value_and_grad(params))
+    return (time.time() - start)/repeats
+
+
+def expected_aic(model, samples):
+    """Expected AIC of model evaluated at fixed posterior draws."""
+    from jax import random
+    from numpyro.infer import Predictive
+    draws = {k: samples[k] for k, n in model.get_params().items() if n > 0}
+    loglik = Predictive(model.model, posterior_samples=draws, return_sites=['loglik'],
+                        parallel=False)(random.PRNGKey(0), args=model.args)['loglik']
+    return -2*float(np.mean(loglik)) + 2*sum(model.get_params().values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", default=EVENTS_PATH)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[2000, 5000])
+    parser.add_argument("--tols", nargs="+", type=float, default=[1e-2, 1e-3, 1e-4])
+    parser.add_argument("--pilot-steps", type=int, default=2000)
+    parser.add_argument("--num-samples", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=5)
+    opts = parser.parse_args()
+
+    import matplotlib
+    matplotlib.use("Agg")
+    import numpyro.distributions as dist
+    from scalable_models import Minibatch_Hawkes_Model
+    from truncated_kernel import Truncated_Hawkes_Model
+
+    priors = {
+        "a_0": dist.Normal(1, 10),
+        "alpha": dist.Beta(20, 60),
+        "beta": dist.HalfNormal(2.0),
+        "sigmax_2": dist.HalfNormal(0.25),
+    }
+    events_all = pd.read_csv(opts.events)
+    rows = []
+    for n in opts.sizes:
+        events_df = events_all.sample(n=min(n, len(events_all)), random_state=42).sort_values(["T", "X", "Y"]).reset_index(drop=True)
+        grid_bounds = np.array([[events_df["X"].min() - 0.005, events_df["X"].max() + 0.005],
+                                [events_df["Y"].min() - 0.005, events_df["Y"].max() + 0.005]])
+        T_max = events_df["T"].max() + 7
+        build = dict(data=events_df, A=grid_bounds, T=T_max, cox_background=False, **priors)
+
+        pilot = Minibatch_Hawkes_Model(subsample_size=256, **build)
+        pilot.run_svi(num_steps=opts.pilot_steps, lr=0.02, num_samples=opts.num_samples, plot_loss=False)
+
+        dense = Minibatch_Hawkes_Model(subsample_size=None, **build)
+        dense_s = grad_time(dense, opts.repeats)
+        dense_aic = expected_aic(dense, pilot.samples)
+        rows.append({"n_events": len(events_df), "cutoffs": "dense", "pairs": len(events_df)*(len(events_df) - 1)//2,
+                     "grad_ms": dense_s*1000, "speedup": 1.0, "aic": dense_aic, "aic_dev": 0.0})
+        print(rows[-1])
+
+        for source, tol in [("prior", opts.tols[0])] + [("pilot", tol) for tol in opts.tols]:
+            try:
+                model = Truncated_Hawkes_Model(tol=tol, cutoff_samples=pilot.samples if source == "pilot" else None,
+                                               **build)
+            except MemoryError as e:
+                print(f"{source} tol={tol}: {e}")
+                continue
+            s = grad_time(model, opts.repeats)
+            aic = expected_aic(model, pilot.samples)
+            rows.append({"n_events": len(events_df), "cutoffs": f"{source} tol={tol:g}", "pairs": model.num_pairs,
+                         "t_cutoff": model.cutoffs[0], "sp_cutoff": model.cutoffs[1],
+                         "grad_ms": s*1000, "speedup": dense_s/s, "aic": aic, "aic_dev": aic - dense_aic})
+            print(rows[-1])
+
+    print("\n=== Truncated vs dense triggering sum ===")
+    print(pd.DataFrame(rows).round(4).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
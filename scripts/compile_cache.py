@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent XLA compilation cache and compile/execute timing for bstpp fits.
+
+Every run_svi / run_mcmc call traces and compiles the model's JAX programs again,
+even when the data, priors and settings match the previous run's. For short daily
+refits the compilation can take longer than the fit itself. enable_compilation_cache
+points JAX at an on-disk cache, so a program compiled once is loaded from disk by
+later processes, including FitScheduler workers. It must be called before the first
+JAX computation. Programs are keyed on their HLO. The SVI step of the minibatched
+models takes the event arrays as arguments (scalable_models.EVENT_ARRAYS), so its
+program depends on the number of events but not on the events themselves, and a daily
+refit on new data reuses it; the grid, priors and settings are part of the program.
+The JAX release pinned by bstpp (0.4.23) only persists GPU/TPU programs. On CPU the
+cache needs a later JAX release, warmup is skipped, and the timing below still applies.
+
+CompileTimer splits the wall time of a block into compilation (tracing, lowering and
+XLA compilation or cache retrieval) and everything else, reported as execution.
+FitCache.fit and the FitScheduler workers log this split for every fit.
+
+warmup fills the cache ahead of time. It builds every SVI model of a run_pipeline.py
+config and compiles the SVI step that run_svi will execute (compile_svi of the
+minibatched models) from the shapes of its inputs, without running it. --events
+compiles it for other event counts as well, e.g. the expected size of tomorrow's table.
+MCMC programs depend on numpyro's sampler state and are compiled, and cached, by their
+first run.
+
+    python compile_cache.py london_pipeline.toml --events 36500 37000
+
+    enable_compilation_cache(f"{OUTPUT_DIR}/xla_cache")  # top of the script
+    with CompileTimer("lgcp_cov (svi)"):
+        lgcp_cov.run_svi(num_steps=500, lr=0.02)
+    # [TIMING] lgcp_cov (svi): 13.5s = 12.4s compile (283 programs, 0 from cache) + 1.1s execute
+"""
+
+import argparse
+import inspect
+import os
+import time
+import warnings
+
+# timers currently collecting compile events; JAX listeners cannot be removed, so one pair is registered
+_ACTIVE_TIMERS = []
+_LISTENING = False
+
+COMPILE_EVENTS = ("/jax/core/compile/jaxpr_trace_duration", "/jax/core/compile/jaxpr_to_mlir_module_duration",
+                  "/jax/core/compile/backend_compile_duration")
+
+
+def cpu_cache_supported():
+    """
+    Whether the installed JAX persists CPU programs.
+
+    Older releases only do so with XLA's experimental CPU runtime, which cannot compile
+    the sorts of numpyro's init_to_median.
+    """
+    from jax._src import compiler
+    return "xla_cpu_use_xla_runtime" not in inspect.getsource(compiler.compile_or_get_cached)
+
+
+def enable_compilation_cache(cache_dir, min_compile_time_s=0.):
+    """
+    Store compiled XLA programs in cache_dir and reuse them across processes.
+
+    Call before the first JAX computation (like enable_parallel_chains). The settings are
+    also exported as environment variables, so worker processes started later use the same cache.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Cache directory. Created if missing.
+    min_compile_time_s: float
+        Only programs that took at least this long to compile are written to the cache. The
+        default also keeps the hundreds of small programs of numpyro's eager initialization.
+    """
+    import jax
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_dir = os.path.abspath(cache_dir)
+    if not cpu_cache_supported():
+        warnings.warn(f"JAX {jax.__version__} does not persist CPU programs; {cache_dir} is only used on GPU/TPU")
+    os.environ["JAX_COMPILATION_CACHE_DIR"] = cache_dir
+    os.environ["JAX_PERSISTENT_CACHE_MIN_COMPILE_TIME_SECS"] = str(min_compile_time_s)
+    jax.config.update("jax_compilation_cache_dir", cache_dir)
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", min_compile_time_s)
+
+
+def _on_duration(event, duration, **kwargs):
+    if event in COMPILE_EVENTS:
+        for timer in _ACTIVE_TIMERS:
+            timer.compile_s += duration
+            timer.n_compiled += event == COMPILE_EVENTS[-1]
+
+
+def _on_event(event, **kwargs):
+    if event == "/jax/compilation_cache/cache_hits":
+        for timer in _ACTIVE_TIMERS:
+            timer.cache_hits += 1
+
+
+class CompileTimer:
+    def __init__(self, label, verbose=True):
+        """
+        Context manager splitting the wall time of a block into JAX compilation and execution.
+
+        Parameters
+        ----------
+        label: str
+            Name used in the printed summary.
+        verbose: bool
+            Print the summary when the block exits.
+        """
+        self.label = label
+        self.verbose = verbose
+        self.compile_s = 0.
+        self.n_compiled = 0
+        self.cache_hits = 0
+        self.wall_s = 0.
+
+    def __enter__(self):
+        global _LISTENING
+        from jax import monitoring
+        if not _LISTENING:
+            monitoring.register_event_duration_secs_listener(_on_duration)
+            monitoring.register_event_listener(_on_event)
+            _LISTENING = True
+        self._start = time.time()
+        _ACTIVE_TIMERS.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _ACTIVE_TIMERS.remove(self)
+        self.wall_s = time.time() - self._start
+        if self.verbose:
+            print(f"[TIMING] {self}")
+
+    @property
+    def execute_s(self):
+        return max(self.wall_s - self.compile_s, 0.)
+
+    def as_dict(self):
+        return {"compile_s": self.compile_s, "execute_s": self.execute_s, "compiled": self.n_compiled,
+                "compile_cache_hits": self.cache_hits}
+
+    def __str__(self):
+        return (f"{self.label}: {self.wall_s:.1f}s = {self.compile_s:.1f}s compile ({self.n_compiled} programs, "
+                f"{self.cache_hits} from cache) + {self.execute_s:.1f}s execute")
+
+
+def warmup(jobs, event_counts=(None,)):
+    """
+    Compile the SVI step of every SVI FitJob without running the fits.
+
+    Parameters
+    ----------
+    jobs: list of FitJob
+    event_counts: sequence of int or None
+        Numbers of events to compile each step for; None is the job's own event table.
+        Truncated Hawkes models are only compiled for their own table.
+
+    Returns
+    -------
+    list of CompileTimer, one per compiled job
+    """
+    timers = []
+    for job in jobs:
+        if job.method != "svi":
+            print(f"[SKIPPED] {job.name}: MCMC programs are compiled by the first run")
+            continue
+        model = job.build()
+        if not hasattr(model, "compile_svi"):
+            print(f"[SKIPPED] {job.name}: {type(model).__name__} has no compile_svi")
+            continue
+        for n in event_counts:
+            if n is not None and "pair_i" in model.args:
+                print(f"[SKIPPED] {job.name} @ {n} events: the pair list of a truncated model depends on the events")
+                continue
+            with CompileTimer(f"warmup {job.name} @ {n or len(model.args['t_events'])} events") as timer:
+                model.compile_svi(num_events=n, **job.fit_kwargs)
+            timers.append(timer)
+    return timers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompile the SVI programs of a run_pipeline.py config.")
+    parser.add_argument("config", help="TOML or YAML config, see london_pipeline.toml")
+    parser.add_argument("--cache-dir", help="defaults to paths.compilation_cache or <output_dir>/xla_cache")
+    parser.add_argument("--events", type=int, nargs="+", default=[],
+                        help="also compile for these numbers of events (the config's own table is always compiled)")
+    opts = parser.parse_args()
+
+    import jax
+    if jax.default_backend() == "cpu" and not cpu_cache_supported():
+        print(f"[SKIPPED] warmup is a no-op with JAX {jax.__version__} on CPU: this release does not persist CPU "
+              f"programs, so they would be compiled and discarded. Install a JAX release that persists CPU "
+              f"programs, or run on GPU/TPU.")
+        return
+
+    from run_pipeline import Pipeline, load_config
+    config = load_config(opts.config)
+    cache_dir = (opts.cache_dir or config["paths"]["compilation_cache"]
+                 or os.path.join(config["paths"]["output_dir"], "xla_cache"))
+    enable_compilation_cache(cache_dir)
+    start = time.time()
+    timers = warmup(Pipeline(config).fit_jobs, [None] + opts.events)
+    print(f"\nCompiled {sum(t.n_compiled for t in timers)} programs for {len(timers)} models into {cache_dir} "
+          f"in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
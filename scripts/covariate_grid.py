@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized construction of covariate grid cells.
+
+Covariates come as cell centres (X, Y in lon/lat) with a cell size given in a
+projected CRS, e.g. 2 km cells in British National Grid. covariate_grid projects all
+centres in one pyproj call, builds the cell corners with array arithmetic and projects
+the corners back, so there is no per-cell Python loop and no GeoSeries round trip.
+The resulting polygons are cached, in memory and optionally on disk, under a key made
+of the centres, both CRSs and the cell size.
+
+covariate_raster samples the covariate cells on a regular grid aligned to a model's
+cov_grid_size and returns a dense (n_y, n_x, n_cov) array. raster_cells turns such a
+raster back into a GeoDataFrame that can be passed to the bstpp models as spatial_cov.
+
+    spatial_cov = covariate_grid(covariates_df, 2000, grid_crs="EPSG:27700")
+    raster, xc, yc = covariate_raster(spatial_cov, cov_names, grid_bounds, (0.01, 0.01))
+    cells = raster_cells(raster, xc, yc, cov_names, (0.01, 0.01))
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import shapely
+
+# (src crs, grid crs, cell size, centres hash) -> (N, 4, 2) corner coordinates
+_GRID_CACHE = {}
+
+
+def _geopandas(caller):
+    """geopandas, imported on first use so that importing this module stays cheap."""
+    try:
+        import geopandas
+    except ImportError:
+        raise ImportError(f"{caller} requires geopandas (pip install geopandas)") from None
+    return geopandas
+
+
+def _cell_size(cell_size):
+    w, h = np.broadcast_to(np.asarray(cell_size, dtype=float), (2,))
+    return w, h
+
+
+def cell_polygons(x, y, cell_size):
+    """
+    Axis-aligned cells centred on (x, y), built with a single shapely.box call.
+
+    Parameters
+    ----------
+    x, y: array-like
+        Cell centres.
+    cell_size: float or (float, float)
+        Cell width and height in the units of x and y.
+
+    Returns
+    -------
+    np.ndarray of shapely Polygons
+    """
+    w, h = _cell_size(cell_size)
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    return shapely.box(x - w/2, y - h/2, x + w/2, y + h/2)
+
+
+def _grid_key(x, y, cell_size, crs, grid_crs):
+    h = hashlib.sha256()
+    h.update(f"{crs}|{grid_crs}|{_cell_size(cell_size)}|".encode())
+    h.update(np.ascontiguousarray(x, dtype=float).tobytes())
+    h.update(np.ascontiguousarray(y, dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def _projected_corners(x, y, cell_size, crs, grid_crs):
+    """Corners, in crs, of cells of cell_size (grid_crs units) centred on (x, y) given in crs."""
+    from pyproj import Transformer
+    w, h = _cell_size(cell_size)
+    to_grid = Transformer.from_crs(crs, grid_crs, always_xy=True)
+    gx, gy = to_grid.transform(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+    # counter-clockwise from the lower-left corner
+    cx = gx[:, None] + np.array([-w, w, w, -w])/2
+    cy = gy[:, None] + np.array([-h, -h, h, h])/2
+    from_grid = Transformer.from_crs(grid_crs, crs, always_xy=True)
+    cx, cy = from_grid.transform(cx, cy)
+    return np.stack([cx, cy], axis=-1)
+
+
+def covariate_grid(covariates, cell_size, crs="EPSG:4326", grid_crs=None, cache_dir=None):
+    """
+    GeoDataFrame of covariate cells from a table of cell centres.
+
+    Parameters
+    ----------
+    covariates: pd.DataFrame
+        Covariate table with cell centres in columns 'X' and 'Y' (in crs).
+    cell_size: float or (float, float)
+        Cell width and height in the units of grid_crs.
+    crs: str
+        CRS of the X/Y columns and of the returned polygons.
+    grid_crs: str or None
+        Projected CRS in which cells are square, e.g. "EPSG:27700". None builds the cells directly in crs.
+    cache_dir: str or None
+        Directory for cached cell corners. Results are always cached in memory.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        covariates with cell polygons as geometry, in crs.
+    """
+    gpd = _geopandas("covariate_grid")
+    x, y = covariates['X'].values, covariates['Y'].values
+    if grid_crs is None or grid_crs == crs:
+        geometry = cell_polygons(x, y, cell_size)
+    else:
+        key = _grid_key(x, y, cell_size, crs, grid_crs)
+        path = None if cache_dir is None else os.path.join(cache_dir, f"covgrid_{key}.npy")
+        if key not in _GRID_CACHE:
+            if path is not None and os.path.exists(path):
+                _GRID_CACHE[key] = np.load(path)
+            else:
+                _GRID_CACHE[key] = _projected_corners(x, y, cell_size, crs, grid_crs)
+                if path is not None:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    tmp = f"{path}.{os.getpid()}.tmp.npy"
+                    np.save(tmp, _GRID_CACHE[key])
+                    os.replace(tmp, path)
+        geometry = shapely.polygons(_GRID_CACHE[key])
+    return gpd.GeoDataFrame(covariates.reset_index(drop=True), geometry=geometry, crs=crs)
+
+
+def covariate_raster(spatial_cov, cov_names, grid_bounds, cov_grid_size):
+    """
+    Dense covariate array on a regular grid aligned to cov_grid_size.
+
+    Each raster cell takes the covariate values of the cell polygon containing its centre,
+    or NaN if no polygon does.
+
+    Parameters
+    ----------
+    spatial_cov: gpd.GeoDataFrame
+        Covariate polygons, e.g. from covariate_grid.
+    cov_names: list
+        Covariate columns to rasterize.
+    grid_bounds: np.ndarray
+        [[x_min, x_max], [y_min, y_max]] of the model domain, in the CRS of spatial_cov.
+    cov_grid_size: (float, float)
+        Raster cell width and height.
+
+    Returns
+    -------
+    raster: np.ndarray
+        (n_y, n_x, len(cov_names)) covariate values, row 0 at y_min.
+    xc, yc: np.ndarray
+        Raster cell centres along x and y.
+    """
+    w, h = _cell_size(cov_grid_size)
+    (x_min, x_max), (y_min, y_max) = np.asarray(grid_bounds, dtype=float)
+    xc = x_min + (np.arange(int(np.ceil((x_max - x_min)/w - 1e-9))) + 0.5)*w
+    yc = y_min + (np.arange(int(np.ceil((y_max - y_min)/h - 1e-9))) + 0.5)*h
+    gx, gy = np.meshgrid(xc, yc)
+
+    tree = shapely.STRtree(np.asarray(spatial_cov.geometry.values))
+    point_idx, cell_idx = tree.query(shapely.points(gx.ravel(), gy.ravel()), predicate="within")
+    raster = np.full((gx.size, len(cov_names)), np.nan)
+    raster[point_idx] = spatial_cov[cov_names].values[cell_idx]
+    return raster.reshape(len(yc), len(xc), len(cov_names)), xc, yc
+
+
+def raster_cells(raster, xc, yc, cov_names, cov_grid_size, crs="EPSG:4326"):
+    """
+    GeoDataFrame of the non-empty cells of a covariate raster, usable as spatial_cov.
+
+    Parameters
+    ----------
+    raster: np.ndarray
+        (n_y, n_x, n_cov) array from covariate_raster.
+    xc, yc: np.ndarray
+        Raster cell centres.
+    cov_names: list
+        Names of the raster layers.
+    cov_grid_size: (float, float)
+        Raster cell width and height, as passed to covariate_raster.
+    crs: str
+        CRS of the cell centres.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        Columns 'X', 'Y', cov_names and the cell polygons.
+    """
+    gpd = _geopandas("raster_cells")
+    gx, gy = np.meshgrid(xc, yc)
+    values = raster.reshape(-1, len(cov_names))
+    keep = ~np.isnan(values).any(axis=1)
+    cells = gpd.GeoDataFrame({'X': gx.ravel()[keep], 'Y': gy.ravel()[keep]})
+    for i, name in enumerate(cov_names):
+        cells[name] = values[keep, i]
+    return cells.set_geometry(cell_polygons(cells['X'].values, cells['Y'].values, cov_grid_size), crs=crs)
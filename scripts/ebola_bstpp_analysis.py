@@ -1,17 +1,15 @@
 # -*- coding: utf-8 -*-
 
 #pip install bstpp
-
-import bstpp
-
 #!pip install --upgrade scipy jax jaxlib
 
-from bstpp.main import LGCP_Model, Hawkes_Model,  Point_Process_Model
+from fit_cache import FitCache
+from event_store import read_events
+from posterior_store import save_posterior
 
 import os
 
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 
 # Try to import geopandas
@@ -21,9 +19,6 @@ try:
 except ImportError:
     HAS_GEOPANDAS = False
 
-import numpyro
-import numpyro.distributions as dist
-
 """# **CONFIGURATION**"""
 
 SEED = 42
@@ -39,9 +34,14 @@ FIGURE_DIR = '/content/drive/MyDrive/data1/bstpp_ebola_analysis_results/figures'
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(FIGURE_DIR, exist_ok=True)
 
+# Fits are keyed on data, domain, priors and inference settings; only changed models are refit
+FIT_CACHE_DIR = f"{OUTPUT_DIR}/fit_cache"
+FIT_CACHE_MAX_GB = 5
+fit_cache = FitCache(FIT_CACHE_DIR, max_bytes=int(FIT_CACHE_MAX_GB * 2**30))
+
 """#**DATA LOADING**"""
 
-events_df = pd.read_csv(EBOLA_CSV)
+events_df = read_events(EBOLA_CSV, store_dir=OUTPUT_DIR)
 
 # Clean NaNs
 events_df = events_df.dropna()
@@ -103,41 +103,16 @@ grid_bounds = np.array([[x_min - buffer_x, x_max + buffer_x],
 
 T_max = events_df['T'].max() + 1.0
 
-print("Grid Bounds:", grid_bounds_ebola)
-print("T_max:", T_max_ebola)
-
-"""#**Helper Inference Function**"""
-
-def run_inference(model, name, method, out_file, rng_key, **kwargs):
-    if os.path.exists(out_file):
-        try:
-            model.load_rslts(out_file)
-            print(f"[LOADED] {name} from {out_file}")
-            return True
-        except:
-            pass
-
-    print(f"[RUNNING] {method.upper()} for {name}")
-
-    start = time.time()
-    if method == "svi":
-        model.run_svi(**kwargs)
-    else:
-        model.run_mcmc(**kwargs)
-
-    elapsed = time.time() - start
-    print(f"[DONE] {name} ({method}) took {elapsed:.2f} seconds")
-
-    model.save_rslts(out_file)
-
-    if method == "svi":
-        plt.savefig(f"{FIGURE_DIR}/{name}_svi_loss.png")
-        plt.close()
-
-    return True
+print("Grid Bounds:", grid_bounds)
+print("T_max:", T_max)
 
 """#**Priors**"""
 
+# bstpp and JAX/numpyro are only loaded from here on, so the EDA above starts without them
+import numpyro.distributions as dist
+# without a subsample size the minibatched models evaluate bstpp's full likelihood, and add early stopping
+from scalable_models import Minibatch_LGCP_Model, Minibatch_Hawkes_Model
+
 priors = {
     "a_0": dist.Normal(1, 10),
     "alpha": dist.Beta(20, 60),
@@ -150,12 +125,18 @@ MCMC_WARMUP = 500
 MCMC_SAMPLES = 1500
 MCMC_CHAINS = 1
 
+# SVI stops once the smoothed loss has not improved by rtol for `patience` steps; SVI_STEPS is the upper bound
+SVI_STEPS = 20000
+SVI_LR = 0.001
+EARLY_STOPPING = dict(rtol=1e-4, patience=1000)  # None runs all SVI_STEPS (see svi_convergence.py)
+svi_kwargs = dict(num_steps=SVI_STEPS, lr=SVI_LR, plot_loss=True, early_stopping=EARLY_STOPPING)
+
 """#**MODEL FITTING**"""
 
-hawkes = Hawkes_Model(events_df, grid_bounds, T_max, **priors)
+hawkes = Minibatch_Hawkes_Model(events_df, grid_bounds, T_max, subsample_size=None, **priors)
 
-hawkes.run_svi(num_steps=20000, lr=0.001, plot_loss=True)
-hawkes.save_rslts(f"{OUTPUT_DIR}/hawkes_svi.pkl")
+fit_cache.fit(hawkes, "hawkes", "svi", **svi_kwargs)
+save_posterior(hawkes, f"{OUTPUT_DIR}/hawkes_svi.nc")
 
 hawkes.expected_AIC()
 
@@ -173,13 +154,13 @@ hawkes.plot_temporal()
 
 """# LGCP MODEL"""
 
-lgcp_cov = LGCP_Model(events_df, grid_bounds, T_max, cov_grid_size=(GRID_RESOLUTION, GRID_RESOLUTION),
-                  **priors)
+lgcp_cov = Minibatch_LGCP_Model(events_df, grid_bounds, T_max, subsample_size=None,
+                                cov_grid_size=(GRID_RESOLUTION, GRID_RESOLUTION), **priors)
 
 print("Running LGCP SVI...")
 
-lgcp_cov.run_svi(num_steps=20000, lr=0.001, plot_loss=True)
-lgcp_cov.save_rslts(f"{OUTPUT_DIR}/lgcp_cov_svi.pkl")
+fit_cache.fit(lgcp_cov, "lgcp_cov", "svi", **svi_kwargs)
+save_posterior(lgcp_cov, f"{OUTPUT_DIR}/lgcp_cov_svi.nc")
 
 print("SVI Completed and saved.")
 
@@ -197,12 +178,13 @@ lgcp_cov.plot_spatial()
 
 """# COX HAWKES MODEL"""
 
-coxhawkes_cov = Hawkes_Model(events_df, grid_bounds, T_max, cox_background=True, **priors)
+coxhawkes_cov = Minibatch_Hawkes_Model(events_df, grid_bounds, T_max, subsample_size=None, cox_background=True,
+                                       **priors)
 
 print("Running Cox-Hawkes SVI...")
 
-coxhawkes_cov.run_svi(num_steps=20000, lr=0.001, plot_loss=True)
-coxhawkes_cov.save_rslts(f"{OUTPUT_DIR}/coxhawkes_cov_svi.pkl")
+fit_cache.fit(coxhawkes_cov, "coxhawkes_cov", "svi", **svi_kwargs)
+save_posterior(coxhawkes_cov, f"{OUTPUT_DIR}/coxhawkes_cov_svi.nc")
 
 print("SVI Completed and saved.")
 
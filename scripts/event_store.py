@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar event store for X/Y/T event tables.
+
+ingest_events converts an events CSV once into a typed, T-sorted Parquet file (or an
+uncompressed Arrow IPC file with the ``.arrow`` suffix). Rows at equal times are ordered
+by X, then Y: Hawkes likelihoods depend on the order of such ties (an earlier row excites
+a later one at the same time), and this is the order collapse_duplicates expands to. X and Y are stored as float32.
+T stays float64 because Hawkes trigger terms use differences of event times. load_events
+reads the store through pyarrow.dataset with memory mapping. Time windows and bounding
+boxes are pushed down as filters: on the T-sorted Parquet layout, row groups outside
+the time window are skipped from their statistics without being read.
+
+read_events is what the analysis scripts call. It (re)builds the store when the CSV is
+newer, and falls back to pandas when pyarrow is not installed. iter_events reads the
+same events in fixed-size chunks for single-pass statistics over files larger than
+memory (see streaming_stats.py).
+
+collapse_duplicates (read_events(..., collapse=True), or --collapse when ingesting)
+replaces exact duplicate (X, Y, T) rows by one row with a 'weight' column counting them;
+the minibatched models take it with weight_col="weight" and evaluate each unique tuple once.
+For Hawkes models the weighted likelihood equals the point-level one of the table sorted
+by (T, X, Y), as read_events returns it.
+
+    python event_store.py ../datasets/london_covid_events.csv london_covid_events.parquet
+    python event_store.py ../datasets/london_covid_events.csv london_covid_unique.parquet --collapse
+
+    events_df = read_events(EVENTS_PATH, store_dir=OUTPUT_DIR, t_range=(0, 40))
+"""
+
+import argparse
+import os
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+    import pyarrow.parquet as pq
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+COLUMN_TYPES = {"X": "float32", "Y": "float32", "T": "float64"}
+# row order of the store and of read_events; ties in T are broken as collapse_duplicates does
+SORT_KEYS = ["T", "X", "Y"]
+ROW_GROUP_SIZE = 65536
+WEIGHT_COLUMN = "weight"
+
+
+def _format(store_path):
+    return "ipc" if store_path.endswith((".arrow", ".feather")) else "parquet"
+
+
+def collapse_duplicates(events, weight_col=WEIGHT_COLUMN):
+    """
+    One row per distinct (X, Y, T) tuple, with the number of events it stands for.
+
+    Parameters
+    ----------
+    events: pd.DataFrame
+        Events with columns 'X', 'Y', 'T'. Other columns are dropped, except an existing
+        weight_col, whose values are summed (so collapsing is idempotent).
+    weight_col: str
+
+    Returns
+    -------
+    pd.DataFrame with columns 'X', 'Y', 'T', weight_col (int64), sorted by (T, X, Y).
+    The weighted Hawkes likelihood of the result equals the point-level one of events in
+    this order; with another order of equal-time rows the point-level value differs.
+    """
+    weights = events[weight_col] if weight_col in events else pd.Series(1, index=events.index)
+    collapsed = (events[["X", "Y", "T"]].assign(**{weight_col: weights.astype("int64")})
+                 .groupby(SORT_KEYS, sort=True)[weight_col].sum().reset_index())
+    return collapsed[["X", "Y", "T", weight_col]]
+
+
+def ingest_events(csv_path, store_path, row_group_size=ROW_GROUP_SIZE, collapse=False):
+    """
+    Convert an events CSV into a columnar store sorted by (T, X, Y).
+
+    Parameters
+    ----------
+    csv_path: str
+        CSV with columns 'X', 'Y', 'T' (other columns are kept as parsed).
+    store_path: str
+        Output file, '.parquet' or '.arrow'.
+    row_group_size: int
+        Rows per Parquet row group / Arrow record batch; the granularity of time-window skipping.
+    collapse: bool
+        Store one weighted row per distinct (X, Y, T) tuple (see collapse_duplicates).
+
+    Returns
+    -------
+    int: number of rows written
+    """
+    if not HAS_PYARROW:
+        raise ImportError("ingest_events requires pyarrow (pip install pyarrow)")
+    table = pacsv.read_csv(csv_path)
+    if collapse:
+        table = pa.Table.from_pandas(collapse_duplicates(table.to_pandas()), preserve_index=False)
+    schema = pa.schema([pa.field(f.name, pa.type_for_alias(COLUMN_TYPES[f.name]) if f.name in COLUMN_TYPES else f.type)
+                        for f in table.schema])
+    table = table.cast(schema)
+    table = table.take(pc.sort_indices(table, sort_keys=[(c, "ascending") for c in SORT_KEYS]))
+
+    os.makedirs(os.path.dirname(os.path.abspath(store_path)), exist_ok=True)
+    tmp = f"{store_path}.{os.getpid()}.tmp"
+    if _format(store_path) == "ipc":
+        # uncompressed so that reads are zero-copy views into the memory map
+        with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            for batch in table.to_batches(max_chunksize=row_group_size):
+                writer.write_batch(batch)
+    else:
+        pq.write_table(table, tmp, row_group_size=row_group_size, compression="zstd")
+    os.replace(tmp, store_path)
+    return table.num_rows
+
+
+def _filter(t_range, bbox):
+    expr = None
+    conditions = []
+    if t_range is not None:
+        conditions += [ds.field("T") >= t_range[0], ds.field("T") <= t_range[1]]
+    if bbox is not None:
+        (x_min, x_max), (y_min, y_max) = bbox
+        conditions += [ds.field("X") >= x_min, ds.field("X") <= x_max,
+                       ds.field("Y") >= y_min, ds.field("Y") <= y_max]
+    for c in conditions:
+        expr = c if expr is None else expr & c
+    return expr
+
+
+def load_events(store_path, t_range=None, bbox=None, columns=None):
+    """
+    Read events from a store written by ingest_events.
+
+    Parameters
+    ----------
+    store_path: str
+    t_range: (float, float) or None
+        Inclusive time window.
+    bbox: array-like or None
+        [[x_min, x_max], [y_min, y_max]], the same layout as the models' grid_bounds.
+    columns: list or None
+        Columns to read. Defaults to all.
+
+    Returns
+    -------
+    pd.DataFrame, sorted by (T, X, Y).
+    """
+    if not HAS_PYARROW:
+        raise ImportError("load_events requires pyarrow (pip install pyarrow)")
+    dataset = ds.dataset(store_path, format=_format(store_path),
+                         filesystem=pafs.LocalFileSystem(use_mmap=True))
+    table = dataset.to_table(columns=columns, filter=_filter(t_range, bbox))
+    # stores written by older versions are only sorted by T
+    events = table.to_pandas()
+    keys = [c for c in SORT_KEYS if c in events]
+    return events.sort_values(keys, kind="stable").reset_index(drop=True) if keys else events
+
+
+def _read_csv_events(csv_path, t_range=None, bbox=None, columns=None):
+    """Pandas equivalent of ingest_events + load_events."""
+    events = pd.read_csv(csv_path)
+    events = events.astype({c: t for c, t in COLUMN_TYPES.items() if c in events.columns})
+    events = events.sort_values(SORT_KEYS, kind="stable").reset_index(drop=True)
+    keep = np.ones(len(events), dtype=bool)
+    if t_range is not None:
+        keep &= events["T"].between(*t_range).values
+    if bbox is not None:
+        (x_min, x_max), (y_min, y_max) = bbox
+        keep &= (events["X"].between(x_min, x_max) & events["Y"].between(y_min, y_max)).values
+    events = events[keep].reset_index(drop=True)
+    return events if columns is None else events[columns]
+
+
+def read_events(csv_path, store_dir=None, fmt="parquet", t_range=None, bbox=None, columns=None, collapse=False):
+    """
+    Load events through a columnar store next to the outputs, ingesting the CSV when needed.
+
+    Parameters
+    ----------
+    csv_path: str
+        Source CSV with columns 'X', 'Y', 'T'.
+    store_dir: str or None
+        Directory of the store. Defaults to the CSV's directory.
+    fmt: str
+        'parquet' or 'arrow'
+    t_range, bbox, columns:
+        see load_events
+    collapse: bool
+        Return one row per distinct (X, Y, T) tuple with a 'weight' column (see collapse_duplicates).
+
+    Returns
+    -------
+    pd.DataFrame, sorted by (T, X, Y).
+    """
+    if not HAS_PYARROW:
+        warnings.warn("pyarrow is not installed; reading events from CSV")
+        events = _read_csv_events(csv_path, t_range, bbox, columns)
+    else:
+        name = os.path.splitext(os.path.basename(csv_path))[0]
+        store_path = os.path.join(store_dir or os.path.dirname(csv_path), f"{name}.{fmt}")
+        if not os.path.exists(store_path) or os.path.getmtime(store_path) < os.path.getmtime(csv_path):
+            start = time.time()
+            n = ingest_events(csv_path, store_path)
+            print(f"Ingested {n} events from {csv_path} into {store_path} in {time.time() - start:.2f}s")
+        events = load_events(store_path, t_range, bbox, columns)
+    if collapse:
+        n = len(events)
+        events = collapse_duplicates(events)
+        print(f"Collapsed {n} events into {len(events)} distinct (X, Y, T) rows ({n/max(len(events), 1):.2f}x)")
+    return events
+
+
+def iter_events(csv_path, store_dir=None, fmt="parquet", chunk_rows=1_000_000, columns=None):
+    """
+    Events in chunks of at most chunk_rows rows, without holding the whole table in memory.
+
+    An up-to-date store written by ingest_events (see read_events) is read batch by batch,
+    in T order. Otherwise the CSV is parsed in chunks, in file order: ingesting it would
+    read it in full.
+
+    Parameters
+    ----------
+    csv_path: str
+        Source CSV with columns 'X', 'Y', 'T'.
+    store_dir, fmt:
+        see read_events
+    chunk_rows: int
+    columns: list or None
+        Columns to read. Defaults to all.
+
+    Yields
+    ------
+    pd.DataFrame
+    """
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    store_path = os.path.join(store_dir or os.path.dirname(csv_path), f"{name}.{fmt}")
+    if HAS_PYARROW and os.path.exists(store_path) and os.path.getmtime(store_path) >= os.path.getmtime(csv_path):
+        dataset = ds.dataset(store_path, format=_format(store_path),
+                             filesystem=pafs.LocalFileSystem(use_mmap=True))
+        for batch in dataset.to_batches(columns=columns, batch_size=chunk_rows):
+            yield batch.to_pandas()
+        return
+    for chunk in pd.read_csv(csv_path, usecols=columns, chunksize=chunk_rows):
+        yield chunk.astype({c: t for c, t in COLUMN_TYPES.items() if c in chunk.columns})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert an X/Y/T events CSV into a T-sorted columnar store.")
+    parser.add_argument("csv_path")
+    parser.add_argument("store_path", help="output .parquet or .arrow file")
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE)
+    parser.add_argument("--collapse", action="store_true",
+                        help=f"one row per distinct (X, Y, T) tuple with a '{WEIGHT_COLUMN}' column")
+    opts = parser.parse_args()
+    start = time.time()
+    n = ingest_events(opts.csv_path, opts.store_path, opts.row_group_size, collapse=opts.collapse)
+    print(f"{n} {'distinct (X, Y, T) rows' if opts.collapse else 'events'} written to {opts.store_path} in "
+          f"{time.time() - start:.2f}s ({os.path.getsize(opts.store_path)/2**20:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
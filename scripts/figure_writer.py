@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Background figure writing for headless runs.
+
+Rendering and compressing a PNG takes far longer than building the figure. FigureWriter
+lets the calling thread build each figure as usual and then hand it over. save()
+detaches the figure from pyplot, so it no longer accumulates in pyplot's figure list,
+and renders it to disk in a small thread pool. Figures are only created and modified
+on the calling thread, and each worker thread renders a single, already detached
+figure, so pyplot's global state is never touched concurrently.
+
+    with FigureWriter(FIGURE_DIR) as figures:
+        model.plot_temporal()
+        figures.save_current("lgcp_temporal")
+        figures.save_new(lambda: model.plot_trigger_posterior(trace=False), "hawkes_trigger")
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import matplotlib.pyplot as plt
+
+
+class FigureWriter:
+    def __init__(self, figure_dir, max_workers=4, fmt="png", dpi=100):
+        """
+        Thread pool writing matplotlib figures to figure_dir.
+
+        Parameters
+        ----------
+        figure_dir: str
+            Output directory. Created if missing.
+        max_workers: int
+            Figures rendered concurrently. 0 writes synchronously on the calling thread.
+        fmt: str
+            File format, used as the suffix of names without one.
+        dpi: int
+        """
+        self.figure_dir = figure_dir
+        self.fmt = fmt
+        self.dpi = dpi
+        self.pool = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 0 else None
+        self.pending = []
+        self.written = []
+        os.makedirs(figure_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _path(self, name):
+        return os.path.join(self.figure_dir, name if os.path.splitext(name)[1] else f"{name}.{self.fmt}")
+
+    def _write(self, fig, path):
+        fig.savefig(path, dpi=self.dpi, bbox_inches="tight")
+        return path
+
+    def save(self, fig, name):
+        """
+        Write fig to figure_dir/name in the background and detach it from pyplot.
+
+        Returns
+        -------
+        str: output path
+        """
+        path = self._path(name)
+        plt.close(fig)
+        if self.pool is None:
+            self.written.append(self._write(fig, path))
+        else:
+            self.pending.append(self.pool.submit(self._write, fig, path))
+        return path
+
+    def save_current(self, name):
+        """Save pyplot's current figure (e.g. after a bstpp plot method)."""
+        return self.save(plt.gcf(), name)
+
+    def save_new(self, plot, name):
+        """
+        Call plot() and save every figure it opened, as name, name_1, name_2, ...
+
+        Returns
+        -------
+        list of str: output paths
+        """
+        before = set(plt.get_fignums())
+        plot()
+        new = [n for n in plt.get_fignums() if n not in before]
+        return [self.save(plt.figure(n), name if i == 0 else f"{name}_{i}") for i, n in enumerate(new)]
+
+    def wait(self):
+        """Block until all submitted figures are written; re-raises the first write error."""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            self.written.append(future.result())
+        return self.written
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
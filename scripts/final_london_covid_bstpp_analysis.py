@@ -1,19 +1,21 @@
 # -*- coding: utf-8 -*-
 #pip install bstpp
-
-import bstpp
-
 #pip install --upgrade scipy jax jaxlib
 
-from bstpp.main import LGCP_Model, Hawkes_Model
+# bstpp and the model modules (JAX/numpyro) are imported in the sections that use them
+from fit_cache import FitCache
+from fit_scheduler import FitJob, FitScheduler
+from mcmc_chains import enable_parallel_chains, run_mcmc_chains
+from covariate_grid import covariate_grid
+from event_store import read_events
+from posterior_store import load_posterior, read_posterior, save_posterior
+from functools import partial
 
 import pandas as pd
 import numpy as np
 import os
 import matplotlib.pyplot as plt
 import geopandas as gpd
-import numpyro.distributions as dist
-from shapely.geometry import box
 
 """#**CONFIGURATION**"""
 
@@ -24,18 +26,74 @@ FIGURE_DIR = "/kaggle/working/"
 SHAPEFILE_PATH = "/kaggle/input/coviduk/Greater_London_Authority_(GLA).shp"  # Update path if available
 
 
-SUBSET_SIZE = 10000
+SUBSET_SIZE = None  # None fits the full event table; set an int to fit a random subsample
+MINIBATCH_SIZE = 512  # events per SVI step in the minibatched likelihoods
+# NUTS needs the exact likelihood, which costs O(N^2) per gradient (about 1 s at 8k events and
+# over 20 s on the full table, see benchmark_london_scaling.py): the MCMC fits use a seeded
+# subsample of this many events, as many as the dense fits of the original analysis saw. Their
+# memory is O(ROW_BLOCK*N) (a 10k coxhawkes_cov chain peaks at about 0.7 GB), so this is a time
+# budget only. None runs them on the full table.
+MCMC_SUBSET_SIZE = 10000
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(FIGURE_DIR, exist_ok=True)
 
+# Fits are keyed on data, domain, priors, covariates and inference settings; only changed models are refit
+FIT_CACHE_DIR = f"{OUTPUT_DIR}/fit_cache"
+FIT_CACHE_MAX_GB = 5
+fit_cache = FitCache(FIT_CACHE_DIR, max_bytes=int(FIT_CACHE_MAX_GB * 2**30))
+
+# Fit all six model/method combinations concurrently before the per-model sections,
+# which then load the results from the fit cache.
+PARALLEL_FITS = True
+FIT_WORKERS = 6  # concurrent fits
+CPUS_PER_FIT = None  # cores pinned to each fit; None splits the machine evenly
+
+# Truncated triggering kernel: only event pairs within the kernel cutoffs for this tolerance
+# enter the Hawkes sums (see truncated_kernel.py). None uses the minibatched dense sums.
+KERNEL_TOL = None  # e.g. 1e-3
+KERNEL_CUTOFF_RSLTS = f"{OUTPUT_DIR}/hawkes_svi.nc"  # pilot fit whose posterior sets the cutoffs
+
+# Model comparison: WAIC / PSIS-LOO from [draws, events] pointwise log-likelihoods, cached per fit
+POINTWISE_CACHE_DIR = f"{OUTPUT_DIR}/pointwise_cache"
+COMPARISON_DRAWS = 200  # thinned posterior draws per model; None uses all
+
+# Frames of the posterior intensity animation (small multiples show 5 of them)
+INTENSITY_FRAMES = 100
+
+# Daily refresh: warm-started Cox-Hawkes update on the days added since the last run
+DAILY_UPDATE = False
+DAILY_RSLTS = f"{OUTPUT_DIR}/coxhawkes_cov_daily.pkl"
+T_HORIZON = 365  # fixed time rescaling shared by all daily updates; must exceed the last day
+DAILY_MAX_LAG = 21  # days of history kept as parents of the new events
+DAILY_FIRST_WINDOW = 28  # days in the likelihood window of the first fit, which later updates extend
+DAILY_SVI_STEPS = 2000
+
+# Chains run in parallel on separate XLA CPU devices; must be set before any JAX computation
+MCMC_CHAINS = 4
+enable_parallel_chains(MCMC_CHAINS)
+
+# Optional persistent XLA compilation cache shared with the fit workers (see compile_cache.py)
+XLA_CACHE_DIR = None  # e.g. f"{OUTPUT_DIR}/xla_cache"
+if XLA_CACHE_DIR is not None:
+    from compile_cache import enable_compilation_cache
+    enable_compilation_cache(XLA_CACHE_DIR)
+
+# Per-fit steps/s, ELBO and leapfrog throughput and peak memory as JSON lines (see fit_telemetry.py)
+TELEMETRY_FILE = f"{OUTPUT_DIR}/fit_telemetry.jsonl"  # None disables
+if TELEMETRY_FILE is not None:
+    from fit_telemetry import enable_telemetry
+    enable_telemetry(TELEMETRY_FILE)
+
 """#**LOAD DATA**"""
 
-events_df = pd.read_csv(EVENTS_PATH)
-events_df = events_df.sample(n=SUBSET_SIZE, random_state=42).sort_values("T").reset_index(drop=True)
-#events_df = events_df[events_df["T"] <= 40].copy()
+# T-sorted columnar copy of the CSV in OUTPUT_DIR, rebuilt when the CSV changes
+events_df = read_events(EVENTS_PATH, store_dir=OUTPUT_DIR)
+if SUBSET_SIZE is not None:
+    events_df = events_df.sample(n=SUBSET_SIZE, random_state=42).sort_values(["T", "X", "Y"]).reset_index(drop=True)
+#events_df = read_events(EVENTS_PATH, store_dir=OUTPUT_DIR, t_range=(0, 40))
 
-print("Subset events data:")
+print("Events data:")
 print(events_df.head())
 
 events_df['T'].unique()
@@ -96,6 +154,8 @@ if SHAPEFILE_PATH and os.path.exists(SHAPEFILE_PATH):
 
 """#**DEFINE SPATIAL DOMAIN**"""
 
+import numpyro.distributions as dist
+
 x_min, x_max = events_df["X"].min() - 0.005, events_df["X"].max() + 0.005
 y_min, y_max = events_df["Y"].min() - 0.005, events_df["Y"].max() + 0.005
 grid_bounds = np.array([[x_min, x_max], [y_min, y_max]])
@@ -111,11 +171,18 @@ priors = {
 
 MCMC_WARMUP = 100
 MCMC_SAMPLES = 400
-MCMC_CHAINS = 1
 
-SVI_STEPS = 15000
+SVI_STEPS = 15000  # upper bound; SVI stops once the smoothed loss plateaus
 SVI_LR = 0.02
+EARLY_STOPPING = dict(rtol=1e-4, patience=1000)  # None runs all SVI_STEPS (see svi_convergence.py)
+# cached fits save their state every so many SVI steps / MCMC iterations and resume after a preemption
+SVI_CHECKPOINT_EVERY = 1000
+MCMC_CHECKPOINT_EVERY = 50
 GRID_RESOLUTION = 0.5
+# spatial field of the Cox backgrounds: "vae" (bstpp's decoder, 25 x 25 grid only) or "hsgp" on a
+# SPATIAL_GRID x SPATIAL_GRID grid (see lowrank_gp.py)
+SPATIAL_GP = "vae"
+SPATIAL_GRID = 25
 SAMPLE_EVENTS = 10000
 
 """# LOAD + SAMPLE EVENTS"""
@@ -135,25 +202,21 @@ SAMPLE_EVENTS = 10000
 events_gdf = gpd.GeoDataFrame(events_df, geometry=gpd.points_from_xy(events_df.X, events_df.Y))
 events_gdf.crs = "EPSG:4326"
 
+# MCMC events, on the domain (grid_bounds, T_max) of the full table
+if MCMC_SUBSET_SIZE is None or MCMC_SUBSET_SIZE >= len(events_gdf):
+    mcmc_events_gdf = events_gdf
+else:
+    mcmc_events_gdf = events_gdf.sample(n=MCMC_SUBSET_SIZE, random_state=42).sort_values(["T", "X", "Y"]).reset_index(drop=True)
+mcmc_events_df = pd.DataFrame(mcmc_events_gdf[["X", "Y", "T"]])
+
 """# LOAD + SAMPLE SPATIAL COVARIATES"""
 
 covariates_df_raw = pd.read_csv(COVARIATES_PATH).drop_duplicates(subset=["X", "Y"]).reset_index(drop=True)
 
-covariates_gdf = gpd.GeoDataFrame(covariates_df_raw, geometry=gpd.points_from_xy(covariates_df_raw.X, covariates_df_raw.Y))
-covariates_gdf.crs = "EPSG:4326"
-
-covariates_gdf = covariates_gdf.to_crs("EPSG:27700")
-
-# Create polygons
+# 2 km cells in British National Grid, reprojected to lon/lat (cached by CRS and cell size)
 grid_size = 2000  # meters
-polygons = []
-for point in covariates_gdf.geometry:
-    x, y = point.x, point.y
-    polygons.append(box(x - grid_size/2, y - grid_size/2, x + grid_size/2, y + grid_size/2))
-
-covariates_gdf['geometry'] = polygons
-covariates_gdf.crs = "EPSG:27700"
-covariates_gdf = covariates_gdf.to_crs("EPSG:4326")
+covariates_gdf = covariate_grid(covariates_df_raw, grid_size, crs="EPSG:4326", grid_crs="EPSG:27700",
+                                cache_dir=f"{OUTPUT_DIR}/covariate_grid_cache")
 
 spatial_cov = covariates_gdf
 
@@ -161,26 +224,109 @@ events_gdf.head()
 
 spatial_cov.head()
 
-"""# LGCP MODEL"""
+"""# MODEL DEFINITIONS + PARALLEL FITTING"""
 
-spatial_cov.columns
-
-lgcp_cov_priors = {
-    "a_0": dist.Normal(0, 10)
-}
+from scalable_models import Minibatch_LGCP_Model, Minibatch_Hawkes_Model
 
 covariate_columns = ['popdensity', 'covid_deaths', 'popn', 'houseprice']
 
-lgcp_cov = LGCP_Model(events_gdf, grid_bounds, T_max,
-                  cov_grid_size=(GRID_RESOLUTION, GRID_RESOLUTION),
-                  spatial_cov=spatial_cov,
-                  cov_names=covariate_columns,
-                  **priors)
+lgcp_cov_kwargs = dict(subsample_size=MINIBATCH_SIZE,
+                       cov_grid_size=(GRID_RESOLUTION, GRID_RESOLUTION),
+                       spatial_gp=SPATIAL_GP, n_xy=SPATIAL_GRID,
+                       spatial_cov=spatial_cov,
+                       cov_names=covariate_columns,
+                       **priors)
+build_lgcp_cov = partial(Minibatch_LGCP_Model, events_gdf, grid_bounds, T_max, **lgcp_cov_kwargs)
+build_lgcp_cov_mcmc = partial(Minibatch_LGCP_Model, mcmc_events_gdf, grid_bounds, T_max, **lgcp_cov_kwargs)
+
+if KERNEL_TOL is None:
+    hawkes_class = partial(Minibatch_Hawkes_Model, subsample_size=MINIBATCH_SIZE)
+else:
+    from truncated_kernel import Truncated_Hawkes_Model
+    # the priors are too vague to truncate anything; take the cutoffs from the last Hawkes fit
+    hawkes_class = partial(Truncated_Hawkes_Model, tol=KERNEL_TOL, cutoff_samples=read_posterior(KERNEL_CUTOFF_RSLTS))
+
+coxhawkes_cov_kwargs = dict(cox_background=True,
+                            spatial_gp=SPATIAL_GP, n_xy=SPATIAL_GRID,
+                            spatial_cov=spatial_cov,
+                            cov_names=covariate_columns,
+                            **priors)
+build_coxhawkes_cov = partial(hawkes_class, events_gdf, grid_bounds, T_max, **coxhawkes_cov_kwargs)
+build_coxhawkes_cov_mcmc = partial(hawkes_class, mcmc_events_gdf, grid_bounds, T_max, **coxhawkes_cov_kwargs)
+
+build_hawkes = partial(hawkes_class, events_df, grid_bounds, T_max, **priors)
+build_hawkes_mcmc = partial(hawkes_class, mcmc_events_df, grid_bounds, T_max, **priors)
+
+svi_kwargs = dict(num_steps=SVI_STEPS, lr=SVI_LR, plot_loss=True, early_stopping=EARLY_STOPPING,
+                  checkpoint_every=SVI_CHECKPOINT_EVERY)
+mcmc_kwargs = dict(num_warmup=MCMC_WARMUP, num_samples=MCMC_SAMPLES, num_chains=MCMC_CHAINS,
+                   checkpoint_every=MCMC_CHECKPOINT_EVERY)
+
+fit_jobs = [
+    FitJob("Hawkes (MCMC)", build_hawkes_mcmc, "mcmc", mcmc_kwargs, out_file=f"{OUTPUT_DIR}/hawkes_mcmc.nc"),
+    FitJob("Hawkes (SVI)", build_hawkes, "svi", svi_kwargs, out_file=f"{OUTPUT_DIR}/hawkes_svi.nc"),
+    FitJob("LGCP_cov (SVI)", build_lgcp_cov, "svi", svi_kwargs, out_file=f"{OUTPUT_DIR}/lgcp_cov_svi.nc"),
+    FitJob("LGCP_cov (MCMC)", build_lgcp_cov_mcmc, "mcmc", mcmc_kwargs, out_file=f"{OUTPUT_DIR}/lgcp_cov_mcmc.nc"),
+    FitJob("Cox-Hawkes_cov (SVI)", build_coxhawkes_cov, "svi", svi_kwargs, out_file=f"{OUTPUT_DIR}/coxhawkes_cov_svi.nc"),
+    FitJob("Cox-Hawkes_cov (MCMC)", build_coxhawkes_cov_mcmc, "mcmc", mcmc_kwargs, out_file=f"{OUTPUT_DIR}/coxhawkes_cov_mcmc.nc"),
+]
+
+# rows of the parallel fits that archived a posterior; the model sections below load those
+# from the job's out_file and only fit the rest
+parallel_fits = {}
+if PARALLEL_FITS:
+    # AICs are streamed into the comparison table as each fit finishes
+    parallel_aic_table = FitScheduler(n_workers=FIT_WORKERS, cpus_per_job=CPUS_PER_FIT,
+                                      cache_dir=FIT_CACHE_DIR,
+                                      log_dir=f"{OUTPUT_DIR}/fit_logs").run(fit_jobs)
+    parallel_aic_table.drop(columns="error", errors="ignore").to_csv(f"{OUTPUT_DIR}/parallel_fits.csv", index=False)
+    print(f"\n=== Parallel fits (Expected AIC) ===\n"
+          f"{parallel_aic_table[['name', 'method', 'aic', 'elapsed_s', 'cached']].round(2).to_string(index=False)}")
+    parallel_fits = {row["name"]: row for _, row in parallel_aic_table.iterrows()
+                     if pd.isna(row.get("error")) and os.path.exists(row["out_file"])}
+
+fit_jobs_by_name = {job.name: job for job in fit_jobs}
+
+
+def fit_svi(model, name, job_name):
+    """SVI fit of the FitJob job_name: loaded from its out_file after a parallel fit, else fitted and saved."""
+    out_file = fit_jobs_by_name[job_name].out_file
+    if job_name in parallel_fits:
+        print(f"Loading {job_name} from {out_file}")
+        load_posterior(model, out_file)
+        return
+    fit_cache.fit(model, name, "svi", **svi_kwargs)
+    save_posterior(model, out_file)
+
+
+def fit_mcmc(model, name, job_name):
+    """
+    MCMC fit of the FitJob job_name, like fit_svi.
+
+    Returns
+    -------
+    pd.Series: min ESS/s (bulk) and max R-hat over the sampled parameters
+    """
+    out_file = fit_jobs_by_name[job_name].out_file
+    if job_name in parallel_fits:
+        print(f"Loading {job_name} from {out_file}")
+        load_posterior(model, out_file)
+        row = parallel_fits[job_name]
+        return pd.Series({"ess_bulk_per_s": row["min_ess_per_s"], "r_hat": row["max_r_hat"]})
+    chains = run_mcmc_chains(model, name, fit_cache, **mcmc_kwargs)
+    save_posterior(model, out_file)
+    return chains[["ess_bulk_per_s", "r_hat"]].agg({"ess_bulk_per_s": "min", "r_hat": "max"})
+
+
+"""# LGCP MODEL"""
+
+spatial_cov.columns
+
+lgcp_cov = build_lgcp_cov()
 
 print("Running LGCP SVI...")
 
-lgcp_cov.run_svi(num_steps=SVI_STEPS, lr=SVI_LR, plot_loss=True)
-lgcp_cov.save_rslts(f"{OUTPUT_DIR}/lgcp_cov_svi.pkl")
+fit_svi(lgcp_cov, "lgcp_cov", "LGCP_cov (SVI)")
 
 print("SVI Completed and saved.")
 
@@ -196,8 +342,9 @@ lgcp_cov.cov_weight_post_summary()
 
 print("Running lgcp_cov MCMC...")
 
-lgcp_cov.run_mcmc(num_warmup=MCMC_WARMUP, num_samples=MCMC_SAMPLES, num_chains=MCMC_CHAINS)
-lgcp_cov.save_rslts(f"{OUTPUT_DIR}/lgcp_cov_mcmc.pkl")
+lgcp_cov = build_lgcp_cov_mcmc()
+
+lgcp_cov_chains = fit_mcmc(lgcp_cov, "lgcp_cov", "LGCP_cov (MCMC)")
 
 print("MCMC Completed and saved.")
 
@@ -211,14 +358,19 @@ lgcp_cov.plot_spatial(include_cov=True)
 
 print("Plotting LGCP Intensity maps...")
 
-time_slices = np.linspace(0, T_max, 5)
+from intensity_surface import posterior_intensity
 
-for t in time_slices:
-    plt.figure(figsize=(10, 6))
-    lgcp_cov.plot_spatial(t)
-    plt.title(f"LGCP_cov Intensity at t={int(t)}")
-    plt.savefig(f"{FIGURE_DIR}/lgcp_cov_mcmc_intensity_t{int(t)}.png")
-    plt.show()
+# posterior intensity for all frames in one batched evaluation; the slices are drawn from the array
+# 100 px per side resolves the 2 km covariate cells
+lgcp_surface = posterior_intensity(lgcp_cov, np.linspace(0, T_max, INTENSITY_FRAMES), resolution=100)
+fig = lgcp_surface.plot(frames=np.linspace(0, INTENSITY_FRAMES - 1, 5).astype(int), events=events_df, event_window=7,
+                        log=True)
+fig.savefig(f"{FIGURE_DIR}/lgcp_cov_mcmc_intensity.png")
+plt.show()
+fig = lgcp_surface.plot(frames=np.linspace(0, INTENSITY_FRAMES - 1, 5).astype(int), stat=0.95, log=True)
+fig.savefig(f"{FIGURE_DIR}/lgcp_cov_mcmc_intensity_q95.png")
+plt.show()
+lgcp_surface.animate(f"{FIGURE_DIR}/lgcp_cov_mcmc_intensity.gif", events=events_df, event_window=7, log=True)
 
 lgcp_cov.cov_weight_post_summary()
 
@@ -228,26 +380,11 @@ lgcp_cov.cov_weight_post_summary()
 
 """
 
-# ---------------------------
-# Define Priors for Cox-Hawkes
-# ---------------------------
-
-coxhawkes_cov_priors = {
-     "a_0": dist.Normal(1, 10),
-    "alpha": dist.Beta(20, 60),
-    "beta": dist.HalfNormal(2.0),
-    "sigmax_2": dist.HalfNormal(0.25)
-}
-
 # ---------------------------
 # Initialize Cox-Hawkes Model
 # ---------------------------
 
-coxhawkes_cov = Hawkes_Model(events_gdf, grid_bounds, T_max,
-                         cox_background=True,
-                         spatial_cov=spatial_cov,
-                         cov_names=covariate_columns,
-                         **coxhawkes_cov_priors)
+coxhawkes_cov = build_coxhawkes_cov()
 
 print("Initialized Cox-Hawkes model.")
 
@@ -257,8 +394,7 @@ print("Initialized Cox-Hawkes model.")
 
 print("Running Cox-Hawkes SVI...")
 
-coxhawkes_cov.run_svi(num_steps=SVI_STEPS, lr=SVI_LR, plot_loss=True)
-coxhawkes_cov.save_rslts(f"{OUTPUT_DIR}/coxhawkes_cov_svi.pkl")
+fit_svi(coxhawkes_cov, "coxhawkes_cov", "Cox-Hawkes_cov (SVI)")
 
 print("SVI Completed and saved.")
 
@@ -282,8 +418,9 @@ coxhawkes_cov.cov_weight_post_summary(trace=True)
 
 print("Running coxhawkes_cov MCMC...")
 
-coxhawkes_cov.run_mcmc(num_warmup=MCMC_WARMUP, num_samples=MCMC_SAMPLES, num_chains=MCMC_CHAINS)
-coxhawkes_cov.save_rslts(f"{OUTPUT_DIR}/coxhawkes_cov_mcmc.pkl")
+coxhawkes_cov = build_coxhawkes_cov_mcmc()
+
+coxhawkes_cov_chains = fit_mcmc(coxhawkes_cov, "coxhawkes_cov", "Cox-Hawkes_cov (MCMC)")
 
 print("MCMC Completed and saved.")
 
@@ -305,16 +442,9 @@ coxhawkes_cov.cov_weight_post_summary(trace=True)
 
 """
 
-priors = {
-    "a_0": dist.Normal(1, 10),
-    "alpha": dist.Beta(20, 60),
-    "beta": dist.HalfNormal(2.0),
-    "sigmax_2": dist.HalfNormal(0.25)
-}
-hawkes = Hawkes_Model(events_df, grid_bounds, T_max, **priors)
+hawkes = build_hawkes_mcmc()
 
-hawkes.run_mcmc(num_warmup=MCMC_WARMUP, num_samples=MCMC_SAMPLES, num_chains=MCMC_CHAINS)
-hawkes.save_rslts(f"{OUTPUT_DIR}/hawkes_mcmc.pkl")
+hawkes_chains = fit_mcmc(hawkes, "hawkes", "Hawkes (MCMC)")
 
 hawkes.expected_AIC()
 
@@ -328,8 +458,9 @@ hawkes.plot_spatial()
 
 hawkes.plot_temporal()
 
-hawkes.run_svi(num_steps=SVI_STEPS, lr=SVI_LR, plot_loss=True)
-hawkes.save_rslts(f"{OUTPUT_DIR}/hawkes_svi.pkl")
+hawkes = build_hawkes()
+
+fit_svi(hawkes, "hawkes", "Hawkes (SVI)")
 
 hawkes.expected_AIC()
 
@@ -341,65 +472,70 @@ hawkes.plot_spatial()
 
 hawkes.plot_temporal()
 
+"""# DAILY INCREMENTAL UPDATE"""
+
+# Yesterday's Cox-Hawkes posterior becomes today's prior and only the new days' events are
+# evaluated, so the refresh costs time proportional to the new data (see incremental_hawkes.py)
+if DAILY_UPDATE:
+    from incremental_hawkes import Incremental_Hawkes_Model
+    last_day = events_df["T"].max()
+    daily_kwargs = dict(cox_background=True, spatial_cov=spatial_cov, cov_names=covariate_columns, **priors)
+    if os.path.exists(DAILY_RSLTS):
+        if Incremental_Hawkes_Model.window_end(DAILY_RSLTS) < last_day:
+            daily = Incremental_Hawkes_Model.from_previous(DAILY_RSLTS, events_df, grid_bounds, T_HORIZON,
+                                                           t_end=last_day, max_lag=DAILY_MAX_LAG,
+                                                           subsample_size=MINIBATCH_SIZE, **daily_kwargs)
+            daily.run_svi(num_steps=DAILY_SVI_STEPS, lr=SVI_LR/10, plot_loss=False)
+            daily.save_rslts(DAILY_RSLTS)
+            print(f"Updated {daily} with {len(daily.data) - daily.args['first_new']} new events")
+        else:
+            print(f"No events after day {last_day}; daily posterior is up to date")
+    else:
+        # first run: fit on the last DAILY_FIRST_WINDOW days on the same fixed horizon, the
+        # starting point for later updates; bounded like them, so its cost does not grow with the table
+        daily = Incremental_Hawkes_Model(events_df, grid_bounds, T_HORIZON,
+                                         t_start=max(last_day - DAILY_FIRST_WINDOW, 0), t_end=last_day,
+                                         max_lag=DAILY_MAX_LAG, subsample_size=MINIBATCH_SIZE, **daily_kwargs)
+        daily.run_svi(num_steps=SVI_STEPS, lr=SVI_LR, plot_loss=False)
+        daily.save_rslts(DAILY_RSLTS)
+
+print("\n=== Model Comparison (Expected AIC, WAIC, PSIS-LOO) ===")
+
+from model_comparison import ComparisonJob, compare_models
+
+# pointwise log-likelihoods are cached per fit, so only new or refitted models are evaluated.
+# The MCMC fits see the MCMC_SUBSET_SIZE subsample, so they are only ranked among themselves.
+if mcmc_events_gdf is events_gdf:
+    comparison_groups = {"all fits": fit_jobs}
+else:
+    comparison_groups = {f"SVI, {len(events_df)} events": [job for job in fit_jobs if job.method == "svi"],
+                         f"MCMC, {len(mcmc_events_df)} events": [job for job in fit_jobs if job.method == "mcmc"]}
+comparison_columns = ["name", "aic", "waic", "p_waic", "looic", "p_loo", "delta_looic", "max_pareto_k", "n_bad_k"]
+for group, jobs in comparison_groups.items():
+    comparison_jobs = [ComparisonJob(job.name, job.build, job.out_file, num_draws=COMPARISON_DRAWS)
+                       for job in jobs]
+    comparison = compare_models(comparison_jobs, cache_dir=POINTWISE_CACHE_DIR, n_workers=FIT_WORKERS,
+                                cpus_per_job=CPUS_PER_FIT, log_dir=f"{OUTPUT_DIR}/comparison_logs",
+                                parallel=PARALLEL_FITS)
+    print(f"\n--- {group} ---")
+    print(comparison[[c for c in comparison_columns if c in comparison.columns]].round(2).to_string(index=False))
+
+    # Best model
+    model_aics = dict(zip(comparison["name"], comparison["aic"]))
+    best_aic = min(model_aics, key=model_aics.get)
+    print(f"\nBest model based on Expected AIC: {best_aic} (AIC = {model_aics[best_aic]:.2f})")
+    best_loo = comparison.iloc[0]
+    print(f"Best model based on PSIS-LOO: {best_loo['name']} (LOOIC = {best_loo['looic']:.2f})")
 
 
-
-
-print("\n=== Loading Results and Calculating Expected AICs ===")
-
-# Hawkes (MCMC)
-hawkes.load_rslts(f"{OUTPUT_DIR}/hawkes_mcmc.pkl")
-hawkes_MCMC_aic = hawkes.expected_AIC()
-print("Expected AIC (Hawkes MCMC):", hawkes_MCMC_aic)
-
-# Hawkes (SVI)
-hawkes.load_rslts(f"{OUTPUT_DIR}/hawkes_svi.pkl")
-hawkes_SVI_aic = hawkes.expected_AIC()
-print("Expected AIC (Hawkes SVI:", hawkes_SVI_aic)
-
-# LGCP_cov (SVI)
-lgcp_cov.load_rslts(f"{OUTPUT_DIR}/lgcp_cov_svi.pkl")
-lgcp_cov_svi_aic = lgcp_cov.expected_AIC()
-print("Expected AIC (LGCP_cov SVI):", lgcp_cov_svi_aic)
-
-# LGCP_cov (MCMC)
-lgcp_cov.load_rslts(f"{OUTPUT_DIR}/lgcp_cov_mcmc.pkl")
-lgcp_cov_mcmc_aic = lgcp_cov.expected_AIC()
-print("Expected AIC (LGCP_cov MCMC):", lgcp_cov_mcmc_aic)
-
-
-# Cox-Hawkes_cov (SVI)
-coxhawkes_cov.load_rslts(f"{OUTPUT_DIR}/coxhawkes_cov_svi.pkl")
-coxhawkes_cov_svi_aic = coxhawkes_cov.expected_AIC()
-print("Expected AIC (Cox-Hawkes_cov SVI):", coxhawkes_cov_svi_aic)
-
-# Cox-Hawkes_cov (MCMC)
-coxhawkes_cov.load_rslts(f"{OUTPUT_DIR}/coxhawkes_cov_mcmc.pkl")
-coxhawkes_cov_mcmc_aic = coxhawkes_cov.expected_AIC()
-print("Expected AIC (Cox-Hawkes_cov MCMC):", coxhawkes_cov_mcmc_aic)
-
 # -------------------------------
-# Comparison + Best Model
+# MCMC throughput (effective samples per second)
 # -------------------------------
 
-print("\n=== Model Comparison (Expected AIC) ===")
-model_aics = {
-    "Hawkes (MCMC)": hawkes_MCMC_aic,
-     "Hawkes (SVI)": hawkes_SVI_aic,
-    "LGCP_cov (SVI)": lgcp_cov_svi_aic,
-    "LGCP_cov (MCMC)": lgcp_cov_mcmc_aic,
-    "Cox-Hawkes_cov (SVI)": coxhawkes_cov_svi_aic,
-    "Cox-Hawkes_cov (MCMC)": coxhawkes_cov_mcmc_aic
-}
-
-# Sort models by AIC
-sorted_aic = sorted(model_aics.items(), key=lambda x: x[1])
-
-# Print nicely
-for model_name, aic in sorted_aic:
-    print(f"{model_name}: Expected AIC = {aic:.2f}")
-
-# Best model
-best_model = sorted_aic[0]
-print(f"\nBest model based on Expected AIC: {best_model[0]} (AIC = {best_model[1]:.2f})")
-
+print(f"\n=== MCMC Diagnostics ({MCMC_CHAINS} chains) ===")
+mcmc_throughput = pd.DataFrame({
+    "Hawkes (MCMC)": hawkes_chains,
+    "LGCP_cov (MCMC)": lgcp_cov_chains,
+    "Cox-Hawkes_cov (MCMC)": coxhawkes_cov_chains,
+}).T.rename(columns={"ess_bulk_per_s": "min ESS/s", "r_hat": "max R-hat"})
+print(mcmc_throughput.round(3))
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of bstpp fit results.
+
+A fit is identified by a hash of everything that determines its output: the X/Y/T
+event data, the spatial domain (grid bounds), T_max, the priors, the covariate
+table, the model type and the inference method and kwargs. Results are stored with
+Point_Process_Model.save_rslts under that hash, so re-running a script only refits
+models whose inputs changed. Entries are evicted least-recently-used first once the
+cache exceeds its size budget.
+
+    cache = FitCache(f"{OUTPUT_DIR}/fit_cache")
+    cache.fit(hawkes, "hawkes", "svi", num_steps=20000, lr=0.001)
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# entries of model.args written by run_svi / run_mcmc rather than by the constructor
+RUNTIME_ARGS = {"num_samples", "num_warmup", "num_chains", "thinning", "batch_size"}
+# fit kwargs that only affect plotting, logging or checkpointing
+IGNORED_KWARGS = {"plot_loss", "checkpoint", "checkpoint_every", "resume_checkpoint"}
+
+
+def _update(h, obj):
+    """Feed a canonical byte representation of obj into the hash h."""
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        h.update(f"{type(obj).__name__}:{obj!r};".encode())
+    elif isinstance(obj, dict):
+        h.update(b"dict{")
+        for k in sorted(obj, key=str):
+            _update(h, k)
+            _update(h, obj[k])
+        h.update(b"}")
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"{type(obj).__name__}[".encode())
+        for v in obj:
+            _update(h, v)
+        h.update(b"]")
+    elif isinstance(obj, pd.DataFrame):
+        geometry = getattr(obj, "_geometry_column_name", None)
+        values = obj.drop(columns=[geometry]) if geometry in obj.columns else obj
+        h.update(b"frame:" + ",".join(map(str, values.columns)).encode())
+        h.update(pd.util.hash_pandas_object(values, index=False).values.tobytes())
+        if geometry in obj.columns:
+            h.update(str(obj.crs).encode())
+            for wkb in obj.geometry.to_wkb():
+                h.update(wkb)
+    elif hasattr(obj, "arg_constraints") and hasattr(obj, "batch_shape"):
+        # numpyro distribution: class and parameter values
+        h.update(f"dist:{type(obj).__name__}(".encode())
+        for name in sorted(obj.arg_constraints):
+            if hasattr(obj, name):
+                _update(h, name)
+                _update(h, np.asarray(getattr(obj, name)))
+        h.update(b")")
+    elif isinstance(obj, type) or callable(obj):
+        h.update(f"callable:{getattr(obj, '__module__', '')}.{getattr(obj, '__qualname__', repr(obj))};".encode())
+    else:
+        arr = np.asarray(obj)
+        if arr.dtype == object:
+            raise TypeError(f"Cannot hash fit input of type {type(obj).__name__}")
+        h.update(f"array:{arr.dtype}:{arr.shape}:".encode())
+        h.update(np.ascontiguousarray(arr).tobytes())
+
+
+def fit_key(model, method, **fit_kwargs):
+    """
+    Hash of the inputs that determine a fit of model.
+
+    Parameters
+    ----------
+    model: Point_Process_Model
+    method: str
+        'svi' or 'mcmc'
+    fit_kwargs: dict
+        keyword arguments passed to run_svi / run_mcmc
+
+    Returns
+    -------
+    str: hex digest
+    """
+    h = hashlib.sha256()
+    _update(h, type(model).__name__)
+    _update(h, method)
+    _update(h, model.data[["X", "Y", "T"]].reset_index(drop=True))
+    _update(h, model.args["A_"])
+    _update(h, model.T)
+    _update(h, model.args["priors"])
+    if "event_weight" in model.args:
+        _update(h, np.asarray(model.args["event_weight"]))
+    if "spatial_cov" in model.args:
+        _update(h, model.cov_names)
+        _update(h, model.spatial_cov[model.cov_names + [model.spatial_cov.geometry.name]])
+    for trig in ("t_trig", "sp_trig"):
+        if trig in model.args:
+            _update(h, type(model.args[trig]))
+    _update(h, {k: v for k, v in model.args.items()
+                if k not in RUNTIME_ARGS and (v is None or isinstance(v, (bool, int, float, str, tuple)))})
+    _update(h, {k: v for k, v in fit_kwargs.items() if k not in IGNORED_KWARGS})
+    return h.hexdigest()
+
+
+class FitCache:
+    def __init__(self, cache_dir, max_bytes=5 * 2**30, max_entries=None):
+        """
+        On-disk cache of fit results with LRU eviction.
+
+        Parameters
+        ----------
+        cache_dir: str
+            Directory holding the cached results. Created if missing.
+        max_bytes: int
+            Total size budget of the cache. Least recently used entries are removed beyond it.
+        max_entries: int or None
+            Optional limit on the number of cached fits.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def load(self, model, key):
+        """
+        Load the cached result for key into model.
+
+        Returns
+        -------
+        bool: True on a cache hit. Unreadable entries are removed and reported as misses.
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return False
+        try:
+            model.load_rslts(path)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, KeyError) as e:
+            warnings.warn(f"Discarding unreadable cache entry {path}: {e!r}")
+            self._remove(key)
+            return False
+        os.utime(path)  # mark as recently used
+        return True
+
+    def store(self, model, key, **meta):
+        """Save model results under key, then evict down to the size budget."""
+        path = self.path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        model.save_rslts(tmp)
+        os.replace(tmp, path)
+        with open(os.path.join(self.cache_dir, f"{key}.json"), "w") as f:
+            json.dump(meta, f, indent=1, default=str)
+        self.evict()
+
+    def fit(self, model, name, method, **fit_kwargs):
+        """
+        Load model results from the cache, or run the fit and cache it.
+
+        Parameters
+        ----------
+        model: Point_Process_Model
+        name: str
+            Label used in log messages and stored with the entry.
+        method: str
+            'svi' or 'mcmc'
+        fit_kwargs: dict
+            keyword arguments for run_svi / run_mcmc
+
+        Returns
+        -------
+        bool: True if the result was loaded from the cache.
+        """
+        if method not in ("svi", "mcmc"):
+            raise ValueError(f"Unknown inference method {method!r}. Use 'svi' or 'mcmc'.")
+        key = fit_key(model, method, **fit_kwargs)
+        if self.load(model, key):
+            print(f"[LOADED] {name} ({method}) from cache {key[:12]}")
+            return True
+
+        from compile_cache import CompileTimer
+        from fit_checkpoint import remove_checkpoint
+        from fit_telemetry import record_fit
+        if fit_kwargs.get("checkpoint_every") and fit_kwargs.get("checkpoint") is None:
+            fit_kwargs["checkpoint"] = os.path.join(self.cache_dir, f"{key}.ckpt")
+        print(f"[RUNNING] {method.upper()} for {name}")
+        with CompileTimer(f"{name} ({method})") as timer, record_fit(model, name, method, fit_kwargs, key=key[:12]):
+            if method == "svi":
+                model.run_svi(**fit_kwargs)
+            else:
+                model.run_mcmc(**fit_kwargs)
+        print(f"[DONE] {name} ({method}) took {timer.wall_s:.2f} seconds")
+
+        self.store(model, key, name=name, method=method, description=str(model),
+                   fit_kwargs=fit_kwargs, elapsed_s=timer.wall_s, created=time.time(),
+                   svi_convergence=getattr(model, "svi_convergence", None), **timer.as_dict())
+        remove_checkpoint(fit_kwargs.get("checkpoint"))
+        return False
+
+    def meta(self, model, method, **fit_kwargs):
+        """Metadata stored with a cached fit (name, kwargs, elapsed_s, ...), or {} if not cached."""
+        path = os.path.join(self.cache_dir, f"{fit_key(model, method, **fit_kwargs)}.json")
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def entries(self):
+        """List of (key, size in bytes, last used time), most recently used first."""
+        out = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith(".pkl"):
+                st = os.stat(os.path.join(self.cache_dir, fname))
+                out.append((fname[:-4], st.st_size, st.st_mtime))
+        return sorted(out, key=lambda e: e[2], reverse=True)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits its budget."""
+        total = 0
+        for i, (key, size, _) in enumerate(self.entries()):
+            total += size
+            if i == 0:
+                continue  # never evict the entry that was just used
+            if total > self.max_bytes or (self.max_entries is not None and i >= self.max_entries):
+                self._remove(key)
+                total -= size
+
+    def _remove(self, key):
+        for path in (self.path(key), os.path.join(self.cache_dir, f"{key}.json")):
+            if os.path.exists(path):
+                os.remove(path)
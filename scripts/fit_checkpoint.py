@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Mid-run checkpoints for long SVI and MCMC fits, so a preempted run continues where it stopped.
+
+The minibatched models of scalable_models.py accept three extra fit kwargs:
+
+- checkpoint: file the run state is written to (None disables checkpointing)
+- checkpoint_every: SVI steps or MCMC iterations between checkpoints
+- resume_checkpoint: continue from an existing checkpoint (default) or start over
+
+SVI checkpoints hold the optimizer state with its step count, the losses so far, the current
+learning rate and the early-stopping monitor. MCMC runs in chunks of checkpoint_every
+iterations, continuing each chunk from the last sampler state (numpyro's documented
+post_warmup_state pattern), and its checkpoints hold the sampler state, including the
+step-size and mass-matrix adaptation state, and the draws collected so far. Each chunk continues
+the same Markov chain with the same PRNG keys, so a resumed fit is bit-identical to an
+uninterrupted one. A checkpoint is only used by a run with the same fit_key (data, priors,
+model and settings); otherwise it is ignored with a warning and overwritten.
+
+FitCache.fit derives the checkpoint path from the fit key when checkpoint_every is given and
+removes the checkpoint once the result is cached. None of the three kwargs is part of the key
+(fit_cache.IGNORED_KWARGS).
+
+    fit_cache.fit(coxhawkes_cov, "coxhawkes_cov", "mcmc", num_warmup=100, num_samples=400,
+                  checkpoint_every=50)
+    # after a preemption, the same call resumes from the last 50-iteration chunk
+"""
+
+import os
+import pickle
+import warnings
+
+import numpy as np
+
+
+def save_checkpoint(path, fingerprint, **payload):
+    """Atomically write payload (device arrays copied to host) with the fit fingerprint to path."""
+    import jax
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump({"fingerprint": fingerprint, **jax.device_get(payload)}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path, fingerprint):
+    """
+    Payload of the checkpoint at path, if it exists and was written by the same fit.
+
+    Returns
+    -------
+    dict or None
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            ckpt = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+        warnings.warn(f"Ignoring unreadable checkpoint {path}: {e!r}")
+        return None
+    if ckpt.pop("fingerprint", None) != fingerprint:
+        warnings.warn(f"Ignoring checkpoint {path}: it was written by a fit with other inputs or settings")
+        return None
+    return ckpt
+
+
+def remove_checkpoint(path):
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
+
+def run_mcmc_checkpointed(mcmc, rng_key, args, path, fingerprint, every, resume=True, extra_fields=(),
+                          telemetry=None):
+    """
+    mcmc.warmup(rng_key, args) followed by mcmc.run, in chunks of `every` iterations with a
+    checkpoint after each chunk.
+
+    Parameters
+    ----------
+    mcmc: numpyro.infer.MCMC
+        Freshly constructed sampler; num_samples is restored after the run.
+    rng_key: PRNGKey
+    args: dict
+        Model arguments.
+    path: str
+        Checkpoint file.
+    fingerprint: str
+        Identity of the fit (fit_key); checkpoints of other fits are ignored.
+    every: int
+        Iterations per chunk, rounded up to a multiple of mcmc.thinning.
+    resume: bool
+        Continue from an existing checkpoint of the same fit.
+    extra_fields: tuple
+        Additional sampler state fields to collect, as in MCMC.run.
+    telemetry: FitTelemetry or None
+        Receives the warmup and sampling phases; requires 'num_steps' in extra_fields.
+
+    Returns
+    -------
+    int: iterations restored from the checkpoint
+    """
+    import jax
+    num_warmup, num_samples, thinning = mcmc.num_warmup, mcmc.num_samples, mcmc.thinning
+    every = -(-every // thinning) * thinning
+    ckpt = load_checkpoint(path, fingerprint) if resume else None
+    if ckpt is not None:
+        done, state, draws, warmup_steps = ckpt["done"], ckpt["state"], ckpt["draws"], ckpt["warmup_num_steps"]
+        print(f"[RESUMED] MCMC from {path} at iteration {done} of {num_warmup + num_samples}")
+    else:
+        done, state, draws, warmup_steps = 0, None, [], []
+    restored, restored_warmup, restored_chunks = done, len(warmup_steps), len(draws)
+
+    try:
+        while done < num_warmup + num_samples:
+            n = min(every, num_warmup - done) if done < num_warmup else min(every, num_warmup + num_samples - done)
+            if state is None:
+                # as mcmc.warmup, but stopping after n iterations: the sampler is initialized
+                # for the full num_warmup adaptation schedule
+                mcmc._set_collection_params(0, n, n, "warmup")
+                mcmc.run(rng_key, args, extra_fields=extra_fields)
+            else:
+                mcmc.num_samples = n
+                mcmc.post_warmup_state = state
+                mcmc.run(state.rng_key, args, extra_fields=extra_fields)
+            state = jax.device_get(mcmc.last_state)
+            chunk = jax.device_get(mcmc._states)
+            if done < num_warmup:
+                warmup_steps.append(chunk.get("num_steps"))
+            else:
+                draws.append(chunk)
+            done += n
+            if telemetry is not None and done == num_warmup and done > restored:
+                telemetry.mcmc_phase("warmup", np.concatenate(warmup_steps[restored_warmup:], axis=1))
+            save_checkpoint(path, fingerprint, done=done, state=state, draws=draws, warmup_num_steps=warmup_steps)
+    finally:
+        mcmc.num_samples = num_samples
+
+    # the draws of all sampling chunks, as if collected by a single mcmc.run
+    states = jax.tree_util.tree_map(lambda *x: np.concatenate(x, axis=1), *draws)
+    mcmc._states = states
+    mcmc._states_flat = jax.tree_util.tree_map(lambda x: x.reshape((-1,) + x.shape[2:]), states)
+    mcmc._last_state = state
+    if telemetry is not None:
+        telemetry.mcmc_phase("sampling", np.concatenate([d["num_steps"] for d in draws[restored_chunks:]], axis=1))
+    return restored
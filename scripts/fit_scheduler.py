@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Run independent model fits concurrently, one worker process per fit.
+
+Each FitJob is pickled and handed to a fresh Python process that pins itself to its
+own block of CPU cores before JAX is imported, builds the model, runs SVI or MCMC
+(through a FitCache when a cache directory is given), saves the results and reports
+the expected AIC, plus R-hat and ESS per second for MCMC fits. MCMC workers get one
+XLA CPU device per chain so the chains run in parallel. Results are streamed into the
+comparison table as soon as each job finishes, so the total wall time approaches that
+of the slowest single fit.
+
+Any picklable job with a name, a num_devices attribute and a run(cache_dir) method
+returning a result row can be scheduled the same way; model_comparison.py uses this
+for its pointwise log-likelihood jobs.
+
+Workers are started with ``python fit_scheduler.py --worker`` rather than through
+multiprocessing, so the analysis scripts do not need an ``if __name__ == "__main__"``
+guard. Each worker's output goes to ``<log_dir>/<job name>.log``.
+
+    jobs = [FitJob("Hawkes (SVI)", partial(Hawkes_Model, events_df, grid_bounds, T_max, **priors),
+                   "svi", dict(num_steps=15000, lr=0.02), out_file="hawkes_svi.nc"), ...]
+    table = FitScheduler(n_workers=6).run(jobs)
+"""
+
+import os
+import pickle
+import queue
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+
+class FitJob:
+    def __init__(self, name, build, method, fit_kwargs, out_file=None):
+        """
+        One model/method combination to fit.
+
+        Parameters
+        ----------
+        name: str
+            Label in the comparison table, e.g. "LGCP_cov (SVI)".
+        build: callable
+            Picklable zero-argument callable returning the model, e.g. a functools.partial
+            of a model class. Called inside the worker process.
+        method: str
+            'svi' or 'mcmc'
+        fit_kwargs: dict
+            keyword arguments for run_svi / run_mcmc
+        out_file: str or None
+            Where to save the fitted model: a posterior archive for '.nc' / '.zarr' names
+            (posterior_store.py), a save_rslts pickle otherwise.
+        """
+        if method not in ("svi", "mcmc"):
+            raise ValueError(f"Unknown inference method {method!r}. Use 'svi' or 'mcmc'.")
+        self.name = name
+        self.build = build
+        self.method = method
+        self.fit_kwargs = fit_kwargs
+        self.out_file = out_file
+
+    @property
+    def num_devices(self):
+        """XLA CPU devices the worker needs: one per MCMC chain."""
+        return self.fit_kwargs.get("num_chains", 1) if self.method == "mcmc" else 1
+
+    def run(self, cache_dir=None):
+        """Fit the job in the current process, see run_job."""
+        return run_job(self, cache_dir)
+
+
+def pin_process(cpus, num_devices=1):
+    """
+    Restrict this process, and the numeric libraries it has not loaded yet, to the given cores.
+    Must run before JAX is imported for the XLA thread pool size to take effect.
+    num_devices > 1 exposes that many CPU devices to JAX so MCMC chains run in parallel.
+    """
+    n = len(cpus)
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[var] = str(n)
+    # XLA's CPU thread pools follow the affinity mask set above
+    xla_flags = [os.environ.get("XLA_FLAGS", ""), f"--xla_cpu_multi_thread_eigen={'true' if n > 1 else 'false'}"]
+    if num_devices > 1:
+        xla_flags.append(f"--xla_force_host_platform_device_count={num_devices}")
+    os.environ["XLA_FLAGS"] = " ".join(xla_flags).strip()
+    os.environ["MPLBACKEND"] = "Agg"
+
+
+def run_job(job, cache_dir=None):
+    """Fit one job in the current process and return its result row."""
+    start = time.time()
+    result = {"name": job.name, "method": job.method, "cached": False, "out_file": job.out_file}
+    try:
+        from compile_cache import CompileTimer
+        from fit_telemetry import record_fit
+        model = job.build()
+        fit_start = time.time()
+        # FitCache.fit logs its own compile/execute split and telemetry
+        with CompileTimer(f"{job.name} ({job.method})", verbose=cache_dir is None) as timer:
+            if cache_dir is not None:
+                from fit_cache import FitCache
+                result["cached"] = FitCache(cache_dir).fit(model, job.name, job.method, **job.fit_kwargs)
+            else:
+                with record_fit(model, job.name, job.method, job.fit_kwargs):
+                    if job.method == "svi":
+                        model.run_svi(**job.fit_kwargs)
+                    else:
+                        model.run_mcmc(**job.fit_kwargs)
+        result["compile_s"] = timer.compile_s
+        convergence = (FitCache(cache_dir).meta(model, job.method, **job.fit_kwargs).get("svi_convergence")
+                       if result["cached"] else getattr(model, "svi_convergence", None))
+        if convergence:
+            result["steps_saved"] = convergence["steps_saved"]
+            result["seconds_saved"] = convergence["seconds_saved"]
+        if job.out_file is not None:
+            from posterior_store import save_results
+            save_results(model, job.out_file)
+        result["aic"] = model.expected_AIC()
+        if job.method == "mcmc":
+            from mcmc_chains import chain_diagnostics
+            fit_s = time.time() - fit_start
+            if result["cached"]:
+                fit_s = FitCache(cache_dir).meta(model, job.method, **job.fit_kwargs).get("elapsed_s", fit_s)
+            diagnostics = chain_diagnostics(model, fit_s)
+            result["min_ess_per_s"] = diagnostics["ess_bulk_per_s"].min()
+            result["max_r_hat"] = diagnostics["r_hat"].max()
+    except Exception:
+        result["aic"] = float("nan")
+        result["error"] = traceback.format_exc()
+    result["elapsed_s"] = time.time() - start
+    return result
+
+
+def _worker_main(job_file, result_file, cpus, num_devices, cache_dir):
+    pin_process(cpus, num_devices)
+    # the job is unpickled only after pinning: unpickling imports bstpp and JAX
+    with open(job_file, "rb") as f:
+        job = pickle.load(f)
+    result = job.run(cache_dir)
+    with open(result_file, "wb") as f:
+        pickle.dump(result, f)
+
+
+class FitScheduler:
+    def __init__(self, n_workers=None, cpus_per_job=None, cache_dir=None, log_dir=None):
+        """
+        Concurrent runner for FitJobs.
+
+        Parameters
+        ----------
+        n_workers: int or None
+            Number of concurrent fits. Defaults to one per job, capped by the CPU count.
+        cpus_per_job: int or None
+            Cores pinned to each running job. Defaults to an even split of the available cores.
+        cache_dir: str or None
+            FitCache directory shared by the workers.
+        log_dir: str or None
+            Directory for the per-job worker logs. Defaults to a temporary directory.
+        """
+        self.n_workers = n_workers
+        self.cpus_per_job = cpus_per_job
+        self.cache_dir = cache_dir
+        self.log_dir = log_dir
+
+    def _core_groups(self, n_workers):
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+        per_job = self.cpus_per_job or max(1, len(cpus) // n_workers)
+        groups = [cpus[i*per_job:(i+1)*per_job] for i in range(n_workers)]
+        # more workers than cores: let the extra groups share the machine
+        return [g if g else cpus for g in groups]
+
+    def _launch(self, i, job, core_groups, work_dir):
+        cpus = core_groups.get()
+        try:
+            tag = f"{i:02d}_" + re.sub(r"[^A-Za-z0-9_.-]+", "_", job.name).strip("_")
+            job_file = os.path.join(work_dir, f"{tag}.job.pkl")
+            result_file = os.path.join(work_dir, f"{tag}.result.pkl")
+            with open(job_file, "wb") as f:
+                pickle.dump(job, f)
+            cmd = [sys.executable, os.path.abspath(__file__), "--worker", job_file, result_file,
+                   ",".join(map(str, cpus)), str(job.num_devices), self.cache_dir or ""]
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+            start = time.time()
+            with open(os.path.join(self.log_dir or work_dir, f"{tag}.log"), "w") as log:
+                proc = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+            if proc.returncode != 0 or not os.path.exists(result_file):
+                return {"name": job.name, "method": getattr(job, "method", None), "cached": False,
+                        "out_file": getattr(job, "out_file", None),
+                        "aic": float("nan"), "elapsed_s": time.time() - start,
+                        "error": f"worker exited with code {proc.returncode}, see {log.name}"}
+            with open(result_file, "rb") as f:
+                result = pickle.load(f)
+            result["cpus"] = len(cpus)
+            return result
+        finally:
+            core_groups.put(cpus)
+
+    def run(self, jobs, on_result=None):
+        """
+        Fit all jobs and return the comparison table sorted by expected AIC.
+
+        Parameters
+        ----------
+        jobs: list of FitJob (or other jobs with name, num_devices and run)
+        on_result: callable or None
+            Called with (result dict, current table) after each job finishes.
+            Defaults to printing the table.
+
+        Returns
+        -------
+        pd.DataFrame
+        """
+        n_workers = self.n_workers or min(len(jobs), os.cpu_count())
+        on_result = on_result or _print_table
+        core_groups = queue.Queue()
+        for group in self._core_groups(n_workers):
+            core_groups.put(group)
+        if self.log_dir is not None:
+            os.makedirs(self.log_dir, exist_ok=True)
+
+        rows = []
+        start = time.time()
+        with tempfile.TemporaryDirectory() as work_dir, ThreadPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(self._launch, i, job, core_groups, work_dir)
+                       for i, job in enumerate(jobs)]
+            for future in as_completed(futures):
+                result = future.result()
+                rows.append(result)
+                on_result(result, _table(rows))
+        print(f"\nAll {len(jobs)} jobs finished in {time.time() - start:.1f}s "
+              f"(sum of fit times {sum(r['elapsed_s'] for r in rows):.1f}s)")
+        return _table(rows)
+
+
+def _table(rows):
+    return pd.DataFrame(rows).sort_values("aic", na_position="last").reset_index(drop=True)
+
+
+def _print_table(result, table):
+    status = "FAILED" if "error" in result else f"AIC = {result['aic']:.2f}"
+    print(f"\n[FINISHED] {result['name']} in {result['elapsed_s']:.1f}s: {status}")
+    if "error" in result:
+        print(result["error"])
+    columns = ["name", "aic", "elapsed_s", "compile_s", "steps_saved", "seconds_saved", "cached", "min_ess_per_s", "max_r_hat"]
+    print(table[[c for c in columns if c in table.columns]].to_string(index=False))
+
+
+if __name__ == "__main__" and len(sys.argv) == 7 and sys.argv[1] == "--worker":
+    _worker_main(sys.argv[2], sys.argv[3], [int(c) for c in sys.argv[4].split(",")], int(sys.argv[5]),
+                 sys.argv[6] or None)
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+Structured per-fit performance telemetry for bstpp SVI and MCMC runs.
+
+Each fit appends JSON lines to one telemetry file, all tagged with the same fit_id:
+
+- "steps": every log_every SVI steps, the step rate and mean / max step time of that
+  interval and its mean loss (minibatched models of scalable_models.py only)
+- "phase": wall, compile and execute time of each phase of a fit (SVI optimization and
+  posterior sampling; MCMC warmup and sampling with their leapfrog step counts)
+- "fit": one summary per fit with steps/s, seconds per ELBO evaluation, ELBO and gradient
+  evaluation counts, MCMC leapfrog steps per second, compile vs execute time and peak
+  host memory, next to the inputs that drive them (number of events, GP and covariate
+  grid sizes, minibatch size, priors, fit kwargs)
+
+Comparing "fit" records across runs shows regressions after changing the covariate grid
+resolution, the subset size or the priors. Plain bstpp models only get the summary, with
+rates averaged over the whole fit.
+
+Telemetry is off until enable_telemetry is called. The path is exported through the
+environment, so FitScheduler and model-comparison workers write to the same file.
+FitCache.fit, the FitScheduler workers and run_mcmc_chains record every fit they run.
+
+    enable_telemetry(f"{OUTPUT_DIR}/fit_telemetry.jsonl")
+    fit_cache.fit(lgcp_cov, "lgcp_cov", "svi", num_steps=15000, lr=0.02)
+
+    python fit_telemetry.py ../results/london/fit_telemetry.jsonl
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import time
+import uuid
+
+import numpy as np
+
+TELEMETRY_ENV = "BSTPP_FIT_TELEMETRY"
+
+# innermost last; the instrumented loops of scalable_models.py report to active()
+_ACTIVE = []
+
+SUMMARY_COLUMNS = ["label", "method", "n_events", "n_cells", "subsample_size", "steps", "steps_per_s",
+                   "ms_per_elbo", "leapfrog_per_s", "mean_tree_size", "compile_s", "execute_s", "peak_rss_mb"]
+
+
+def enable_telemetry(path):
+    """
+    Append fit telemetry to the JSONL file path, in this process and in workers started later.
+
+    Parameters
+    ----------
+    path: str
+        Telemetry file. Its directory is created if missing.
+    """
+    path = os.path.abspath(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.environ[TELEMETRY_ENV] = path
+
+
+def telemetry_path():
+    """Telemetry file set by enable_telemetry, or None when telemetry is off."""
+    return os.environ.get(TELEMETRY_ENV) or None
+
+
+def active():
+    """The innermost running FitTelemetry, or None."""
+    return _ACTIVE[-1] if _ACTIVE else None
+
+
+def _reset_peak_rss():
+    """Reset the kernel's peak RSS of this process (Linux >= 4.0); False where unsupported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if platform.system() == "Darwin" else peak / 1024
+
+
+def _describe_prior(d):
+    params = []
+    for name in sorted(getattr(d, "arg_constraints", {})):
+        value = np.asarray(getattr(d, name, np.nan))
+        params.append(f"{name}={value.item():g}" if value.size == 1 else f"{name}=<{value.shape}>")
+    return f"{type(d).__name__}({', '.join(params)})"
+
+
+def describe_model(model):
+    """
+    Problem size and priors of a bstpp model, the inputs that fit performance depends on.
+
+    Returns
+    -------
+    dict: model class, n_events, GP grid sizes (n_t, n_xy), covariate cells and features,
+    minibatch size and a readable form of each prior.
+    """
+    args = model.args
+    out = {"model": type(model).__name__, "n_events": len(model.data),
+           "n_t": args.get("n_t"), "n_xy": args.get("n_xy"),
+           "subsample_size": args.get("subsample_size"),
+           "priors": {k: _describe_prior(v) for k, v in args.get("priors", {}).items()}}
+    if "spatial_cov" in args:
+        out["n_cells"] = int(np.shape(args["spatial_cov"])[0])
+        out["n_covariates"] = len(model.cov_names)
+    return out
+
+
+class FitTelemetry:
+    def __init__(self, path, label, method, model=None, log_every=100, **context):
+        """
+        Context manager recording the performance of one fit as JSON lines.
+
+        Parameters
+        ----------
+        path: str
+            JSONL file the records are appended to.
+        label: str
+            Name of the fit.
+        method: str
+            'svi' or 'mcmc'
+        model: Point_Process_Model or None
+            Fitted model; its problem size and priors are added to the summary (see describe_model).
+        log_every: int
+            SVI steps per "steps" record.
+        context: dict
+            Further fields of the summary record, e.g. fit_kwargs.
+        """
+        from compile_cache import CompileTimer
+        self.path = path
+        self.label = label
+        self.method = method
+        self.log_every = log_every
+        self.context = dict(describe_model(model), **context) if model is not None else context
+        if method == "mcmc" and "subsample_size" in self.context:
+            self.context["subsample_size"] = None  # NUTS always runs on the exact likelihood
+        self.fit_id = uuid.uuid4().hex[:12]
+        self.timer = CompileTimer(f"{label} ({method})", verbose=False)
+        self.fields = {}
+        self.phases = {}
+        self.steps = 0
+        self.loop_s = 0.
+        self.summary = None
+
+    def write(self, event, **record):
+        """Append one record; a single write per line, so concurrent workers do not interleave."""
+        line = json.dumps({"event": event, "fit_id": self.fit_id, "label": self.label, "method": self.method,
+                           "time": time.time(), **record}, default=str)
+        with open(self.path, "a") as f:
+            f.write(line + "\n")
+
+    def __enter__(self):
+        self.timer.__enter__()
+        self._peak_reset = _reset_peak_rss()
+        self.mark()
+        _ACTIVE.append(self)
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        _ACTIVE.remove(self)
+        self.timer.__exit__(exc_type, *exc)
+        self.summary = self._summarize(failed=exc_type is not None)
+        self.write("fit", **self.summary)
+
+    def mark(self):
+        """Start timing the next phase or step loop here."""
+        self._mark = (time.perf_counter(), self.timer.compile_s)
+        self._last_step = self._mark[0]
+        self._interval = []
+        self._losses = []
+
+    def svi_step(self, loss):
+        """
+        Record one SVI step that has just finished; loss must be ready (block_until_ready).
+
+        The first step after mark() includes the compilation of the step and is left out
+        of the step rates.
+        """
+        now = time.perf_counter()
+        step_s, self._last_step = now - self._last_step, now
+        self.steps += 1
+        if self.steps == 1:
+            self.fields["first_step_s"] = step_s
+            return
+        self.loop_s += step_s
+        self._interval.append(step_s)
+        self._losses.append(float(loss))
+        if len(self._interval) == self.log_every:
+            interval = np.asarray(self._interval)
+            self.write("steps", step=self.steps, steps_per_s=len(interval) / interval.sum(),
+                       mean_step_ms=1e3 * interval.mean(), max_step_ms=1e3 * interval.max(),
+                       loss=float(np.nanmean(self._losses)))
+            self._interval, self._losses = [], []
+
+    def phase(self, name, **fields):
+        """
+        Record the phase that ran since the last mark() / phase() and start timing the next one.
+
+        Returns
+        -------
+        dict: the phase record (seconds, compile_s, execute_s and fields)
+        """
+        start, compile_start = self._mark
+        seconds = time.perf_counter() - start
+        compile_s = self.timer.compile_s - compile_start
+        record = {"phase": name, "seconds": seconds, "compile_s": compile_s,
+                  "execute_s": max(seconds - compile_s, 0.), **fields}
+        self.write("phase", **record)
+        self.phases[name] = record
+        self.mark()
+        return record
+
+    def mcmc_phase(self, name, num_steps):
+        """
+        Record an MCMC phase from the per-iteration tree sizes of numpyro's 'num_steps' extra field.
+
+        Each leapfrog step evaluates the gradient of the log density once.
+        """
+        num_steps = np.asarray(num_steps)
+        leapfrog = int(num_steps.sum())
+        start, compile_start = self._mark
+        execute_s = max(time.perf_counter() - start - (self.timer.compile_s - compile_start), 1e-9)
+        return self.phase(name, iterations=int(num_steps.size), leapfrog_steps=leapfrog,
+                          leapfrog_per_s=leapfrog / execute_s, mean_tree_size=leapfrog / max(num_steps.size, 1))
+
+    def update(self, **fields):
+        """Add fields to the summary record (e.g. num_particles of the ELBO)."""
+        self.fields.update(fields)
+
+    def _summarize(self, failed):
+        timer = self.timer
+        out = {"failed": failed, "wall_s": timer.wall_s, **timer.as_dict(), "peak_rss_mb": _peak_rss_mb(),
+               "peak_rss_scope": "fit" if self._peak_reset else "process", "pid": os.getpid(),
+               "hostname": platform.node()}
+        fit_kwargs = self.context.get("fit_kwargs", {})
+        if self.method == "svi":
+            num_particles = self.fields.get("num_particles", 1)
+            if self.steps > 1:
+                # per-step timings of the instrumented loop, first (compiling) step excluded
+                steps, loop_s, rate_source = self.steps, self.loop_s, "steps"
+                timed_steps = self.steps - 1
+            else:
+                steps = fit_kwargs.get("num_steps", 0)
+                loop_s, rate_source, timed_steps = timer.execute_s, "fit", steps
+            rate = timed_steps / loop_s if loop_s > 0 else float("nan")
+            out.update(steps=steps, steps_per_s=rate, ms_per_step=1e3 / rate,
+                       elbo_evals=steps * num_particles, grad_evals=steps * num_particles,
+                       ms_per_elbo=1e3 / (rate * num_particles), rate_source=rate_source)
+        elif "sampling" in self.phases:
+            phases = [self.phases[p] for p in ("warmup", "sampling") if p in self.phases]
+            leapfrog = sum(p["leapfrog_steps"] for p in phases)
+            iterations = sum(p["iterations"] for p in phases)
+            execute_s = sum(p["execute_s"] for p in phases)
+            out.update(steps=iterations, steps_per_s=iterations / execute_s if execute_s > 0 else float("nan"),
+                       leapfrog_steps=leapfrog, grad_evals=leapfrog,
+                       leapfrog_per_s=leapfrog / execute_s if execute_s > 0 else float("nan"),
+                       mean_tree_size=leapfrog / max(iterations, 1),
+                       sampling_leapfrog_per_s=self.phases["sampling"]["leapfrog_per_s"], rate_source="steps")
+        else:
+            chains = fit_kwargs.get("num_chains", 1)
+            steps = chains * (fit_kwargs.get("num_warmup", 500) + fit_kwargs.get("num_samples", 1000))
+            out.update(steps=steps, steps_per_s=steps / timer.execute_s if timer.execute_s > 0 else float("nan"),
+                       rate_source="fit")
+        out.update(self.fields)
+        out.update(self.context)
+        return out
+
+
+def record_fit(model, label, method, fit_kwargs, **context):
+    """
+    FitTelemetry for a fit of model if telemetry is enabled, otherwise a no-op context.
+
+    Parameters
+    ----------
+    model: Point_Process_Model
+    label: str
+    method: str
+        'svi' or 'mcmc'
+    fit_kwargs: dict
+        keyword arguments of run_svi / run_mcmc, stored in the summary
+    """
+    path = telemetry_path()
+    if path is None:
+        return contextlib.nullcontext()
+    return FitTelemetry(path, label, method, model=model, fit_kwargs=fit_kwargs, **context)
+
+
+def load_telemetry(path, event="fit"):
+    """
+    Records of one event type ("fit", "phase" or "steps") from a telemetry file.
+
+    Returns
+    -------
+    pd.DataFrame: one row per record, nested fields (priors, fit_kwargs) flattened with '.'
+    """
+    import pandas as pd
+    with open(path) as f:
+        records = [r for r in map(json.loads, filter(str.strip, f)) if r["event"] == event]
+    return pd.json_normalize(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the fit records of a telemetry file.")
+    parser.add_argument("path", help="JSONL file written by FitTelemetry")
+    parser.add_argument("--label", help="only fits with this label")
+    parser.add_argument("--last", type=int, default=20, help="most recent fits shown")
+    opts = parser.parse_args()
+
+    import pandas as pd
+    fits = load_telemetry(opts.path)
+    if opts.label:
+        fits = fits[fits["label"] == opts.label]
+    fits = fits.sort_values("time").tail(opts.last)
+    fits.insert(0, "when", pd.to_datetime(fits["time"], unit="s").dt.strftime("%Y-%m-%d %H:%M"))
+    columns = ["when"] + [c for c in SUMMARY_COLUMNS if c in fits.columns]
+    print(fits[columns].round(3).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+"""
+Posterior predictive forecasts of event counts per grid cell and day.
+
+simulate_forecast draws thousands of future event sets from a fitted LGCP, Hawkes or
+Cox-Hawkes model, one per posterior draw, and returns their counts on the computational
+grid for each day of the horizon. The Hawkes models are simulated through their branching
+structure rather than by thinning, vectorized over the posterior draws, so a generation of
+events of every draw is a handful of NumPy calls:
+
+- background events: Poisson counts per (draw, day, background piece) with mean
+  exp(a_0 + f_t + f_xy + X w) * area * day length, placed uniformly in the piece (its
+  bounding box) and the day. The pieces are the ones bstpp integrates the background over:
+  the covariate / grid cell intersections (int_df), the covariate cells (Hawkes with
+  covariates) or the domain cells of the computational grid.
+- offspring: each event has Poisson(alpha) children, delayed by Exponential(beta) and
+  displaced by N(0, sigmax_2 I) (bstpp's exponential / Gaussian triggers). The observed
+  events in the lag window before the start still excite the horizon: an event at t_j
+  leaves Poisson(w_j alpha exp(-(t0 - t_j)/beta)) children after t0, by memorylessness at
+  t0 + Exponential(beta). Generations are simulated until none is left in the horizon.
+
+Children outside the unit square or after the horizon are dropped, as the truncated
+excitation integral of the likelihood assumes. The temporal GP f_t is only defined on
+[0, T]; after T the last temporal bin carries on.
+
+The draws are cut into chunks of CHUNK_DRAWS with their own seeds, so the result does not
+depend on n_workers. Chunks are simulated in ``python forecast.py --worker`` processes, like
+the FitScheduler workers, so calling scripts need no ``if __name__ == "__main__"`` guard;
+the workers only import NumPy.
+
+    fc = simulate_forecast(coxhawkes, horizon=28, num_draws=1000, n_workers=8)
+    fc.quantiles()      # per (day, comp_grid_id): mean and forecast quantiles
+    fc.daily_totals()
+    fc.plot_daily_totals(observed=events_df)
+    fc.plot_cells(days=range(7))
+
+Timing of 1,000 draws x 28 days of London, after a short Cox-Hawkes fit:
+
+    python forecast.py --dataset london --model coxhawkes --draws 1000 --horizon 28 --workers 8
+"""
+
+import argparse
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+# posterior draws per unit of work, each with its own random stream
+CHUNK_DRAWS = 25
+# neglected kernel mass of the observed events left out of the history window
+HISTORY_TOL = 1e-6
+
+
+class Forecast:
+    def __init__(self, counts, days, comp_grid, domain_cells):
+        """
+        Simulated event counts of a posterior predictive forecast.
+
+        Parameters
+        ----------
+        counts: np.ndarray [draws, days, n_xy**2]
+            Events per posterior draw, day and computational grid cell (comp_grid_id).
+        days: np.ndarray [days]
+            Start of each day in the units of data['T'].
+        comp_grid: GeoDataFrame
+            Computational grid of the model.
+        domain_cells: np.ndarray
+            comp_grid_id of the cells in the domain.
+        """
+        self.counts = counts
+        self.days = days
+        self.comp_grid = comp_grid
+        self.domain_cells = domain_cells
+
+    def __len__(self):
+        return len(self.counts)
+
+    def quantiles(self, q=QUANTILES):
+        """
+        Forecast mean and quantiles per day and domain cell.
+
+        Returns
+        -------
+        pd.DataFrame with columns day, comp_grid_id, mean and one 'q<level>' column per level
+        """
+        counts = self.counts[:, :, self.domain_cells]
+        stats = {'mean': counts.mean(axis=0).ravel()}
+        for level, values in zip(q, np.quantile(counts, q, axis=0)):
+            stats[f"q{level:g}"] = values.ravel()
+        day, cell = np.meshgrid(self.days, self.domain_cells, indexing='ij')
+        return pd.DataFrame({'day': day.ravel(), 'comp_grid_id': cell.ravel(), **stats})
+
+    def daily_totals(self, q=QUANTILES):
+        """Forecast mean and quantiles of the number of events per day over the whole domain."""
+        totals = self.counts.sum(axis=2)
+        stats = {'mean': totals.mean(axis=0)}
+        for level, values in zip(q, np.quantile(totals, q, axis=0)):
+            stats[f"q{level:g}"] = values
+        return pd.DataFrame({'day': self.days, **stats})
+
+    def cell_map(self, days=None, stat='mean'):
+        """
+        comp_grid with the forecast events per domain cell summed over days.
+
+        Parameters
+        ----------
+        days: iterable of int or None
+            Day positions in the horizon; None sums the whole horizon.
+        stat: str
+            'mean' or a quantile level such as 0.95 of the summed counts.
+        """
+        counts = self.counts if days is None else self.counts[:, list(days)]
+        counts = counts.sum(axis=1)[:, self.domain_cells]
+        values = counts.mean(axis=0) if stat == 'mean' else np.quantile(counts, float(stat), axis=0)
+        grid = self.comp_grid[self.comp_grid['comp_grid_id'].isin(self.domain_cells)].copy()
+        grid['forecast'] = pd.Series(values, index=self.domain_cells).loc[grid['comp_grid_id']].values
+        return grid
+
+    def plot_daily_totals(self, observed=None, q=(0.05, 0.25, 0.75, 0.95), ax=None):
+        """
+        Fan chart of the daily totals, with the observed daily counts of an events frame if given.
+        """
+        import matplotlib.pyplot as plt
+
+        if ax is None:
+            _, ax = plt.subplots(figsize=(8, 4))
+        table = self.daily_totals(q)
+        for lo, hi, alpha in ((q[0], q[-1], 0.2), (q[1], q[-2], 0.4)):
+            ax.fill_between(table['day'], table[f"q{lo:g}"], table[f"q{hi:g}"], step='post',
+                            color='C0', alpha=alpha, lw=0, label=f"{lo:g}-{hi:g}")
+        ax.step(table['day'], table['mean'], where='post', color='C0', label='mean')
+        if observed is not None:
+            daily = np.floor(observed['T']).value_counts().sort_index()
+            ax.step(daily.index, daily.values, where='post', color='k', lw=1, label='observed')
+        ax.set_xlabel('day')
+        ax.set_ylabel('events per day')
+        ax.legend()
+        return ax
+
+    def plot_cells(self, days=None, stat='mean', ax=None, cmap='viridis'):
+        """Map of the forecast events per domain cell, summed over days."""
+        import matplotlib.pyplot as plt
+
+        if ax is None:
+            _, ax = plt.subplots(figsize=(6, 6))
+        self.cell_map(days, stat).plot(column='forecast', ax=ax, legend=True, cmap=cmap)
+        ax.set_axis_off()
+        return ax
+
+
+def _draws(num_samples, num_draws, seed):
+    """Evenly thinned posterior draws, or draws resampled with replacement if there are too few."""
+    if num_draws <= num_samples:
+        return np.linspace(0, num_samples - 1, num_draws).astype(int)
+    return np.sort(np.random.default_rng(seed).choice(num_samples, num_draws))
+
+
+def _background_pieces(model, samples, draws):
+    """Rescaled bounding boxes [4, P], areas [P] and spatial log background [draws, P] of the pieces."""
+    args = model.args
+    A_ = np.asarray(args['A_'], dtype=float)
+
+    def rescale(bounds):
+        bounds = np.asarray(bounds, dtype=float)
+        return np.stack([(bounds[:, 0] - A_[0, 0])/(A_[0, 1] - A_[0, 0]), (bounds[:, 1] - A_[1, 0])/(A_[1, 1] - A_[1, 0]),
+                         (bounds[:, 2] - A_[0, 0])/(A_[0, 1] - A_[0, 0]), (bounds[:, 3] - A_[1, 0])/(A_[1, 1] - A_[1, 0])])
+
+    if 'int_df' in args:
+        int_df = args['int_df']
+        box = rescale(int_df.geometry.bounds.values)
+        area = int_df['area'].values
+        log_xy = (np.asarray(samples['f_xy'])[draws][:, int_df['comp_grid_id'].values] +
+                  np.asarray(samples['b_0'])[draws][:, int_df['cov_ind'].values])
+    elif 'cov_area' in args:
+        # spatial_cov rows are in cov_ind order, so they index b_0 directly
+        box = rescale(model.spatial_cov.geometry.bounds.values)
+        area = np.asarray(args['cov_area'])
+        log_xy = np.asarray(samples['b_0'])[draws]
+    else:
+        cells = np.asarray(args['spatial_grid_cells'])
+        n_xy = args['n_xy']
+        ix, iy = cells % n_xy, cells // n_xy
+        box = np.stack([ix, iy, ix + 1, iy + 1])/n_xy
+        if 'f_xy' in samples:
+            area = np.full(len(cells), 1/n_xy**2)
+            log_xy = np.asarray(samples['f_xy'])[draws][:, cells]
+        else:
+            # the Hawkes background is uniform on A, whose area the domain cells share
+            area = np.full(len(cells), args['A_area']/len(cells))
+            log_xy = np.zeros((len(draws), len(cells)))
+    return np.clip(box, 0., 1.), area, log_xy
+
+
+def forecast_inputs(model, horizon, num_draws=1000, start=None, max_lag=None, seed=0):
+    """
+    Everything the simulation needs from a fitted model, as NumPy arrays in rescaled units.
+
+    Parameters
+    ----------
+    model: Point_Process_Model
+        Fitted bstpp (or scalable_models) model with samples.
+    horizon: int
+        Days to forecast, in the units of data['T'].
+    num_draws: int
+        Simulated trajectories: evenly thinned posterior samples, or samples resampled with
+        replacement if the posterior has fewer.
+    start: float or None
+        Start of the forecast in the units of data['T']; defaults to T. Observed events before
+        it excite the horizon, later ones are ignored, so start < T gives hindcasts.
+    max_lag: float or None
+        Observed events older than start - max_lag are left out. Defaults to the lag at which
+        the kernel of the largest beta drawn falls below HISTORY_TOL.
+    seed: int
+
+    Returns
+    -------
+    dict of np.ndarray and scalars
+    """
+    if 'samples' not in dir(model):
+        raise Exception("MCMC posterior sampling has not been performed yet.")
+    args = model.args
+    samples = model.samples
+    hawkes = 'alpha' in samples
+    if hawkes and (args['t_trig'].get_par_names() != ['beta'] or args['sp_trig'].get_par_names() != ['sigmax_2']):
+        raise Exception("Forecasts support the exponential / symmetric Gaussian triggers only")
+    draws = _draws(len(samples['a_0']), num_draws, seed)
+
+    scale = args['T']/model.T
+    start = model.T if start is None else start
+    edges = (start + np.arange(horizon + 1))*scale
+    log_t = np.repeat(np.asarray(samples['a_0'], dtype=float)[draws][:, None], horizon, axis=1)
+    if 'f_t' in samples:
+        mid = edges[:-1] + scale/2
+        bins = np.clip(np.searchsorted(np.asarray(args['x_t']), mid, side='right') - 1, 0, args['n_t'] - 1)
+        log_t = log_t + np.asarray(samples['f_t'])[draws][:, bins]
+    box, area, log_xy = _background_pieces(model, samples, draws)
+
+    inputs = {'edges': edges, 'day_len': scale, 'n_xy': args['n_xy'], 'log_t': log_t, 'log_xy': log_xy,
+              'box': box, 'area': area}
+    if hawkes:
+        for k in ('alpha', 'beta', 'sigmax_2'):
+            inputs[k] = np.asarray(samples[k], dtype=float)[draws].ravel()
+        lag = -np.log(HISTORY_TOL)*inputs['beta'].max() if max_lag is None else max_lag*scale
+        t_events = np.asarray(args['t_events'])
+        keep = (t_events <= edges[0]) & (t_events > edges[0] - lag)
+        inputs['t_hist'] = t_events[keep]
+        inputs['xy_hist'] = np.asarray(args['xy_events'])[:, keep]
+        inputs['w_hist'] = np.asarray(args.get('event_weight', np.ones(len(t_events))), dtype=float)[keep]
+    lo = np.arange(0, len(draws), CHUNK_DRAWS)
+    inputs['chunks'] = np.stack([lo, np.minimum(lo + CHUNK_DRAWS, len(draws))], axis=1)
+    inputs['seeds'] = np.random.SeedSequence(seed).generate_state(len(lo))
+    return inputs
+
+
+def _children(rng, d, s, x, y, k, beta, sigma, t1):
+    """k[i] children of the parents (d, s, x, y), delayed from s; those outside the unit square or after t1 are dropped."""
+    rep = np.repeat(np.arange(len(k)), k)
+    d = d[rep]
+    t = s[rep] + rng.exponential(beta[d])
+    x = x[rep] + sigma[d]*rng.standard_normal(len(rep))
+    y = y[rep] + sigma[d]*rng.standard_normal(len(rep))
+    keep = (t < t1) & (x >= 0) & (x <= 1) & (y >= 0) & (y <= 1)
+    return d[keep], t[keep], x[keep], y[keep]
+
+
+def simulate_events(inputs, chunk):
+    """
+    Simulate the events of the draws of one chunk of inputs.
+
+    inputs holds the rescaled time bin edges 'edges' [H + 1], the temporal 'log_t' [draws, H]
+    and spatial 'log_xy' [draws, P] log background, the piece bounding boxes 'box' [4, P] and
+    areas 'area' [P], for Hawkes models 'alpha', 'beta' and 'sigmax_2' [draws], optionally the
+    observed events 't_hist', 'xy_hist', 'w_hist' before edges[0], and the draw ranges
+    'chunks' with their 'seeds'.
+
+    Returns
+    -------
+    (d, t, x, y): draw index, rescaled time and location of every event, unordered
+    """
+    lo, hi = inputs['chunks'][chunk]
+    rng = np.random.default_rng(inputs['seeds'][chunk])
+    edges = inputs['edges']
+    widths = np.diff(edges)
+    t0, t1 = edges[0], edges[-1]
+
+    # background: Poisson counts per (draw, time bin, piece)
+    box, area = inputs['box'], inputs['area']
+    rate = np.exp(inputs['log_t'][lo:hi, :, None] + inputs['log_xy'][lo:hi, None, :])*(widths[:, None]*area)
+    k = rng.poisson(rate).ravel()
+    d, h, p = np.unravel_index(np.repeat(np.arange(k.size), k), rate.shape)
+    t = edges[h] + widths[h]*rng.random(len(d))
+    x = box[0, p] + (box[2, p] - box[0, p])*rng.random(len(d))
+    y = box[1, p] + (box[3, p] - box[1, p])*rng.random(len(d))
+    events = [(d, t, x, y)]
+
+    if 'alpha' in inputs:
+        alpha, beta = inputs['alpha'][lo:hi], inputs['beta'][lo:hi]
+        sigma = np.sqrt(inputs['sigmax_2'][lo:hi])
+        if len(inputs.get('t_hist', ())):
+            # children of the observed events after t0, in every draw
+            t_hist, (x_hist, y_hist) = inputs['t_hist'], inputs['xy_hist']
+            mean = inputs['w_hist'][None, :]*alpha[:, None]*np.exp(-(t0 - t_hist[None, :])/beta[:, None])
+            k = rng.poisson(mean).ravel()
+            parents = np.flatnonzero(k)
+            dh, j = np.divmod(parents, len(t_hist))
+            events.append(_children(rng, dh, np.full(len(j), t0), x_hist[j], y_hist[j], k[parents],
+                                    beta, sigma, t1))
+        generation = tuple(np.concatenate(v) for v in zip(*events))
+        while len(generation[0]):
+            d, t, x, y = generation
+            generation = _children(rng, d, t, x, y, rng.poisson(alpha[d]), beta, sigma, t1)
+            events.append(generation)
+    return tuple(np.concatenate(v) for v in zip(*events))
+
+
+def simulate_chunk(inputs, chunk):
+    """
+    Simulate the draws of one chunk of forecast_inputs.
+
+    Returns
+    -------
+    np.ndarray [chunk draws, days, n_xy**2]: events per draw, day and grid cell
+    """
+    lo, hi = inputs['chunks'][chunk]
+    edges, day_len, n_xy = inputs['edges'], inputs['day_len'], inputs['n_xy']
+    D, H, C = hi - lo, len(edges) - 1, n_xy**2
+    d, t, x, y = simulate_events(inputs, chunk)
+    day = np.minimum(((t - edges[0])/day_len).astype(int), H - 1)
+    ix = np.minimum((x*n_xy).astype(int), n_xy - 1)
+    iy = np.minimum((y*n_xy).astype(int), n_xy - 1)
+    # bstpp numbers the computational grid row by row from the lower-left cell
+    counts = np.bincount((d*H + day)*C + iy*n_xy + ix, minlength=D*H*C)
+    return counts.reshape(D, H, C).astype(np.int32)
+
+
+def _launch(inputs_file, work_dir, chunks):
+    out_file = os.path.join(work_dir, f"counts_{chunks[0]:05d}.npy")
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker", inputs_file, out_file, str(chunks[0]), str(chunks[-1] + 1)]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"forecast worker for chunks {chunks[0]}-{chunks[-1]} failed:\n{proc.stderr}")
+    return np.load(out_file)
+
+
+def _worker_main(inputs_file, out_file, first, stop):
+    with open(inputs_file, "rb") as f:
+        inputs = pickle.load(f)
+    counts = np.concatenate([simulate_chunk(inputs, c) for c in range(first, stop)])
+    np.save(out_file, counts)
+
+
+def simulate_forecast(model, horizon=28, num_draws=1000, start=None, max_lag=None, n_workers=None, seed=0):
+    """
+    Posterior predictive event counts per day and grid cell over the forecast horizon.
+
+    Parameters
+    ----------
+    model: Point_Process_Model
+        Fitted 'lgcp', 'hawkes' or 'cox_hawkes' model with samples.
+    horizon, num_draws, start, max_lag, seed:
+        see forecast_inputs
+    n_workers: int or None
+        Worker processes; defaults to the number of CPUs. 1 simulates in this process.
+
+    Returns
+    -------
+    Forecast
+    """
+    inputs = forecast_inputs(model, horizon, num_draws, start, max_lag, seed)
+    n_chunks = len(inputs['chunks'])
+    n_workers = min(n_workers or os.cpu_count(), n_chunks)
+    started = time.time()
+    if n_workers == 1:
+        counts = np.concatenate([simulate_chunk(inputs, c) for c in range(n_chunks)])
+    else:
+        groups = np.array_split(np.arange(n_chunks), n_workers)
+        with tempfile.TemporaryDirectory() as work_dir, ThreadPoolExecutor(max_workers=n_workers) as pool:
+            inputs_file = os.path.join(work_dir, "inputs.pkl")
+            with open(inputs_file, "wb") as f:
+                pickle.dump(inputs, f)
+            counts = np.concatenate(list(pool.map(lambda g: _launch(inputs_file, work_dir, g), groups)))
+    print(f"[FORECAST] {num_draws} trajectories x {horizon} days in {time.time() - started:.1f}s "
+          f"({n_workers} worker{'s' if n_workers > 1 else ''}, {counts.sum()/num_draws:.0f} events per trajectory)")
+    start = model.T if start is None else start
+    return Forecast(counts, start + np.arange(horizon, dtype=float), model.comp_grid,
+                    np.asarray(model.args['spatial_grid_cells']))
+
+
+def main():
+    import benchmark_suite
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dataset", default="london", choices=list(benchmark_suite.DATASETS))
+    parser.add_argument("--model", default="coxhawkes", choices=benchmark_suite.MODELS)
+    parser.add_argument("--events", type=int, default=None, help="seeded subset of the events; all by default")
+    parser.add_argument("--steps", type=int, default=2000)
+    parser.add_argument("--lr", type=float, default=0.02)
+    parser.add_argument("--subsample-size", type=int, default=512)
+    parser.add_argument("--draws", type=int, default=1000)
+    parser.add_argument("--horizon", type=int, default=28)
+    parser.add_argument("--start", type=float, default=None, help="forecast start in days; T by default")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--collapse", action="store_true",
+                        help="fit on one weighted row per distinct (X, Y, T) tuple (same likelihood, fewer rows)")
+    opts = parser.parse_args()
+
+    import matplotlib
+    matplotlib.use("Agg")
+    from event_store import collapse_duplicates
+
+    file, t_pad, bbox_pad = benchmark_suite.DATASETS[opts.dataset]
+    events_df = benchmark_suite.load_dataset(f"{benchmark_suite.DATA_DIR}/{file}", opts.events)
+    grid_bounds, T_max = benchmark_suite.domain(events_df, t_pad, bbox_pad)
+    if opts.collapse:
+        model = benchmark_suite.build_model(opts.model, collapse_duplicates(events_df), grid_bounds, T_max,
+                                            opts.subsample_size, weight_col="weight")
+    else:
+        model = benchmark_suite.build_model(opts.model, events_df, grid_bounds, T_max, opts.subsample_size)
+    start = time.time()
+    model.run_svi(num_steps=opts.steps, lr=opts.lr, num_samples=opts.draws, plot_loss=False)
+    print(f"[FIT] {opts.model} on {len(events_df)} events in {time.time() - start:.1f}s")
+
+    forecast = simulate_forecast(model, opts.horizon, opts.draws, opts.start, n_workers=opts.workers)
+    print(forecast.daily_totals().round(1).to_string(index=False))
+
+
+if __name__ == "__main__" and len(sys.argv) == 6 and sys.argv[1] == "--worker":
+    _worker_main(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+elif __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental (daily) updates of Hawkes / Cox-Hawkes posteriors.
+
+The Hawkes likelihood factorizes over time. The events of a new window (t0, t1] have
+log-likelihood sum_i log lambda(t_i) - int_{t0}^{t1} lambda, conditional on the
+history. So yesterday's posterior can serve as today's prior, and only the new
+events need to be evaluated:
+
+- The prior of every latent site is moment-matched to the previous posterior
+  samples in the save_rslts pickle. Normal is used for real sites, LogNormal for
+  positive sites and Beta for unit-interval sites. This is mean-field assumed
+  density filtering, so posterior correlations are not carried over.
+- SVI is warm-started from the previous variational parameters.
+- The event term only covers events in the new window. Their kernel sums over all
+  preceding events are evaluated on the fly (blocked_triggering_sum of
+  scalable_models.py), so memory stays O(minibatch or row block x history) and no
+  [new events x N] pair arrays are ever stored. Old-old pairs never appear again.
+  History older than max_lag is dropped, so a daily refresh costs
+  O(new events x lag window).
+- The integrals cover (t0, t1] only, including the remaining kernel mass of old
+  events that falls inside the window.
+
+Time is rescaled by a fixed horizon T (bstpp maps [0, T] to [0, 50]) so that the
+trigger parameters keep their meaning from one day to the next. Pick T beyond the
+last day you expect to add. Like bstpp, the likelihood is registered as two
+identical factor sites, so chaining updates targets the same posterior as a single
+fit on all the data.
+
+    day0 = Incremental_Hawkes_Model(events_df, grid_bounds, T_HORIZON, t_end=40, **priors)
+    day0.run_svi(num_steps=5000, lr=0.02)
+    day0.save_rslts("hawkes_day40.pkl")
+    day1 = Incremental_Hawkes_Model.from_previous("hawkes_day40.pkl", events_df, grid_bounds, T_HORIZON,
+                                                  t_end=41, max_lag=21, **priors)
+"""
+
+import pickle
+
+import numpy as np
+import jax.numpy as jnp
+import numpyro
+import numpyro.distributions as dist
+from numpyro.distributions import constraints
+
+from bstpp.main import Hawkes_Model
+from scalable_models import (_Minibatch_Mixin, blocked_triggering_sum, constant_background, lgcp_background,
+                             excitation_integral)
+
+
+def moment_matched_prior(draws, prior):
+    """
+    Distribution with the support of prior matching the mean and spread of posterior draws.
+
+    Parameters
+    ----------
+    draws: np.ndarray
+        Posterior samples of one site, [num_samples, ...].
+    prior: numpyro Distribution
+        The site's original prior. Only its support is used.
+
+    Returns
+    -------
+    numpyro Distribution
+    """
+    draws = np.asarray(draws, dtype=float)
+    support = prior.support
+    if support is constraints.real or support is constraints.real_vector:
+        return dist.Normal(draws.mean(axis=0), draws.std(axis=0) + 1e-6)
+    if support is constraints.positive:
+        log_draws = np.log(draws)
+        return dist.LogNormal(log_draws.mean(axis=0), log_draws.std(axis=0) + 1e-6)
+    if support is constraints.unit_interval:
+        m, v = draws.mean(axis=0), draws.var(axis=0) + 1e-12
+        common = np.maximum(m*(1 - m)/v - 1, 1e-3)
+        return dist.Beta(m*common, (1 - m)*common)
+    raise ValueError(f"No moment-matched family for support {support}")
+
+
+def incremental_hawkes_model(args):
+    """Hawkes / Cox-Hawkes likelihood of the events in args['t_window'] given their history."""
+    first = args['first_new']
+    n_new = args["t_events"].shape[0] - first
+    if args['model'] == 'hawkes':
+        Itot_txy_back, log_mu = constant_background(args)
+    else:
+        Itot_t, Itot_xy, log_mu = lgcp_background(args)
+        Itot_txy_back = numpyro.deterministic("Itot_txy_back", Itot_t*Itot_xy)
+
+    alpha = numpyro.sample("alpha", args['priors']['alpha'])
+    t_pars = args['t_trig'].sample_parameters()
+    sp_pars = args['sp_trig'].sample_parameters()
+
+    with numpyro.plate("events", n_new, subsample_size=args.get('subsample_size')) as idx:
+        # idx counts from the first new event; all earlier rows, history included, are parents
+        l_hawkes = alpha*blocked_triggering_sum(args, t_pars, sp_pars, first + idx)
+        log_lambda = jnp.log(l_hawkes + jnp.exp(log_mu(first + idx)))
+        if args.get('pointwise'):
+            numpyro.deterministic('log_lambda', log_lambda)
+        ell_batch = jnp.sum(log_lambda)
+    ell_1 = numpyro.deterministic('ell_1', ell_batch*n_new/idx.shape[0])
+
+    Itot_excite = excitation_integral(args, alpha, t_pars, sp_pars)
+    Itot_txy = numpyro.deterministic("Itot_txy", Itot_excite + Itot_txy_back)
+    loglik = numpyro.deterministic('loglik', ell_1 - Itot_txy)
+
+    numpyro.factor("t_events", loglik)
+    numpyro.factor("xy_events", loglik)
+
+
+class Incremental_Hawkes_Model(_Minibatch_Mixin, Hawkes_Model):
+    def __init__(self, data, A, T, t_start=0., t_end=None, max_lag=None, subsample_size=None, **kwargs):
+        """
+        Hawkes / Cox-Hawkes model of the events in (t_start, t_end], conditional on earlier events.
+
+        Parameters
+        ----------
+        data: pd.DataFrame
+            Events with columns 'X', 'Y', 'T'. Events with T <= t_start are history, events after t_end are ignored.
+        A: np.array [2x2], GeoDataFrame
+            see Hawkes_Model
+        T: float
+            Fixed time horizon used to rescale time. Must not be before t_end.
+        t_start: float
+            Start of the likelihood window, e.g. the end of the previous update.
+        t_end: float or None
+            End of the likelihood window. Defaults to T.
+        max_lag: float or None
+            History older than t_start - max_lag is dropped. None keeps all of it, so each
+            evaluation then costs O(new events x all earlier events).
+        subsample_size: int or None
+            Number of new events in each SVI minibatch. None uses all of them.
+        kwargs: dict
+            parameters from Hawkes_Model
+        """
+        t_end = T if t_end is None else t_end
+        if not t_start < t_end <= T:
+            raise ValueError(f"Need t_start < t_end <= T, got {t_start}, {t_end}, {T}")
+        keep = data['T'] <= t_end
+        if max_lag is not None:
+            keep &= data['T'] >= t_start - max_lag
+        data = data[keep].sort_values('T', kind='stable').reset_index(drop=True)
+        super().__init__(data, A, T, **kwargs)
+        self.model = incremental_hawkes_model
+        self.t_start, self.t_end, self.max_lag = t_start, t_end, max_lag
+        self.args['subsample_size'] = subsample_size
+        self.args['t_window'] = (t_start/T*self.args['T'], t_end/T*self.args['T'])
+
+        first = int(np.searchsorted(data['T'].values, t_start, side='right'))
+        if first == len(data):
+            raise ValueError(f"No events in ({t_start}, {t_end}]")
+        self.args['first_new'] = first
+        self.init_params = None
+
+    def __str__(self):
+        return f"Incremental {super().__str__()} on ({self.t_start}, {self.t_end}]"
+
+    def use_posterior_as_prior(self, samples, guide_params=None):
+        """
+        Replace the priors of all latent sites by moment-matched fits to previous posterior samples.
+
+        Parameters
+        ----------
+        samples: dict
+            Posterior samples from a previous fit (model.samples).
+        guide_params: dict or None
+            Previous SVI parameters used to warm-start run_svi.
+        """
+        for site, size in self.get_params().items():
+            if size == 0:
+                continue
+            if site in ('z_temporal', 'z_spatial'):
+                prior = dist.Normal(jnp.zeros(size), jnp.ones(size))
+            else:
+                prior = self.args['priors'][site]
+            # trigger objects hold a reference to the same priors dict
+            self.args['priors'][site] = moment_matched_prior(samples[site], prior)
+        self.init_params = guide_params
+
+    @classmethod
+    def from_previous(cls, rslts_file, data, A, T, t_end, max_lag=None, subsample_size=None, **kwargs):
+        """
+        Model for the events after a previous fit, with that fit's posterior as prior.
+
+        Parameters
+        ----------
+        rslts_file: str
+            Pickle written by save_rslts of an Incremental_Hawkes_Model.
+        data, A, T, t_end, max_lag, subsample_size, kwargs:
+            see Incremental_Hawkes_Model. T and the model kwargs must match the previous fit.
+        """
+        with open(rslts_file, 'rb') as f:
+            output = pickle.load(f)
+        if 't_end' not in output:
+            raise ValueError(f"{rslts_file} was not written by an Incremental_Hawkes_Model")
+        model = cls(data, A, T, t_start=output['t_end'], t_end=t_end, max_lag=max_lag,
+                    subsample_size=subsample_size, **kwargs)
+        guide_params = output['svi_results'].params if 'svi_results' in output else None
+        model.use_posterior_as_prior(output['samples'], guide_params)
+        return model
+
+    @staticmethod
+    def window_end(rslts_file):
+        """End of the likelihood window of the fit saved in rslts_file."""
+        with open(rslts_file, 'rb') as f:
+            return pickle.load(f)['t_end']
+
+    def save_rslts(self, file_name):
+        """Save results, with the window end needed by from_previous."""
+        output = {'samples': self.samples, 't_end': self.t_end}
+        if 'svi_results' in dir(self):
+            output['svi_results'] = self.svi_results
+        if 'mcmc' in dir(self):
+            output['mcmc'] = self.mcmc
+        with open(file_name, 'wb') as f:
+            pickle.dump(output, f)
+
+    def run_svi(self, num_steps, lr, num_samples=1000, resume=False, plot_loss=True, **kwargs):
+        """Same as Minibatch run_svi, warm-started from the previous fit's variational parameters."""
+        if self.init_params is not None and not resume:
+            kwargs.setdefault('init_params', self.init_params)
+        super().run_svi(num_steps, lr, num_samples=num_samples, resume=resume, plot_loss=plot_loss, **kwargs)
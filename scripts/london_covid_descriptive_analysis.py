@@ -1,20 +1,17 @@
 # -*- coding: utf-8 -*-
-#pip install bstpp
 
-import bstpp
-
-#!pip install --upgrade scipy jax jaxlib
-
-from bstpp.main import LGCP_Model, Hawkes_Model,  Point_Process_Model
+# Descriptive statistics only: no bstpp / JAX / numpyro. geopandas, seaborn and sklearn are
+# imported in the sections that use them, so the header stays light.
 
 import pandas as pd
-import numpy as np
 import os
 import matplotlib.pyplot as plt
-import geopandas as gpd
-import numpyro.distributions as dist
-from shapely.geometry import box
-import seaborn as sns
+import matplotlib.cm as cm
+from matplotlib.colors import Normalize
+from event_store import iter_events
+from covariate_grid import covariate_grid
+from spatial_index import CellIndex, assign_cells
+from streaming_stats import EventStatistics
 
 """#**CONFIGURATION**"""
 
@@ -28,29 +25,45 @@ MCMC_WARMUP = 100
 MCMC_SAMPLES = 400
 MCMC_CHAINS = 1
 
-SUBSET_SIZE = 10000
+SUBSET_SIZE = 10000  # reservoir sample for the point maps, PCA and clustering
+CHUNK_ROWS = 1_000_000  # events per chunk of the single pass over the event file
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(FIGURE_DIR, exist_ok=True)
 
 """#**LOAD DATA**"""
 
-events_df = pd.read_csv(EVENTS_PATH)
-events_df = events_df.sample(n=SUBSET_SIZE, random_state=42).sort_values("T").reset_index(drop=True)
-#events_df = events_df[events_df["T"] <= 40].copy()
+# === Load covariates as GeoDataFrame ===
+covariates_df = pd.read_csv(COVARIATES_PATH)
+
+# Square 2 km grid cells around each covariate point, built in British National Grid
+grid_size = 2000  # in meters
+covariates_gdf = covariate_grid(covariates_df, grid_size, crs="EPSG:4326", grid_crs="EPSG:27700")
+cell_index = CellIndex.cached(covariates_gdf, f"{OUTPUT_DIR}/covariate_cells.idx")
+
+# One pass over the event file in chunks: time and space histograms, events per covariate cell
+# and a uniform sample of SUBSET_SIZE events, in bounded memory (see streaming_stats.py)
+event_stats = EventStatistics.from_chunks(iter_events(EVENTS_PATH, store_dir=OUTPUT_DIR, chunk_rows=CHUNK_ROWS),
+                                          cell_index=cell_index, sample_size=SUBSET_SIZE, seed=42)
+events_df = event_stats.sample
+
+# Single events GeoDataFrame (lon/lat) reused by the maps and the covariate assignment below
+import geopandas as gpd
+
+events_gdf = gpd.GeoDataFrame(events_df, geometry=gpd.points_from_xy(events_df["X"], events_df["Y"]),
+                              crs="EPSG:4326")
 
 print("Subset events data:")
 print(events_df.head())
 
-events_df['T'].unique()
-
-len(events_df)
+print(f"Events: {event_stats.n}, T quartiles: {event_stats.time.quantile([0.25, 0.5, 0.75]).round(2)}")
 
 """#**EDA - EXPLORATORY DATA ANALYSIS**"""
 
 # Epidemic curve
 plt.figure()
-events_df["T"].hist(bins=50)
+event_stats.plot_epidemic_curve(bins=50)
+plt.grid(True)
 plt.xlabel("Time (T)")
 plt.ylabel("Number of Events")
 plt.title("Epidemic Curve (COVID Cases Over Time)")
@@ -60,7 +73,7 @@ plt.show()
 """# Plot 1: Epidemic Curve (Histogram of events over time)"""
 
 plt.figure(figsize=(10, 5))
-sns.histplot(events_df["T"], bins=50, kde=False, color="steelblue")
+event_stats.plot_epidemic_curve(bins=50, color="steelblue", edgecolor="white")
 #plt.title("Epidemic Curve: Event Counts Over Time")
 plt.xlabel("Time (T)")
 plt.ylabel("Number of Events")
@@ -70,11 +83,8 @@ plt.show()
 
 """# Plot 2: Cumulative Events Over Time"""
 
-sorted_times = np.sort(events_df["T"].values)
-cumulative_counts = np.arange(1, len(sorted_times) + 1)
-
 plt.figure(figsize=(10, 5))
-plt.plot(sorted_times, cumulative_counts, color="darkgreen")
+event_stats.plot_cumulative(color="darkgreen")
 #plt.title("Cumulative Number of Events Over Time")
 plt.xlabel("Time (T)")
 plt.ylabel("Cumulative Count")
@@ -84,10 +94,8 @@ plt.show()
 
 """# Plot 3: Autocorrelation of event timestamps"""
 
-from pandas.plotting import autocorrelation_plot
-
 plt.figure(figsize=(10, 5))
-autocorrelation_plot(events_df["T"].sort_values().reset_index(drop=True))
+event_stats.plot_time_autocorrelation()
 #plt.title("Autocorrelation of Event Times")
 plt.tight_layout()
 plt.show()
@@ -108,14 +116,7 @@ plt.show()
 """# KDE (Kernel Density Estimation) for spatial intensity"""
 
 plt.figure(figsize=(8, 6))
-sns.kdeplot(
-    x=events_df["X"],
-    y=events_df["Y"],
-    fill=True,
-    cmap="viridis",
-    bw_adjust=0.5,
-    thresh=0.05
-)
+event_stats.plot_kde(bw_adjust=0.5, thresh=0.05, cmap="viridis")
 #plt.title("Spatial KDE (Intensity Approximation)")
 plt.xlabel("Longitude (X)")
 plt.ylabel("Latitude (Y)")
@@ -125,41 +126,24 @@ plt.show()
 """# 2D histogram heatmap"""
 
 plt.figure(figsize=(8, 6))
-plt.hist2d(events_df["X"], events_df["Y"], bins=50, cmap="plasma")
-plt.colorbar(label="Event Count")
+plt.colorbar(event_stats.plot_hist2d(bins=50, cmap="plasma"), label="Event Count")
 #plt.title("2D Histogram Heatmap of Events")
 plt.xlabel("Longitude (X)")
 plt.ylabel("Latitude (Y)")
 plt.tight_layout()
 plt.show()
 
-import geopandas as gpd
-import matplotlib.pyplot as plt
-from shapely.geometry import Point
-import os
-
-
 if SHAPEFILE_PATH and os.path.exists(SHAPEFILE_PATH):
     # Load and fix CRS if needed
     shp = gpd.read_file(SHAPEFILE_PATH)
     if shp.crs is None:
         shp = shp.set_crs("EPSG:27700", allow_override=True)
 
-    # Convert event DataFrame to GeoDataFrame and reproject
-    events_gdf = gpd.GeoDataFrame(
-        events_df,
-        geometry=gpd.points_from_xy(events_df["X"], events_df["Y"]),
-        crs="EPSG:4326"
-    )
-    events_gdf = events_gdf.to_crs(shp.crs)
+    # Reproject events to the shapefile CRS
+    events_shp = events_gdf.to_crs(shp.crs)
 
 """#Plot COVID Events Over 4 Time Slices"""
 
-import matplotlib.pyplot as plt
-import numpy as np
-import matplotlib.cm as cm
-from matplotlib.colors import Normalize
-
 # === Define time bins and color normalization ===
 bins = [0, 35, 70, 105, 140]
 norm = Normalize(vmin=0, vmax=140)
@@ -170,7 +154,7 @@ fig, axs = plt.subplots(1, 4, figsize=(22, 6), sharex=True, sharey=True)
 
 for i, ax in enumerate(axs):
     t_start, t_end = bins[i], bins[i + 1]
-    slice_df = events_gdf[(events_gdf["T"] >= t_start) & (events_gdf["T"] < t_end)]
+    slice_df = events_shp[(events_shp["T"] >= t_start) & (events_shp["T"] < t_end)]
 
     shp.plot(ax=ax, color='white', edgecolor='black', linewidth=1)
     slice_df.plot(
@@ -198,41 +182,15 @@ plt.show()
 
 """#Spatial Join of Events to Covariate Polygons"""
 
-import geopandas as gpd
-from shapely.geometry import box
-
-# === Load covariates as GeoDataFrame ===
-covariates_df = pd.read_csv(COVARIATES_PATH)
+# === Assign the sampled events to cells (ids are stored in OUTPUT_DIR and reused across runs) ===
+events_gdf["cell_id"] = assign_cells(events_gdf, cell_index, f"{OUTPUT_DIR}/event_cell_ids.npz")
+joined = events_gdf.join(covariates_gdf.drop(columns=["X", "Y", "geometry"]), on="cell_id")
+matched = joined[joined["cell_id"] >= 0]
 
-# Create square polygons around each covariate point (grid cell)
-grid_size = 2000  # in meters
-covariates_gdf = gpd.GeoDataFrame(
-    covariates_df,
-    geometry=gpd.points_from_xy(covariates_df["X"], covariates_df["Y"]),
-    crs="EPSG:4326"
-).to_crs("EPSG:27700")
-
-polygons = [box(x - grid_size / 2, y - grid_size / 2, x + grid_size / 2, y + grid_size / 2)
-            for x, y in zip(covariates_gdf.geometry.x, covariates_gdf.geometry.y)]
-covariates_gdf["geometry"] = polygons
-covariates_gdf = covariates_gdf.set_geometry("geometry").to_crs("EPSG:4326")  # back to lat/lon if needed
-
-# === Prepare event GeoDataFrame ===
-events_gdf = gpd.GeoDataFrame(
-    events_df,
-    geometry=gpd.points_from_xy(events_df["X"], events_df["Y"]),
-    crs="EPSG:4326"
-)
-
-# === Spatial Join ===
-joined = gpd.sjoin(events_gdf, covariates_gdf, how="left", predicate="within")
-matched = joined[~joined.index_right.isna()]
-unmatched = joined[joined.index_right.isna()]
-
-# === Diagnostics ===
-total = len(events_gdf)
-matched_count = len(matched)
-unmatched_count = len(unmatched)
+# === Diagnostics (all events, from the per-cell counts of the single pass) ===
+total = event_stats.n
+unmatched_count = event_stats.unmatched
+matched_count = total - unmatched_count
 match_rate = matched_count / total * 100
 
 print(f"Matched events:   {matched_count}/{total} ({match_rate:.2f}%)")
@@ -241,18 +199,13 @@ print(f"Unmatched events: {unmatched_count}")
 """#Summary Statistics for Covariates at Event Locations"""
 
 # === Keep only matched events with covariates ===
-matched_events = joined[~joined["index_right"].isna()].copy()
+matched_events = matched.copy()
 
 # === Covariate columns to describe ===
 covariate_cols = ["popdensity", "covid_deaths", "popn", "houseprice"]
 
-# === Summary statistics ===
-summary_stats = matched_events[covariate_cols].describe().T[
-    ["mean", "std", "min", "25%", "50%", "75%", "max"]
-]
-
-# Optional: rename for clarity
-summary_stats.columns = ["Mean", "Std Dev", "Min", "Q1", "Median", "Q3", "Max"]
+# === Summary statistics over all matched events, weighted by the events per cell ===
+summary_stats = event_stats.covariate_summary(covariates_gdf, covariate_cols)
 
 # Display neatly
 print("Summary Statistics for Covariates at Event Locations:")
@@ -260,19 +213,15 @@ print(summary_stats)
 
 """# Covariate Correlation Matrix (with Heatmap)"""
 
-import seaborn as sns
-import matplotlib.pyplot as plt
-
-# === Use only matched events ===
-matched_events = joined[~joined["index_right"].isna()].copy()
-
 # === Covariate columns ===
 covariate_cols = ["popdensity", "covid_deaths", "popn", "houseprice"]
 
-# === Compute correlation matrix ===
-corr_matrix = matched_events[covariate_cols].corr(method='pearson')
+# === Compute correlation matrix (Pearson, all matched events) ===
+corr_matrix = event_stats.covariate_correlation(covariates_gdf, covariate_cols)
 
 # === Plot heatmap ===
+import seaborn as sns
+
 plt.figure(figsize=(8, 6))
 sns.heatmap(
     corr_matrix,
@@ -291,8 +240,6 @@ plt.show()
 
 from sklearn.preprocessing import StandardScaler
 from sklearn.decomposition import PCA
-import pandas as pd
-import matplotlib.pyplot as plt
 
 # === Extract and scale covariates ===
 covariate_cols = ["popdensity", "covid_deaths", "popn", "houseprice"]
@@ -332,9 +279,6 @@ pca_gdf = matched_events.iloc[:len(pca_df)].copy()
 pca_gdf["PC1"] = pca_df["PC1"].values
 pca_gdf["PC2"] = pca_df["PC2"].values
 
-from shapely.geometry import Point
-import matplotlib.pyplot as plt
-
 # === Ensure geometry and CRS are consistent ===
 pca_gdf["geometry"] = matched_events.geometry.values
 pca_gdf = gpd.GeoDataFrame(pca_gdf, geometry="geometry")
@@ -421,9 +365,6 @@ plt.axis("off")
 plt.tight_layout()
 plt.show()
 
-import matplotlib.cm as cm
-from matplotlib.colors import Normalize
-
 # Set color scale for time
 norm = Normalize(vmin=0, vmax=140)
 cmap = cm.get_cmap("plasma")
@@ -465,7 +406,6 @@ summary_by_cluster["cluster"] = pca_gdf["cluster"].values
 cluster_summary = summary_by_cluster.groupby("cluster")[covariate_cols].describe()
 print(cluster_summary)
 
-import seaborn as sns
 plt.figure(figsize=(8, 5))
 sns.histplot(data=pca_gdf, x="T", hue="cluster", bins=30, multiple="stack")
 plt.title("Epidemic Curve by PCA-Based Cluster")
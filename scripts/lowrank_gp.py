@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Reduced-rank Gaussian process prior for the spatial background field on fine grids.
+
+bstpp draws the spatial field f_xy of the 'lgcp' and 'cox_hawkes' backgrounds from a VAE
+decoder pretrained on a fixed 25 x 25 grid, so the field cannot be resolved more finely than
+25 x 25 cells, whatever cov_grid_size the covariates use. An exact GP on an n x n grid needs
+the Cholesky factor of an [n^2, n^2] covariance, which at 200 x 200 is a 12.8 GB matrix.
+
+The 'hsgp' backend instead uses the Hilbert-space approximation of a squared exponential GP
+(Solin & Sarkka, 2020) on the unit square, which has Kronecker structure on the regular grid:
+
+    f_xy = sigma * Phi (s[:, None] * s[None, :] * Z) Phi^T
+
+with Phi the [n, m] Laplacian eigenfunctions of [-L, L] evaluated at the cell centres of
+each axis, s the square root of the 1-d spectral density at their frequencies, and Z an
+[m, m] standard normal site replacing z_spatial. Each evaluation costs O(n^2 m) time and
+O(n^2 + n m) memory, independent of the VAE, and the length scale and variance are sampled
+with the hyperpriors the VAE was trained on (ell_xy ~ InverseGamma(15, 1), var_xy ~
+LogNormal(2, 0.5)); both can be overridden through the priors like any other site.
+
+The minibatched models of scalable_models.py select the backend in the constructor:
+
+    lgcp = Minibatch_LGCP_Model(events_df, grid_bounds, T_max, spatial_gp="hsgp", n_xy=100, num_basis=20,
+                                spatial_cov=cov_df, cov_names=COV_NAMES, cov_grid_size=cov_grid_size, **priors)
+
+num_basis basis functions per axis resolve length scales down to about 1.75 c / num_basis
+of the unit square (Riutort-Mayol et al., 2023), c being boundary_factor; the default 20
+covers the bulk of the InverseGamma(15, 1) prior. With num_basis**2 = 400 coefficients instead
+of the VAE's 20 latents, an SVI step is dominated by the default AutoMultivariateNormal guide
+rather than by the grid; run_svi(..., auto_guide=AutoLowRankMultivariateNormal) roughly halves it.
+
+benchmark_suite.py records the per-step SVI time and peak memory of the backend on finer grids:
+
+    python benchmark_suite.py --datasets london --models lgcp coxhawkes --no-mcmc --synthetic-sizes \
+        --grid-sizes 25 50 100 200
+"""
+
+import numpy as np
+import jax.numpy as jnp
+import numpyro
+import numpyro.distributions as dist
+
+SPATIAL_GPS = ("vae", "hsgp")
+# grid side of the pretrained bstpp spatial decoder
+VAE_N_XY = 25
+
+
+def sine_basis(n, num_basis, boundary_factor=1.5):
+    """
+    Laplacian eigenfunctions on [-L, L], L = boundary_factor / 2, at the n cell centres of [0, 1].
+
+    Returns
+    -------
+    phi: np.ndarray [n, num_basis]
+    freqs: np.ndarray [num_basis]
+        square roots of the eigenvalues
+    """
+    L = boundary_factor * 0.5
+    x = (np.arange(n) + 0.5) / n - 0.5
+    freqs = np.pi * np.arange(1, num_basis + 1) / (2 * L)
+    phi = np.sqrt(1 / L) * np.sin(freqs[None, :] * (x[:, None] + L))
+    return phi, freqs
+
+
+def hsgp_spatial_field(args):
+    """
+    Sample the spatial field of the 'hsgp' backend.
+
+    Returns
+    -------
+    f_xy: array [n_xy**2]
+        field on the computational grid, indexed by comp_grid_id = iy*n_xy + ix
+    """
+    m = args["num_basis"]
+    ell = numpyro.sample("ell_xy", args['priors'].get("ell_xy", dist.InverseGamma(15., 1.)))
+    var = numpyro.sample("var_xy", args['priors'].get("var_xy", dist.LogNormal(2., 0.5)))
+    z_spatial = numpyro.sample("z_spatial", args['priors'].get(
+        "z_spatial", dist.Normal(jnp.zeros(m*m), jnp.ones(m*m))))
+    freqs = jnp.asarray(args["gp_freqs"])
+    # square root of the 1-d squared exponential spectral density; the 2-d density factorizes
+    sqrt_s = jnp.sqrt(jnp.sqrt(2*jnp.pi) * ell * jnp.exp(-0.5*(ell*freqs)**2))
+    W = jnp.sqrt(var) * sqrt_s[:, None] * sqrt_s[None, :] * z_spatial.reshape(m, m)
+    phi = jnp.asarray(args["gp_basis_xy"])
+    return (phi @ W @ phi.T).reshape(-1)
+
+
+def comp_grid(n_xy, A_, crs=None):
+    """bstpp's computational grid with n_xy cells per side over the bounding box A_."""
+    import geopandas as gpd
+    from shapely.geometry import Polygon
+
+    cols = np.arange(n_xy) / n_xy
+    polygons = [Polygon([(x, y), (x + 1/n_xy, y), (x + 1/n_xy, y + 1/n_xy), (x, y + 1/n_xy)])
+                for y in cols for x in cols]
+    grid = gpd.GeoDataFrame({'geometry': polygons, 'comp_grid_id': np.arange(n_xy**2)}, crs=crs)
+    grid.geometry = grid.geometry.scale(xfact=A_[0, 1]-A_[0, 0], yfact=A_[1, 1]-A_[1, 0],
+                                        origin=(0, 0)).translate(A_[0, 0], A_[1, 0])
+    return grid
+
+
+def use_lowrank_gp(model, n_xy, num_basis=20, boundary_factor=1.5):
+    """
+    Switch a constructed 'lgcp' / 'cox_hawkes' model to the 'hsgp' spatial field on an n_xy grid.
+
+    Rebuilds the computational grid and everything bstpp derived from it (event cells, domain
+    cells and the covariate intersection areas) as Point_Process_Model.__init__ does.
+
+    Parameters
+    ----------
+    model: Point_Process_Model
+    n_xy: int
+        Grid cells per side.
+    num_basis: int
+        Basis functions per axis; z_spatial has num_basis**2 entries.
+    boundary_factor: float
+        Half-width of the approximation domain relative to the half-width of the unit square.
+    """
+    import geopandas as gpd
+
+    args = model.args
+    if args['model'] not in ('lgcp', 'cox_hawkes'):
+        raise ValueError("The 'hsgp' spatial field needs a Gaussian process background ('lgcp' or 'cox_hawkes')")
+    A_ = args['A_']
+    grid = comp_grid(n_xy, A_, model.comp_grid.crs)
+    if model.A is model.comp_grid:
+        model.A = grid
+        args['spatial_grid_cells'] = np.arange(n_xy**2)
+    else:
+        args['spatial_grid_cells'] = np.unique(grid.sjoin(model.A, how='inner')['comp_grid_id'])
+    model.comp_grid = grid
+    args['n_xy'] = n_xy
+
+    args['indices_xy'] = model.points.sjoin(grid).sort_values(by='point_id')['comp_grid_id'].values
+    if len(args['indices_xy']) != len(model.points):
+        raise Exception("Computational grid does not encompass all data points!")
+
+    if 'spatial_cov' in args:
+        spatial_cov = model.spatial_cov
+        grid.crs = spatial_cov.crs
+        intersect = gpd.overlay(grid, spatial_cov, how='intersection', keep_geom_type=True)
+        intersect['area'] = intersect.area/((A_[0, 1]-A_[0, 0])*(A_[1, 1]-A_[1, 0]))
+        args['int_df'] = intersect[intersect['area'] > 1e-10]
+        args['spatial_grid_cells'] = np.unique(grid.sjoin(spatial_cov, how='inner')['comp_grid_id'])
+
+    args['spatial_gp'] = 'hsgp'
+    args['num_basis'] = num_basis
+    args['gp_boundary_factor'] = boundary_factor
+    args['z_dim_spatial'] = num_basis**2
+    args['gp_basis_xy'], args['gp_freqs'] = sine_basis(n_xy, num_basis, boundary_factor)
+    return model
+
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-chain MCMC for bstpp models.
+
+bstpp's run_mcmc already asks numpyro for ``chain_method="parallel"``, but JAX exposes a
+single CPU device by default, so numpyro falls back to running the chains one after
+another. enable_parallel_chains splits the host CPU into one XLA device per chain;
+it has to be called before JAX runs any computation (including building a numpyro
+distribution), i.e. at the top of a script. numpyro then shows one progress bar per
+chain.
+
+chain_diagnostics merges the chains into an ArviZ InferenceData and reports R-hat,
+bulk/tail ESS and effective samples per second of wall time.
+"""
+
+import importlib.util
+import os
+import re
+import time
+
+# arviz takes over a second to import; it is only loaded by chain_diagnostics
+HAS_ARVIZ = importlib.util.find_spec("arviz") is not None
+
+
+def enable_parallel_chains(num_chains):
+    """
+    Expose num_chains CPU devices to JAX so MCMC chains run in parallel.
+
+    Parameters
+    ----------
+    num_chains: int
+        Number of chains to run concurrently.
+    """
+    # what numpyro.set_host_device_count does, without importing JAX at the top of the script
+    xla_flags = re.sub(r"--xla_force_host_platform_device_count=\S+", "", os.environ.get("XLA_FLAGS", ""))
+    os.environ["XLA_FLAGS"] = f"--xla_force_host_platform_device_count={num_chains} {xla_flags}".strip()
+
+
+def chain_diagnostics(model, elapsed_s, var_names=None):
+    """
+    Convergence and throughput summary of the model's last MCMC run.
+
+    Parameters
+    ----------
+    model: Point_Process_Model
+        Model with an mcmc attribute (after run_mcmc or load_rslts).
+    elapsed_s: float
+        Wall time of the MCMC run, used for ESS per second.
+    var_names: list or None
+        Sites to summarize. Defaults to the sampled model parameters.
+
+    Returns
+    -------
+    pd.DataFrame
+        ArviZ diagnostics (mcse, ess_bulk, ess_tail, r_hat) plus ess_bulk_per_s and ess_tail_per_s.
+        The merged InferenceData is stored as model.idata.
+    """
+    if not HAS_ARVIZ:
+        raise ImportError("chain_diagnostics requires arviz (pip install arviz)")
+    import arviz as az
+    if 'mcmc' not in dir(model):
+        raise Exception("MCMC posterior sampling has not been performed yet.")
+    # the point-process likelihood is a factor site, there is no pointwise log-likelihood to collect
+    model.idata = az.from_numpyro(model.mcmc, log_likelihood=False)
+    if var_names is None:
+        var_names = [k for k, n in model.get_params().items() if n > 0 and k in model.idata.posterior]
+    summary = az.summary(model.idata, var_names=var_names, kind="diagnostics")
+    summary["ess_bulk_per_s"] = summary["ess_bulk"]/elapsed_s
+    summary["ess_tail_per_s"] = summary["ess_tail"]/elapsed_s
+    return summary
+
+
+def run_mcmc_chains(model, name, fit_cache=None, **mcmc_kwargs):
+    """
+    Run (or load from fit_cache) model.run_mcmc and print its chain diagnostics.
+
+    Parameters
+    ----------
+    model: Point_Process_Model
+    name: str
+        Label for log messages.
+    fit_cache: FitCache or None
+        Cache to load from / store into. On a hit, the wall time of the original run is used.
+    mcmc_kwargs: dict
+        keyword arguments for run_mcmc (num_warmup, num_samples, num_chains, ...)
+
+    Returns
+    -------
+    pd.DataFrame: see chain_diagnostics
+    """
+    start = time.time()
+    if fit_cache is not None:
+        fit_cache.fit(model, name, "mcmc", **mcmc_kwargs)
+        elapsed_s = fit_cache.meta(model, "mcmc", **mcmc_kwargs).get("elapsed_s", time.time() - start)
+    else:
+        from fit_telemetry import record_fit
+        with record_fit(model, name, "mcmc", mcmc_kwargs):
+            model.run_mcmc(**mcmc_kwargs)
+        elapsed_s = time.time() - start
+
+    summary = chain_diagnostics(model, elapsed_s)
+    num_chains = mcmc_kwargs.get("num_chains", 1)
+    print(f"\n=== {name} MCMC: {num_chains} chain(s), {elapsed_s:.1f}s ===")
+    print(summary.round(3).to_string())
+    print(f"min ESS/s (bulk): {summary['ess_bulk_per_s'].min():.2f}, "
+          f"max R-hat: {summary['r_hat'].max():.3f}")
+    return summary
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Model comparison by expected AIC, WAIC and PSIS-LOO from pointwise log-likelihoods.
+
+expected_AIC only needs the total log-likelihood of each posterior draw. WAIC and
+PSIS-LOO need one term per event and draw. For a point process with N events,
+
+    log p(X | theta) = sum_i log lambda(x_i) - int lambda,
+
+so event i gets log lambda(x_i) - (int lambda)/N. These terms sum to bstpp's
+loglik. pointwise_loglik evaluates them for all draws with one jitted function.
+The function maps over the draws and is applied to fixed-size chunks of events, by
+substituting the chunk for the models' "events" subsample plate. It works with the
+models of scalable_models.py, truncated_kernel.py and incremental_hawkes.py, which
+record a 'log_lambda' site when args['pointwise'] is set.
+
+The [draws, events] arrays are cached on disk under a hash of the model inputs and of
+the posterior draws. Refreshing the comparison after adding a model therefore only
+evaluates that model. compare_models runs the evaluations in FitScheduler's
+CPU-pinned worker processes.
+
+    jobs = [ComparisonJob(job.name, job.build, job.out_file) for job in fit_jobs]
+    table = compare_models(jobs, cache_dir=f"{OUTPUT_DIR}/pointwise_cache", n_workers=6)
+"""
+
+import hashlib
+import importlib.util
+import os
+import time
+import traceback
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy.special import logsumexp
+
+# arviz is only imported by information_criteria, which runs in the scoring workers
+HAS_ARVIZ = importlib.util.find_spec("arviz") is not None
+
+# deterministic sites holding the integral of the intensity, by model
+INTEGRAL_SITES = ("Itot_txy", "I_tot_txy")
+
+
+def _latent_samples(model, num_draws=None):
+    """Posterior draws of the latent sites, evenly thinned to num_draws."""
+    samples = {k: np.asarray(model.samples[k]) for k, n in model.get_params().items()
+               if n > 0 and k in model.samples}
+    S = len(next(iter(samples.values())))
+    if num_draws is not None and num_draws < S:
+        keep = np.linspace(0, S - 1, num_draws).astype(int)
+        samples = {k: v[keep] for k, v in samples.items()}
+    return samples
+
+
+def pointwise_loglik(model, num_draws=None, chunk_size=256):
+    """
+    Log-likelihood of every event under every posterior draw.
+
+    Parameters
+    ----------
+    model: Point_Process_Model
+        Fitted model from scalable_models.py, truncated_kernel.py or incremental_hawkes.py.
+    num_draws: int or None
+        Evenly thinned number of posterior draws to use. None uses all.
+    chunk_size: int
+        Events per evaluation. Dense Hawkes models hold [chunk_size, N] kernel matrices for one draw at a time.
+
+    Returns
+    -------
+    np.ndarray [draws, events]
+    """
+    import jax
+    import jax.numpy as jnp
+    from numpyro import handlers
+
+    args = dict(model.args, pointwise=True, subsample_size=chunk_size)
+    # incremental models only score the events after first_new
+    n = args["t_events"].shape[0] - args.get("first_new", 0)
+    params = {k: jnp.asarray(v) for k, v in _latent_samples(model, num_draws).items()}
+
+    @jax.jit
+    def evaluate(params, idx):
+        def one_draw(draw):
+            tr = handlers.trace(handlers.substitute(handlers.seed(model.model, 0),
+                                                    data=dict(draw, events=idx))).get_trace(args)
+            if "log_lambda" not in tr:
+                raise ValueError(f"{model} does not record pointwise log-intensities; "
+                                 "use a model from scalable_models.py")
+            integral = next(tr[site]["value"] for site in INTEGRAL_SITES if site in tr)
+            return tr["log_lambda"]["value"], integral
+        return jax.lax.map(one_draw, params)
+
+    S = len(next(iter(params.values())))
+    log_lambda = None
+    for start in range(0, n, chunk_size):
+        # pad the last chunk so every call reuses the same compiled function
+        idx = np.minimum(np.arange(start, start + chunk_size), n - 1)
+        values, integral = evaluate(params, jnp.asarray(idx))
+        values = np.asarray(values)
+        if log_lambda is None:
+            # weighted Hawkes models return one column per event of each row
+            log_lambda = np.empty((S, n) + values.shape[2:])
+        if values.shape[1] != chunk_size:
+            # models without an events plate return all events at once
+            log_lambda[:] = values
+            break
+        stop = min(start + chunk_size, n)
+        log_lambda[:, start:stop] = values[:, :stop - start]
+    if log_lambda.ndim == 3:
+        # weighted Hawkes models: the first weight columns of each row are its events
+        w = np.asarray(args["event_weight"])
+        log_lambda = log_lambda[:, np.repeat(np.arange(n), w), np.arange(w.sum()) - np.repeat(np.cumsum(w) - w, w)]
+        n = log_lambda.shape[1]
+    elif "event_weight" in args:
+        # binned models: every event of a bin gets the log-intensity of its bin
+        log_lambda = np.repeat(log_lambda, args["event_weight"], axis=1)
+        n = log_lambda.shape[1]
+    return log_lambda - np.asarray(integral, dtype=float)[:, None]/n
+
+
+def pointwise_key(model, num_draws=None):
+    """Hash of the model inputs and of the posterior draws that pointwise_loglik depends on."""
+    from fit_cache import fit_key
+    h = hashlib.sha256(fit_key(model, "pointwise").encode())
+    for k, v in sorted(_latent_samples(model, num_draws).items()):
+        h.update(f"{k}:{v.dtype}:{v.shape}:".encode())
+        h.update(np.ascontiguousarray(v).tobytes())
+    return h.hexdigest()
+
+
+def cached_pointwise_loglik(model, cache_dir, num_draws=None, chunk_size=256):
+    """
+    pointwise_loglik, read from or stored in cache_dir as float32 .npy files.
+
+    Returns
+    -------
+    (np.ndarray, bool): pointwise log-likelihoods and whether they came from the cache
+    """
+    path = os.path.join(cache_dir, f"pointwise_{pointwise_key(model, num_draws)}.npy")
+    if os.path.exists(path):
+        try:
+            return np.load(path).astype(float), True
+        except (OSError, ValueError) as e:
+            warnings.warn(f"Discarding unreadable cache entry {path}: {e!r}")
+    ll = pointwise_loglik(model, num_draws, chunk_size)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp, ll.astype(np.float32))
+    os.replace(tmp, path)
+    return ll, False
+
+
+def information_criteria(ll):
+    """
+    WAIC and PSIS-LOO on the deviance scale, from a [draws, events] log-likelihood array.
+
+    Returns
+    -------
+    dict with 'waic', 'p_waic', 'looic', 'p_loo', 'max_pareto_k' and 'n_bad_k' (k > 0.7).
+    LOO entries are NaN when arviz is not installed.
+    """
+    S = ll.shape[0]
+    lppd = logsumexp(ll, axis=0) - np.log(S)
+    p_waic = ll.var(axis=0, ddof=1)
+    out = {"waic": -2*np.sum(lppd - p_waic), "p_waic": np.sum(p_waic)}
+    if HAS_ARVIZ:
+        import arviz as az
+        with warnings.catch_warnings():
+            # the high-k warning is reported through n_bad_k
+            warnings.simplefilter("ignore", UserWarning)
+            # Pareto-smoothed, normalized log importance weights [events, draws]
+            log_weights, k = az.psislw(-ll.T, reff=1.)
+        elpd_loo = logsumexp(log_weights + ll.T, axis=1)
+        k = np.asarray(k)
+        out.update(looic=-2*np.sum(elpd_loo), p_loo=np.sum(lppd - elpd_loo),
+                   max_pareto_k=float(k.max()), n_bad_k=int((k > 0.7).sum()))
+    else:
+        warnings.warn("arviz is not installed; PSIS-LOO is not computed")
+        out.update(looic=np.nan, p_loo=np.nan, max_pareto_k=np.nan, n_bad_k=np.nan)
+    return out
+
+
+class ComparisonJob:
+    num_devices = 1
+
+    def __init__(self, name, build, rslts_file, num_draws=None, chunk_size=256):
+        """
+        One fitted model to score, schedulable by FitScheduler.
+
+        Parameters
+        ----------
+        name: str
+            Label in the comparison table.
+        build: callable
+            Picklable zero-argument callable returning the (unfitted) model, as for FitJob.
+        rslts_file: str
+            Posterior archive (posterior_store.py) or save_rslts pickle of the fitted model.
+            Only the latent sites and the log-likelihood are read from an archive.
+        num_draws, chunk_size:
+            see pointwise_loglik
+        """
+        self.name = name
+        self.build = build
+        self.rslts_file = rslts_file
+        self.num_draws = num_draws
+        self.chunk_size = chunk_size
+
+    def run(self, cache_dir=None):
+        """Score the model in the current process and return its result row."""
+        start = time.time()
+        result = {"name": self.name, "rslts_file": self.rslts_file, "cached": False}
+        try:
+            from posterior_store import load_results
+            model = self.build()
+            sites = [k for k, n in model.get_params().items() if n > 0] + ["loglik"]
+            load_results(model, self.rslts_file, var_names=sites)
+            result["aic"] = model.expected_AIC()
+            if cache_dir is None:
+                ll = pointwise_loglik(model, self.num_draws, self.chunk_size)
+            else:
+                ll, result["cached"] = cached_pointwise_loglik(model, cache_dir, self.num_draws, self.chunk_size)
+            result["num_draws"], result["num_events"] = ll.shape
+            result.update(information_criteria(ll))
+        except Exception:
+            result["aic"] = float("nan")
+            result["error"] = traceback.format_exc()
+        result["elapsed_s"] = time.time() - start
+        return result
+
+
+def _print_row(result, table):
+    status = "FAILED" if "error" in result else f"LOOIC = {result.get('looic', np.nan):.2f}"
+    print(f"\n[SCORED] {result['name']} in {result['elapsed_s']:.1f}s: {status}")
+    if "error" in result:
+        print(result["error"])
+    columns = ["name", "aic", "waic", "looic", "max_pareto_k", "cached", "elapsed_s"]
+    print(table[[c for c in columns if c in table.columns]].to_string(index=False))
+
+
+def compare_models(jobs, cache_dir=None, n_workers=None, cpus_per_job=None, log_dir=None, parallel=True,
+                   sort_by="looic"):
+    """
+    Score fitted models by expected AIC, WAIC and PSIS-LOO.
+
+    Parameters
+    ----------
+    jobs: list of ComparisonJob
+    cache_dir: str or None
+        Directory of the pointwise log-likelihood cache.
+    n_workers, cpus_per_job, log_dir:
+        see FitScheduler
+    parallel: bool
+        Score the models in concurrent worker processes. False scores them one by one in this process.
+    sort_by: str
+        'looic', 'waic' or 'aic'
+
+    Returns
+    -------
+    pd.DataFrame sorted by sort_by, with the difference to the best model in 'delta_<sort_by>'.
+    """
+    if parallel:
+        from fit_scheduler import FitScheduler
+        table = FitScheduler(n_workers=n_workers, cpus_per_job=cpus_per_job, cache_dir=cache_dir,
+                             log_dir=log_dir).run(jobs, on_result=_print_row)
+    else:
+        rows = []
+        for job in jobs:
+            rows.append(job.run(cache_dir))
+            _print_row(rows[-1], pd.DataFrame(rows))
+        table = pd.DataFrame(rows)
+    if sort_by not in table.columns:
+        sort_by = "aic"
+    table = table.sort_values(sort_by, na_position="last").reset_index(drop=True)
+    table[f"delta_{sort_by}"] = table[sort_by] - table[sort_by].min()
+    return table
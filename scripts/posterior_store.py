@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Compact posterior archives in place of save_rslts pickles.
+
+save_rslts pickles the whole fitted state (samples, svi_results, the MCMC object), and
+load_rslts reads all of it back, including the [draws, grid cells] and [draws, time bins]
+latent GP fields, even when the caller only needs a few scalar sites. save_posterior
+writes model.samples as an ArviZ InferenceData layout instead: one float32 array per
+site, compressed and chunked along the draws, in a 'posterior' group (chain, draw, ...)
+and the total log-likelihood in a 'log_likelihood' group. The file opens with
+az.from_netcdf / az.from_zarr, and load_posterior reads only the requested sites:
+
+    save_posterior(hawkes, f"{OUTPUT_DIR}/hawkes_mcmc.nc")
+    load_posterior(hawkes, f"{OUTPUT_DIR}/hawkes_mcmc.nc", var_names=["alpha", "beta", "loglik"])
+    hawkes.expected_AIC()  # without reading the Cox background fields
+
+The format follows the file name: '.nc' for NetCDF4 (h5netcdf) and '.zarr' for a Zarr
+directory store (needs zarr). save_results / load_results fall back to save_rslts /
+load_rslts for any other name, so FitJob.out_file and ComparisonJob.rslts_file accept
+both. Archives hold the posterior only: resuming SVI needs the optimizer state, which
+stays in the FitCache pickles, and chain diagnostics need the fitted model.mcmc.
+"""
+
+import importlib.util
+import os
+import shutil
+
+import numpy as np
+
+HAS_ZARR = importlib.util.find_spec("zarr") is not None
+
+ARCHIVE_SUFFIXES = (".nc", ".zarr")
+# sites stored in the log_likelihood group rather than the posterior group
+LOGLIK_SITES = ("loglik",)
+
+
+def is_archive(path):
+    return str(path).rstrip("/").endswith(ARCHIVE_SUFFIXES)
+
+
+def _engine(path):
+    if path.rstrip("/").endswith(".zarr"):
+        if not HAS_ZARR:
+            raise ImportError(f"Writing or reading {path} needs zarr; use a '.nc' archive instead")
+        return "zarr"
+    return "h5netcdf"
+
+
+def _inference(model, num_draws):
+    """('mcmc', number of chains) for an MCMC posterior, ('svi', 1) for SVI draws."""
+    mcmc = getattr(model, "mcmc", None)
+    if mcmc is None or num_draws != mcmc.num_chains * (mcmc.num_samples // mcmc.thinning):
+        # no MCMC run, or samples of a later SVI fit on the same model
+        return "svi", 1
+    return "mcmc", mcmc.num_chains
+
+
+def save_posterior(model, path, chunk_draws=100, complevel=4):
+    """
+    Write model.samples to a compressed, chunked float32 archive.
+
+    Parameters
+    ----------
+    model: Point_Process_Model
+        Fitted model.
+    path: str
+        '.nc' or '.zarr' file; replaced atomically.
+    chunk_draws: int
+        Draws per chunk. load_posterior decompresses whole chunks of the sites it reads.
+    complevel: int
+        zlib compression level of NetCDF archives (Zarr uses its default Blosc compressor).
+
+    Returns
+    -------
+    str: path
+    """
+    import arviz as az
+
+    samples = {k: np.asarray(v) for k, v in model.samples.items()}
+    S = len(next(iter(samples.values())))
+    inference, chains = _inference(model, S)
+    groups = {"posterior": {}, "log_likelihood": {}}
+    for k, v in samples.items():
+        if np.issubdtype(v.dtype, np.floating):
+            v = v.astype(np.float32)
+        groups["log_likelihood" if k in LOGLIK_SITES else "posterior"][k] = v.reshape((chains, S // chains) + v.shape[1:])
+    attrs = {"model": type(model).__name__, "inference": inference}
+
+    engine = _engine(path)
+    tmp = f"{path.rstrip('/')}.{os.getpid()}.tmp"
+    mode = "w"
+    for group, data in groups.items():
+        if not data:
+            continue
+        ds = az.dict_to_dataset(data, library=None, attrs=attrs)
+        encoding = {}
+        for k, var in ds.data_vars.items():
+            chunks = (1, min(chunk_draws, var.shape[1])) + var.shape[2:]
+            encoding[k] = ({"chunks": chunks} if engine == "zarr" else
+                           {"chunksizes": chunks, "zlib": True, "complevel": complevel, "shuffle": True})
+        if engine == "zarr":
+            ds.to_zarr(tmp, group=group, mode=mode, encoding=encoding)
+        else:
+            ds.to_netcdf(tmp, group=group, mode=mode, engine=engine, encoding=encoding)
+        mode = "a"
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+    return path
+
+
+def _open(path, group):
+    import xarray as xr
+    engine = _engine(path)
+    if engine == "zarr":
+        return xr.open_zarr(path, group=group)
+    try:
+        return xr.open_dataset(path, group=group, engine=engine)
+    except OSError:
+        # archives without a log_likelihood group
+        return None
+
+
+def posterior_var_names(path):
+    """Sites stored in an archive, read from its metadata only."""
+    names = []
+    for group in ("posterior", "log_likelihood"):
+        ds = _open(path, group)
+        if ds is not None:
+            names += list(ds.data_vars)
+            ds.close()
+    return names
+
+
+def read_posterior(path, var_names=None):
+    """
+    Posterior draws of the requested sites, with chains concatenated as in model.samples.
+
+    Only the chunks of the requested sites are read and decompressed.
+
+    Parameters
+    ----------
+    path: str
+        Archive written by save_posterior.
+    var_names: list of str or None
+        Sites to read; names not in the archive are skipped. None reads all.
+
+    Returns
+    -------
+    dict of np.ndarray [draws, ...]
+    """
+    samples = {}
+    for group in ("posterior", "log_likelihood"):
+        ds = _open(path, group)
+        if ds is None:
+            continue
+        for k in ds.data_vars:
+            if var_names is None or k in var_names:
+                v = ds[k].values
+                samples[k] = v.reshape((-1,) + v.shape[2:])
+        ds.close()
+    return samples
+
+
+def load_posterior(model, path, var_names=None):
+    """
+    Set model.samples from an archive, like load_rslts.
+
+    Returns
+    -------
+    dict: model.samples
+    """
+    model.samples = read_posterior(path, var_names)
+    return model.samples
+
+
+def save_results(model, path):
+    """save_posterior for '.nc' / '.zarr' paths, save_rslts otherwise."""
+    if is_archive(path):
+        return save_posterior(model, path)
+    model.save_rslts(path)
+    return path
+
+
+def load_results(model, path, var_names=None):
+    """load_posterior for '.nc' / '.zarr' paths, load_rslts (which reads every site) otherwise."""
+    if is_archive(path):
+        return load_posterior(model, path, var_names)
+    model.load_rslts(path)
+    return model.samples
@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+"""
+Headless runner for the London COVID analysis, driven by a single config file.
+
+The notebook scripts hard-code Colab/Kaggle paths and settings and call plt.show()
+after every figure. This runner reads paths, priors, model list and inference
+settings from a TOML (or YAML, with PyYAML) config such as london_pipeline.toml. It
+runs three stages on the non-interactive Agg backend:
+
+- eda: epidemic curve, spatial maps, time slices and covariates at event locations
+- fit: all configured model/method combinations in parallel worker processes
+  (FitScheduler, with the FitCache), plus the posterior plots of each model as soon
+  as its fit finishes
+- compare: expected AIC, WAIC and PSIS-LOO of the fitted models (model_comparison.py)
+
+Each stage records a hash of its inputs (the relevant config sections and the
+size/mtime of its input files) in <output_dir>/pipeline/<stage>.json. A stage whose
+inputs and outputs are unchanged is skipped; --force reruns it. Figures are built on
+the main thread and written by a FigureWriter thread pool. PNG rendering therefore
+overlaps the fits running in the worker processes and never holds them up.
+
+    python run_pipeline.py london_pipeline.toml
+    python run_pipeline.py london_pipeline.toml --stages fit compare --force
+"""
+
+import argparse
+import copy
+import hashlib
+import json
+import os
+import time
+import traceback
+from functools import cached_property, partial
+
+# non-interactive backend for this process and the fit workers, before matplotlib is imported
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+try:
+    import yaml
+    HAS_YAML = True
+except ImportError:
+    HAS_YAML = False
+
+from figure_writer import FigureWriter
+
+STAGES = ("eda", "fit", "compare")
+
+# the settings of final_london_covid_bstpp_analysis.py
+DEFAULT_CONFIG = {
+    "paths": {"events": "", "covariates": "", "shapefile": "", "output_dir": "results", "figure_dir": "",
+              "compilation_cache": "", "telemetry": ""},
+    "data": {"subset_size": 0, "mcmc_subset_size": 10000, "seed": 42, "t_padding": 7, "bbox_padding": 0.005},
+    "covariates": {"columns": ["popdensity", "covid_deaths", "popn", "houseprice"], "cell_size": 2000,
+                   "crs": "EPSG:4326", "grid_crs": "EPSG:27700", "cov_grid_size": 0.5,
+                   "spatial_gp": "vae", "n_xy": 25, "num_basis": 20},
+    "priors": {"a_0": ["Normal", 1, 10], "alpha": ["Beta", 20, 60], "beta": ["HalfNormal", 2.0],
+               "sigmax_2": ["HalfNormal", 0.25]},
+    "fit": {"minibatch_size": 512, "svi_steps": 15000, "svi_lr": 0.02, "svi_patience": 1000, "svi_rtol": 1e-4,
+            "svi_lr_decay": 0, "svi_checkpoint_every": 0, "mcmc_warmup": 100, "mcmc_samples": 400, "mcmc_chains": 4, "mcmc_checkpoint_every": 0, "workers": 6,
+            "cpus_per_fit": 0, "cache_max_gb": 5, "intensity_frames": 10},
+    "models": [{"model": m, "method": method} for m in ("hawkes", "lgcp_cov", "coxhawkes_cov")
+               for method in ("svi", "mcmc")],
+    "compare": {"draws": 200, "sort_by": "looic"},
+    "figures": {"workers": 4, "format": "png", "dpi": 100},
+}
+
+MODEL_LABELS = {"hawkes": "Hawkes", "lgcp_cov": "LGCP_cov", "coxhawkes_cov": "Cox-Hawkes_cov"}
+PATH_KEYS = ("events", "covariates", "shapefile", "output_dir", "figure_dir", "compilation_cache", "telemetry")
+
+
+def _merge(base, override):
+    out = copy.deepcopy(base)
+    for k, v in override.items():
+        out[k] = _merge(out[k], v) if isinstance(v, dict) and isinstance(out.get(k), dict) else v
+    return out
+
+
+def load_config(path):
+    """
+    Read a TOML/YAML config, fill in DEFAULT_CONFIG and resolve relative paths against its directory.
+
+    Returns
+    -------
+    dict
+    """
+    if path.endswith((".yaml", ".yml")):
+        if not HAS_YAML:
+            raise ImportError("YAML configs require PyYAML (pip install pyyaml)")
+        with open(path) as f:
+            config = yaml.safe_load(f) or {}
+    else:
+        if tomllib is None:
+            raise ImportError("TOML configs require Python 3.11 or tomli (pip install tomli)")
+        with open(path, "rb") as f:
+            config = tomllib.load(f)
+    config = _merge(DEFAULT_CONFIG, config)
+    base = os.path.dirname(os.path.abspath(path))
+    paths = config["paths"]
+    for key in PATH_KEYS:
+        if paths[key]:
+            paths[key] = os.path.normpath(os.path.join(base, os.path.expanduser(paths[key])))
+    paths["figure_dir"] = paths["figure_dir"] or os.path.join(paths["output_dir"], "figures")
+    if not paths["events"]:
+        raise ValueError(f"{path}: paths.events is required")
+    for spec in config["models"]:
+        if spec["model"] not in MODEL_LABELS or spec["method"] not in ("svi", "mcmc"):
+            raise ValueError(f"{path}: unknown model/method {spec}")
+    return config
+
+
+def build_priors(spec):
+    """numpyro priors from {"site": ["Distribution", *parameters]}."""
+    import numpyro.distributions as dist
+    return {site: getattr(dist, args[0])(*args[1:]) for site, args in spec.items()}
+
+
+def _file_stat(path):
+    if not path or not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return [os.path.basename(path), st.st_size, st.st_mtime_ns]
+
+
+class Pipeline:
+    def __init__(self, config, force=False):
+        """
+        Stages of the London analysis for one config.
+
+        Parameters
+        ----------
+        config: dict
+            From load_config.
+        force: bool
+            Rerun stages even when their inputs are unchanged.
+        """
+        self.config = config
+        self.force = force
+        self.paths = config["paths"]
+        self.manifest_dir = os.path.join(self.paths["output_dir"], "pipeline")
+        os.makedirs(self.paths["output_dir"], exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        if self.paths["compilation_cache"]:
+            # before any JAX computation; the fit and scoring workers inherit it through the environment
+            from compile_cache import enable_compilation_cache
+            enable_compilation_cache(self.paths["compilation_cache"])
+        if self.paths["telemetry"]:
+            from fit_telemetry import enable_telemetry
+            enable_telemetry(self.paths["telemetry"])
+        fig = config["figures"]
+        self.figures = FigureWriter(self.paths["figure_dir"], max_workers=fig["workers"], fmt=fig["format"],
+                                    dpi=fig["dpi"])
+
+    # --- inputs shared by the stages -------------------------------------------------------------
+
+    @cached_property
+    def events_df(self):
+        from event_store import read_events
+        events = read_events(self.paths["events"], store_dir=self.paths["output_dir"])
+        n = self.config["data"]["subset_size"]
+        if n:
+            events = events.sample(n=min(n, len(events)), random_state=self.config["data"]["seed"])
+            events = events.sort_values(["T", "X", "Y"]).reset_index(drop=True)
+        return events
+
+    @cached_property
+    def events_gdf(self):
+        return self._geo(self.events_df)
+
+    @cached_property
+    def mcmc_events_df(self):
+        """Seeded subsample of events_df for the MCMC fits, whose exact likelihood costs O(N^2) per gradient."""
+        n = self.config["data"]["mcmc_subset_size"]
+        if not n or n >= len(self.events_df):
+            return self.events_df
+        events = self.events_df.sample(n=n, random_state=self.config["data"]["seed"])
+        return events.sort_values(["T", "X", "Y"]).reset_index(drop=True)
+
+    @cached_property
+    def mcmc_events_gdf(self):
+        return self._geo(self.mcmc_events_df)
+
+    def _geo(self, events):
+        import geopandas as gpd
+        return gpd.GeoDataFrame(events, geometry=gpd.points_from_xy(events.X, events.Y),
+                                crs=self.config["covariates"]["crs"])
+
+    @cached_property
+    def grid_bounds(self):
+        pad = self.config["data"]["bbox_padding"]
+        return np.array([[self.events_df["X"].min() - pad, self.events_df["X"].max() + pad],
+                         [self.events_df["Y"].min() - pad, self.events_df["Y"].max() + pad]])
+
+    @cached_property
+    def T_max(self):
+        return self.events_df["T"].max() + self.config["data"]["t_padding"]
+
+    @cached_property
+    def spatial_cov(self):
+        from covariate_grid import covariate_grid
+        cov = self.config["covariates"]
+        covariates = pd.read_csv(self.paths["covariates"]).drop_duplicates(subset=["X", "Y"]).reset_index(drop=True)
+        return covariate_grid(covariates, cov["cell_size"], crs=cov["crs"], grid_crs=cov["grid_crs"],
+                              cache_dir=os.path.join(self.paths["output_dir"], "covariate_grid_cache"))
+
+    # --- skip-if-cached --------------------------------------------------------------------------
+
+    def stage_key(self, stage):
+        """Hash of the config sections and input files a stage depends on."""
+        c = self.config
+        inputs = {"data": c["data"], "events": _file_stat(self.paths["events"]), "covariates": c["covariates"],
+                  "covariates_file": _file_stat(self.paths["covariates"])}
+        if stage == "eda":
+            inputs["shapefile"] = _file_stat(self.paths["shapefile"])
+        if stage in ("fit", "compare"):
+            inputs.update(priors=c["priors"], fit=c["fit"], models=c["models"])
+        if stage == "compare":
+            inputs.update(compare=c["compare"], results=[_file_stat(job.out_file) for job in self.fit_jobs])
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _manifest(self, stage):
+        return os.path.join(self.manifest_dir, f"{stage}.json")
+
+    def is_current(self, stage):
+        """True if the stage already ran on the same inputs and its outputs still exist."""
+        path = self._manifest(stage)
+        if self.force or not os.path.exists(path):
+            return False
+        with open(path) as f:
+            manifest = json.load(f)
+        return manifest["key"] == self.stage_key(stage) and all(os.path.exists(p) for p in manifest["outputs"])
+
+    def _record(self, stage, outputs, elapsed_s):
+        tmp = f"{self._manifest(stage)}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"key": self.stage_key(stage), "outputs": outputs, "elapsed_s": elapsed_s,
+                       "finished": time.time()}, f, indent=1)
+        os.replace(tmp, self._manifest(stage))
+
+    def run(self, stages=STAGES):
+        """Run the selected stages in pipeline order, skipping the up-to-date ones."""
+        start = time.time()
+        try:
+            for stage in STAGES:
+                if stage not in stages:
+                    continue
+                if self.is_current(stage):
+                    print(f"[SKIPPED] {stage}: inputs unchanged since the last run")
+                    continue
+                print(f"\n[STAGE] {stage}")
+                stage_start = time.time()
+                outputs = getattr(self, f"run_{stage}")()
+                # outputs include figures, which must be on disk before the stage counts as done
+                self.figures.wait()
+                self._record(stage, outputs, time.time() - stage_start)
+                print(f"[DONE] {stage} in {time.time() - stage_start:.1f}s")
+        finally:
+            self.figures.close()
+        print(f"\nPipeline finished in {time.time() - start:.1f}s; figures in {self.paths['figure_dir']}")
+
+    # --- eda -------------------------------------------------------------------------------------
+
+    def run_eda(self):
+        events = self.events_df
+        out = self.paths["output_dir"]
+        figs = []
+        print(f"{len(events)} events, T in [{events['T'].min()}, {events['T'].max()}]")
+
+        fig, ax = plt.subplots(figsize=(10, 5))
+        ax.hist(events["T"], bins=50, color="steelblue")
+        ax.set(xlabel="Time (T)", ylabel="Number of Events", title="Epidemic Curve (COVID Cases Over Time)")
+        figs.append(self.figures.save(fig, "eda_epidemic_curve"))
+
+        fig, ax = plt.subplots(figsize=(10, 5))
+        ax.plot(np.sort(events["T"].values), np.arange(1, len(events) + 1))
+        ax.set(xlabel="Time (T)", ylabel="Cumulative Number of Events")
+        ax.grid(True)
+        figs.append(self.figures.save(fig, "eda_cumulative_events"))
+
+        fig, ax = plt.subplots(figsize=(8, 6))
+        sc = ax.scatter(events["X"], events["Y"], c=events["T"], cmap="viridis", s=4, alpha=0.5)
+        fig.colorbar(sc, ax=ax, label="Time (T)")
+        if self.paths["shapefile"] and os.path.exists(self.paths["shapefile"]):
+            import geopandas as gpd
+            shp = gpd.read_file(self.paths["shapefile"])
+            if shp.crs is None:
+                shp = shp.set_crs(self.config["covariates"]["grid_crs"])
+            shp.to_crs(self.config["covariates"]["crs"]).boundary.plot(ax=ax, color="black", linewidth=0.5)
+        ax.set(xlabel="Longitude (X)", ylabel="Latitude (Y)",
+               title="Spatial Distribution of COVID Cases (colored by Time)")
+        figs.append(self.figures.save(fig, "eda_spatial_scatter"))
+
+        fig, ax = plt.subplots(figsize=(8, 6))
+        h = ax.hist2d(events["X"], events["Y"], bins=50, cmap="hot")
+        fig.colorbar(h[3], ax=ax, label="Events")
+        ax.set(xlabel="Longitude (X)", ylabel="Latitude (Y)")
+        figs.append(self.figures.save(fig, "eda_heatmap"))
+
+        edges = np.linspace(events["T"].min(), events["T"].max(), 5)
+        fig, axs = plt.subplots(1, 4, figsize=(20, 5), sharex=True, sharey=True)
+        for ax, t0, t1 in zip(axs, edges[:-1], edges[1:]):
+            window = events[(events["T"] >= t0) & (events["T"] <= t1)]
+            ax.scatter(window["X"], window["Y"], s=4, alpha=0.5)
+            ax.set_title(f"Day {int(t0)}–{int(t1)}")
+        figs.append(self.figures.save(fig, "eda_time_slices"))
+
+        tables = []
+        if self.paths["covariates"]:
+            from spatial_index import CellIndex, assign_cells
+            names = self.config["covariates"]["columns"]
+            cells = self.spatial_cov
+            index = CellIndex.cached(cells, os.path.join(out, "covariate_cells.idx"))
+            cell_id = assign_cells(events, index, os.path.join(out, "event_cell_ids.npz"))
+            at_events = cells[names].iloc[cell_id[cell_id >= 0]]
+            print(f"{(cell_id >= 0).sum()} of {len(events)} events fall in a covariate cell")
+            summary_file = os.path.join(out, "eda_covariate_summary.csv")
+            at_events.describe().T.to_csv(summary_file)
+            tables.append(summary_file)
+
+            fig, axs = plt.subplots(1, len(names), figsize=(5*len(names), 4), squeeze=False)
+            for ax, name in zip(axs[0], names):
+                cells.plot(column=name, ax=ax, legend=True)
+                ax.set_title(name)
+            figs.append(self.figures.save(fig, "eda_covariate_maps"))
+
+            corr = at_events.corr()
+            fig, ax = plt.subplots(figsize=(6, 5))
+            im = ax.imshow(corr.values, cmap="coolwarm", vmin=-1, vmax=1)
+            ax.set_xticks(range(len(names)), names, rotation=45, ha="right")
+            ax.set_yticks(range(len(names)), names)
+            for (i, j), v in np.ndenumerate(corr.values):
+                ax.text(j, i, f"{v:.2f}", ha="center", va="center")
+            fig.colorbar(im, ax=ax)
+            figs.append(self.figures.save(fig, "eda_covariate_correlation"))
+
+        counts_file = os.path.join(out, "eda_daily_counts.csv")
+        events["T"].round().value_counts().sort_index().rename_axis("T").rename("events").to_csv(counts_file)
+        return figs + tables + [counts_file]
+
+    # --- fit -------------------------------------------------------------------------------------
+
+    @cached_property
+    def fit_jobs(self):
+        from fit_scheduler import FitJob
+        from scalable_models import Minibatch_LGCP_Model, Minibatch_Hawkes_Model
+        fit, cov = self.config["fit"], self.config["covariates"]
+        priors = build_priors(self.config["priors"])
+        common = dict(subsample_size=fit["minibatch_size"], **priors)
+        cov_kwargs = dict(spatial_cov=self.spatial_cov, cov_names=cov["columns"]) if self.paths["covariates"] else {}
+        field = dict(spatial_gp=cov["spatial_gp"], n_xy=cov["n_xy"], num_basis=cov["num_basis"])
+        # the MCMC fits see the mcmc_subset_size subsample, on the domain of the full table
+        builds = {method: {
+            "hawkes": partial(Minibatch_Hawkes_Model, events_df, self.grid_bounds, self.T_max, **common),
+            "lgcp_cov": partial(Minibatch_LGCP_Model, events_gdf, self.grid_bounds, self.T_max,
+                                cov_grid_size=(cov["cov_grid_size"], cov["cov_grid_size"]), **field, **cov_kwargs, **common),
+            "coxhawkes_cov": partial(Minibatch_Hawkes_Model, events_gdf, self.grid_bounds, self.T_max,
+                                     cox_background=True, **field, **cov_kwargs, **common),
+        } for method, events_df, events_gdf in (("svi", self.events_df, self.events_gdf),
+                                                ("mcmc", self.mcmc_events_df, self.mcmc_events_gdf))}
+        early_stopping = (dict(rtol=fit["svi_rtol"], patience=fit["svi_patience"], lr_decay=fit["svi_lr_decay"] or None)
+                          if fit["svi_patience"] else None)
+        fit_kwargs = {
+            "svi": dict(num_steps=fit["svi_steps"], lr=fit["svi_lr"], plot_loss=False, early_stopping=early_stopping),
+            "mcmc": dict(num_warmup=fit["mcmc_warmup"], num_samples=fit["mcmc_samples"],
+                         num_chains=fit["mcmc_chains"]),
+        }
+        for method in fit_kwargs:
+            if fit[f"{method}_checkpoint_every"]:
+                fit_kwargs[method]["checkpoint_every"] = fit[f"{method}_checkpoint_every"]
+        jobs = []
+        for spec in self.config["models"]:
+            name = spec.get("name", f"{MODEL_LABELS[spec['model']]} ({spec['method'].upper()})")
+            out_file = os.path.join(self.paths["output_dir"], f"{spec['model']}_{spec['method']}.nc")
+            job = FitJob(name, builds[spec["method"]][spec["model"]], spec["method"], fit_kwargs[spec["method"]],
+                         out_file=out_file)
+            job.model_type = spec["model"]
+            jobs.append(job)
+        return jobs
+
+    def _posterior_figures(self, job):
+        """Load a finished fit and queue its posterior plots."""
+        from posterior_store import load_results
+        model = job.build()
+        load_results(model, job.out_file)
+        slug = os.path.splitext(os.path.basename(job.out_file))[0]
+        plots = []
+        if model.args["model"] in ("lgcp", "cox_hawkes"):
+            plots.append(("temporal", model.plot_temporal))
+        if "spatial_cov" in model.args:
+            plots.append(("spatial_cov", partial(model.plot_spatial, include_cov=True)))
+        if "alpha" in model.samples:
+            plots += [("trigger_posterior", partial(model.plot_trigger_posterior, trace=False)),
+                      ("prop_excitation", model.plot_prop_excitation)]
+        paths = []
+        for label, plot in plots:
+            paths += self.figures.save_new(plot, f"{slug}_{label}")
+        if job.model_type == "lgcp_cov" and self.config["fit"]["intensity_frames"]:
+            from intensity_surface import posterior_intensity
+            surface = posterior_intensity(model, np.linspace(0, self.T_max, self.config["fit"]["intensity_frames"]),
+                                          resolution=100)
+            paths.append(self.figures.save(surface.plot(events=self.events_df, event_window=7, log=True),
+                                           f"{slug}_intensity"))
+        return paths
+
+    def run_fit(self):
+        from fit_scheduler import FitScheduler, _print_table
+        fit = self.config["fit"]
+        cache_dir = os.path.join(self.paths["output_dir"], "fit_cache")
+        outputs = []
+
+        def on_result(result, table):
+            _print_table(result, table)
+            if "error" in result:
+                return
+            job = next(j for j in self.fit_jobs if j.name == result["name"])
+            outputs.append(job.out_file)
+            try:
+                # plotting runs here while the remaining fits keep their worker processes busy
+                outputs.extend(self._posterior_figures(job))
+            except Exception:
+                print(f"[WARNING] posterior figures of {job.name} failed:\n{traceback.format_exc()}")
+
+        table = FitScheduler(n_workers=fit["workers"], cpus_per_job=fit["cpus_per_fit"] or None, cache_dir=cache_dir,
+                             log_dir=os.path.join(self.paths["output_dir"], "fit_logs")).run(self.fit_jobs,
+                                                                                          on_result=on_result)
+        from fit_cache import FitCache
+        FitCache(cache_dir, max_bytes=int(fit["cache_max_gb"] * 2**30)).evict()
+        table_file = os.path.join(self.paths["output_dir"], "fit_summary.csv")
+        table.drop(columns=["error"], errors="ignore").to_csv(table_file, index=False)
+        failed = table[table["aic"].isna()]["name"].tolist()
+        if failed:
+            raise RuntimeError(f"Fits failed: {failed}; see {os.path.join(self.paths['output_dir'], 'fit_logs')}")
+        return outputs + [table_file]
+
+    # --- compare ---------------------------------------------------------------------------------
+
+    def run_compare(self):
+        from model_comparison import ComparisonJob, compare_models
+        fit, comp = self.config["fit"], self.config["compare"]
+        missing = [job.out_file for job in self.fit_jobs if not os.path.exists(job.out_file)]
+        if missing:
+            raise RuntimeError(f"Missing fit results {missing}; run the fit stage first")
+        # fits on different events are not comparable: with an MCMC subsample, rank each method's fits separately
+        subsampled = len(self.mcmc_events_df) < len(self.events_df)
+        groups = ([[job for job in self.fit_jobs if job.method == method] for method in ("svi", "mcmc")]
+                  if subsampled else [self.fit_jobs])
+        tables = []
+        for fit_jobs in groups:
+            if not fit_jobs:
+                continue
+            jobs = [ComparisonJob(job.name, job.build, job.out_file, num_draws=comp["draws"] or None)
+                    for job in fit_jobs]
+            table = compare_models(jobs, cache_dir=os.path.join(self.paths["output_dir"], "pointwise_cache"),
+                                   n_workers=fit["workers"], cpus_per_job=fit["cpus_per_fit"] or None,
+                                   log_dir=os.path.join(self.paths["output_dir"], "comparison_logs"),
+                                   sort_by=comp["sort_by"])
+            table.insert(1, "n_events", len(self.mcmc_events_df if fit_jobs[0].method == "mcmc" else self.events_df))
+            best = table.iloc[0]
+            print(f"\nBest model by {comp['sort_by']} on {best['n_events']} events: {best['name']} "
+                  f"({comp['sort_by']} = {best[comp['sort_by']]:.2f})")
+            tables.append(table)
+        table_file = os.path.join(self.paths["output_dir"], "model_comparison.csv")
+        pd.concat(tables).drop(columns=["error"], errors="ignore").to_csv(table_file, index=False)
+        return [table_file]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the London COVID analysis headless from a config file.")
+    parser.add_argument("config", help="TOML or YAML config, see london_pipeline.toml")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--force", action="store_true", help="rerun stages whose inputs are unchanged")
+    opts = parser.parse_args()
+    Pipeline(load_config(opts.config), force=opts.force).run(opts.stages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,652 @@
+# -*- coding: utf-8 -*-
+"""
+Minibatched bstpp models for fitting the full event table.
+
+bstpp evaluates the Hawkes triggering sum as a dense [N, N] difference matrix, so
+the cost of every SVI step grows quadratically in the number of events. The models
+here draw a random subsample of B "target" events per step (``numpyro.plate`` with
+``subsample_size``) and evaluate their log-intensity against the full history, which
+is an unbiased estimate of the event term at O(B*N) cost. The integral terms are
+O(N) and are always evaluated exactly. Full-batch evaluations (subsample_size=None and
+run_mcmc, since NUTS needs the exact likelihood) sum the kernel in blocks of ROW_BLOCK
+events, so their memory is O(ROW_BLOCK*N) rather than O(N^2); their time is still
+O(N^2) per gradient.
+
+The posterior target is the same as bstpp's (including its two identical factor
+sites), so expected AIC values remain comparable with the dense fits.
+
+With args['pointwise'] set, the models also record the log-intensity of the events in
+the current batch as a 'log_lambda' site, for the pointwise log-likelihoods of
+model_comparison.py.
+
+The integral helpers accept an optional args['t_window'] = (t0, t1) in rescaled time,
+restricting the likelihood to events and intensity in (t0, t1]; this is used by
+incremental_hawkes.py. Without it they integrate over [0, T] as bstpp does.
+
+With args['event_weight'] set, each row of the event arrays stands for that many events
+(the weight_col of the constructors, or the LGCP bins of binned_likelihood.py), and the
+triggering sums and the excitation integral count every row with its weight. The LGCP
+events of a row share its intensity. The Hawkes events of a row are the consecutive rows
+of bstpp's point-level table: each is excited by all earlier rows, including earlier rows
+at the same time, and by the events of its own row before it (see tied_log_lambda), so
+the weighted Hawkes likelihood equals the point-level one.
+"""
+
+import copy
+import os
+import time
+
+import numpy as np
+import matplotlib.pyplot as plt
+import tqdm
+import jax
+import jax.numpy as jnp
+from jax import random
+from jax.example_libraries.optimizers import inverse_time_decay
+import numpyro
+import numpyro.distributions as dist
+from numpyro.infer import SVI, Trace_ELBO, Predictive, MCMC, NUTS, init_to_median
+from numpyro.infer.svi import SVIRunResult
+from numpyro.infer.autoguide import AutoMultivariateNormal
+
+from bstpp.main import LGCP_Model, Hawkes_Model
+from bstpp.vae_functions import vae_decoder_temporal, vae_decoder_spatial
+
+import fit_telemetry
+from binned_likelihood import bin_events
+from lowrank_gp import SPATIAL_GPS, VAE_N_XY, hsgp_spatial_field, use_lowrank_gp
+from svi_convergence import ConvergenceMonitor
+
+# events per block of the exact (full-batch) triggering sums, see blocked_triggering_sum
+ROW_BLOCK = 256
+
+# per-event (and per-pair) entries of args; the jitted SVI step takes them as arguments, so its
+# program depends on their shapes only, and the event axis is the last axis of each
+EVENT_ARRAYS = ('t_events', 'xy_events', 'indices_t', 'indices_xy', 'cov_ind', 'event_weight',
+                'pair_i', 'pair_dt', 'pair_dxy', 'pair_w')
+
+
+def _window(args):
+    return args.get('t_window', (0., args['T']))
+
+
+def _event_weight(args):
+    """Events represented by each row of the event arrays, or None for one each."""
+    w = args.get('event_weight')
+    return None if w is None else jnp.asarray(w, dtype=jnp.float32)
+
+
+def _weighted_sum(args, values, idx):
+    w = _event_weight(args)
+    return jnp.sum(values) if w is None else jnp.sum(w[idx]*values)
+
+
+def _bin_weights(args):
+    """Length of the overlap of each temporal GP bin with the likelihood window."""
+    t0, t1 = _window(args)
+    edges = np.asarray(args["x_t"])
+    width = args["T"]/args["n_t"]
+    return np.clip(np.minimum(edges + width, t1) - np.maximum(edges, t0), 0., None)
+
+
+def lgcp_background(args):
+    """
+    Sample the Gaussian process background shared by the 'lgcp' and 'cox_hawkes' models.
+
+    Returns
+    -------
+    Itot_t: float
+        integral of the temporal rate over [0, T]
+    Itot_xy: float
+        integral of the spatial rate over the domain
+    log_mu: function
+        maps an array of event indices to the log background intensity at those events
+    """
+    a_0 = numpyro.sample("a_0", args['priors']['a_0'])
+
+    z_temporal = numpyro.sample("z_temporal", args['priors'].get(
+        "z_temporal", dist.Normal(jnp.zeros(args["z_dim_temporal"]), jnp.ones(args["z_dim_temporal"]))))
+    decoder_nn_temporal = vae_decoder_temporal(args["hidden_dim_temporal"], args["n_t"])
+    v_t = numpyro.deterministic("v_t", decoder_nn_temporal[1](args["decoder_params_temporal"], z_temporal))
+    f_t = numpyro.deterministic("f_t", v_t[0:args["n_t"]])
+    rate_t = numpyro.deterministic("rate_t", jnp.exp(f_t + a_0))
+    if 't_window' in args:
+        Itot_t = numpyro.deterministic("Itot_t", rate_t @ _bin_weights(args))
+    else:
+        Itot_t = numpyro.deterministic("Itot_t", jnp.sum(rate_t)/args["n_t"]*args["T"])
+
+    if args.get('spatial_gp') == 'hsgp':
+        f_xy = numpyro.deterministic("f_xy", hsgp_spatial_field(args))
+    else:
+        z_spatial = numpyro.sample("z_spatial", args['priors'].get(
+            "z_spatial", dist.Normal(jnp.zeros(args["z_dim_spatial"]), jnp.ones(args["z_dim_spatial"]))))
+        decoder_nn = vae_decoder_spatial(args["hidden_dim2_spatial"], args["hidden_dim1_spatial"], args["n_xy"])
+        f_xy = numpyro.deterministic("f_xy", jnp.exp(args['sp_var_mu']) *
+                                     decoder_nn[1](args["decoder_params_spatial"], z_spatial))
+    rate_xy = numpyro.deterministic("rate_xy", jnp.exp(f_xy))
+
+    indices_t = jnp.asarray(args["indices_t"])
+    indices_xy = jnp.asarray(args["indices_xy"])
+    if 'spatial_cov' in args:
+        w = numpyro.sample("w", args['priors']['w'])
+        b_0 = numpyro.deterministic("b_0", args['spatial_cov'] @ w)
+        cov_ind = jnp.asarray(args['cov_ind'])
+        spatial_integral = jnp.exp(b_0[args['int_df']['cov_ind'].values] +
+                                   f_xy[args['int_df']['comp_grid_id'].values]
+                                   ) @ args['int_df']['area'].values
+
+        def log_mu(idx):
+            return a_0 + f_t[indices_t[idx]] + f_xy[indices_xy[idx]] + b_0[cov_ind[idx]]
+    else:
+        spatial_integral = jnp.sum(rate_xy[args['spatial_grid_cells']])/args['n_xy']**2
+
+        def log_mu(idx):
+            return a_0 + f_t[indices_t[idx]] + f_xy[indices_xy[idx]]
+    Itot_xy = numpyro.deterministic("Itot_xy", spatial_integral)
+    return Itot_t, Itot_xy, log_mu
+
+
+def constant_background(args):
+    """
+    Sample the log-linear background of the plain 'hawkes' model.
+
+    Returns
+    -------
+    Itot_txy_back: float
+        integral of the background over the space-time window
+    log_mu: function
+        maps an array of event indices to the log background intensity at those events
+    """
+    a_0 = numpyro.sample("a_0", args['priors']['a_0'])
+    t0, t1 = _window(args)
+    if 'spatial_cov' in args:
+        w = numpyro.sample("w", args['priors']['w'])
+        b_0 = numpyro.deterministic("b_0", args['spatial_cov'] @ w)
+        mu_xyt = numpyro.deterministic("mu_xyt", jnp.exp(a_0 + b_0))
+        Itot_txy_back = numpyro.deterministic("Itot_txy_back", mu_xyt @ args['cov_area']*(t1 - t0))
+        cov_ind = jnp.asarray(args['cov_ind'])
+
+        def log_mu(idx):
+            return a_0 + b_0[cov_ind[idx]]
+    else:
+        mu_xyt = numpyro.deterministic("mu_xyt", jnp.exp(a_0))
+        Itot_txy_back = numpyro.deterministic("Itot_txy_back", mu_xyt*(t1 - t0)*args['A_area'])
+
+        def log_mu(idx):
+            return jnp.broadcast_to(a_0, idx.shape)
+    return Itot_txy_back, log_mu
+
+
+def triggering_sum(args, t_pars, sp_pars, idx):
+    """
+    Sum the (unscaled) triggering kernel over all events preceding each event in idx.
+
+    Events must be sorted by time; "preceding" follows bstpp and means a lower row index.
+    Weighted rows (args['event_weight']) count with their weight. Memory and compute are
+    O(len(idx) * N).
+
+    Returns
+    -------
+    jax numpy [len(idx)]
+    """
+    t_events = jnp.asarray(args["t_events"])
+    xy_events = jnp.asarray(args["xy_events"])
+    N = t_events.shape[0]
+    w = _event_weight(args)
+    prior = jnp.arange(N)[None, :] < idx[:, None]
+    # zero the differences of non-preceding pairs so the kernels stay finite under autodiff
+    T_diff = jnp.where(prior, t_events[idx][:, None] - t_events[None, :], 0.)
+    S_diff = jnp.where(prior, xy_events[:, idx][:, :, None] - xy_events[:, None, :], 0.)
+    trig = args['t_trig'].compute_trigger(t_pars, T_diff)*args['sp_trig'].compute_trigger(sp_pars, S_diff)
+    if w is not None:
+        trig = trig*w[None, :]
+    return jnp.sum(jnp.where(prior, trig, 0.), axis=1)
+
+
+def blocked_triggering_sum(args, t_pars, sp_pars, idx, block=None):
+    """
+    triggering_sum over row blocks of idx, in O(block * N) memory.
+
+    The blocks run one after another in lax.map, and each is rematerialized in the backward
+    pass, so neither the sums nor their gradients hold the [len(idx), N] kernel matrix.
+    Used for the exact likelihood of run_mcmc and of full-batch evaluations.
+    """
+    block = block or args.get('row_block', ROW_BLOCK)
+    n = idx.shape[0]
+    if n <= block:
+        return triggering_sum(args, t_pars, sp_pars, idx)
+    # pad with row 0, which no row precedes, and drop the padding afterwards
+    rows = jnp.concatenate([idx, jnp.zeros((-n) % block, dtype=idx.dtype)]).reshape(-1, block)
+    sums = jax.lax.map(jax.checkpoint(lambda r: triggering_sum(args, t_pars, sp_pars, r)), rows)
+    return sums.reshape(-1)[:n]
+
+
+def tied_log_lambda(args, lam, alpha, t_pars, sp_pars, idx):
+    """
+    Log-intensities of the events of the weighted rows idx, [len(idx), max event weight].
+
+    lam is the intensity at the first event of each row: background plus the excitation
+    by all earlier rows. Each further event of a row is also excited by the ones before it,
+    at zero time and distance, so its k-th event has intensity lam + k*alpha*g(0)*h(0),
+    as in bstpp's point-level likelihood with the row repeated. Entries past a row's
+    weight are 0, so summing a row gives the log-likelihood of all of its events.
+    """
+    w = _event_weight(args)[idx]
+    k = jnp.arange(args['max_weight'], dtype=jnp.float32)
+    trig_0 = (args['t_trig'].compute_trigger(t_pars, jnp.zeros(1)) *
+              args['sp_trig'].compute_trigger(sp_pars, jnp.zeros((2, 1))))
+    tied = k[None, :] < w[:, None]
+    return jnp.where(tied, jnp.log(lam[:, None] + alpha*trig_0*k[None, :]), 0.)
+
+
+def excitation_integral(args, alpha, t_pars, sp_pars):
+    """Integral of the self-exciting component over the window, exact and O(N)."""
+    t_events = args["t_events"]
+    xy_events = args["xy_events"]
+    t0, t1 = _window(args)
+    temp_part = alpha*args['t_trig'].compute_integral(t_pars, t1-t_events)
+    if 't_window' in args:
+        # events before the window only contribute the part of their kernel that falls inside it
+        temp_part = temp_part - alpha*args['t_trig'].compute_integral(t_pars, jnp.maximum(t0-t_events, 0.))
+    sp_limits = jnp.stack((args['x_max']-xy_events[0], xy_events[0]-args['x_min'],
+                           args['y_max']-xy_events[1], xy_events[1]-args['y_min'])
+                          ).reshape(2, 2, -1)
+    sp_part = args['sp_trig'].compute_integral(sp_pars, sp_limits)
+    return numpyro.deterministic("Itot_excite", _weighted_sum(args, temp_part*sp_part, slice(None)))
+
+
+def minibatch_hawkes_model(args):
+    """
+    bstpp's spatiotemporal_hawkes_model with a subsampled event term.
+
+    args['subsample_size'] sets the number of events per step; None evaluates all of
+    them, which reproduces the dense likelihood.
+    """
+    N = args["t_events"].shape[0]
+    if args['model'] == 'hawkes':
+        Itot_txy_back, log_mu = constant_background(args)
+    else:
+        Itot_t, Itot_xy, log_mu = lgcp_background(args)
+        Itot_txy_back = numpyro.deterministic("Itot_txy_back", Itot_t*Itot_xy)
+
+    alpha = numpyro.sample("alpha", args['priors']['alpha'])
+    t_pars = args['t_trig'].sample_parameters()
+    sp_pars = args['sp_trig'].sample_parameters()
+
+    with numpyro.plate("events", N, subsample_size=args.get('subsample_size')) as idx:
+        lam = alpha*blocked_triggering_sum(args, t_pars, sp_pars, idx) + jnp.exp(log_mu(idx))
+        if 'event_weight' in args:
+            log_lambda = tied_log_lambda(args, lam, alpha, t_pars, sp_pars, idx)
+        else:
+            log_lambda = jnp.log(lam)
+        if args.get('pointwise'):
+            numpyro.deterministic('log_lambda', log_lambda)
+        ell_batch = jnp.sum(log_lambda)
+    ell_1 = numpyro.deterministic('ell_1', ell_batch*N/idx.shape[0])
+
+    Itot_excite = excitation_integral(args, alpha, t_pars, sp_pars)
+    Itot_txy = numpyro.deterministic("Itot_txy", Itot_excite + Itot_txy_back)
+    loglik = numpyro.deterministic('loglik', ell_1 - Itot_txy)
+
+    numpyro.factor("t_events", loglik)
+    numpyro.factor("xy_events", loglik)
+
+
+def minibatch_LGCP_model(args):
+    """bstpp's spatiotemporal_LGCP_model with a subsampled event term."""
+    N = args["t_events"].shape[0]
+    Itot_t, Itot_xy, log_mu = lgcp_background(args)
+
+    with numpyro.plate("events", N, subsample_size=args.get('subsample_size')) as idx:
+        log_lambda = log_mu(idx)
+        if args.get('pointwise'):
+            numpyro.deterministic('log_lambda', log_lambda)
+        ell_batch = _weighted_sum(args, log_lambda, idx)
+    I_tot_txy = numpyro.deterministic("I_tot_txy", Itot_xy*Itot_t)
+    loglik = numpyro.deterministic("loglik", ell_batch*N/idx.shape[0] - I_tot_txy)
+
+    numpyro.factor("t_events", loglik)
+    numpyro.factor("xy_events", loglik)
+
+
+class _Minibatch_Mixin:
+
+    def _set_spatial_gp(self, spatial_gp, n_xy, num_basis):
+        if spatial_gp not in SPATIAL_GPS:
+            raise ValueError(f"Unknown spatial_gp {spatial_gp!r}; expected one of {SPATIAL_GPS}")
+        if spatial_gp == "hsgp":
+            use_lowrank_gp(self, n_xy, num_basis)
+        elif n_xy != VAE_N_XY:
+            raise ValueError(f"The VAE spatial field is trained on a {VAE_N_XY} x {VAE_N_XY} grid; "
+                             "use spatial_gp='hsgp' for other grid sizes")
+
+    def _set_event_weight(self, weight_col):
+        if weight_col is None:
+            return
+        w = self.data[weight_col].to_numpy()
+        if (w < 1).any() or (w != np.round(w)).any():
+            raise ValueError(f"Event weights in column {weight_col!r} must be positive integer counts")
+        self.args['event_weight'] = w.astype(np.int64)
+        self.args['num_events'] = int(w.sum())
+        # static width of the per-event log-intensities of the Hawkes models, see tied_log_lambda
+        self.args['max_weight'] = int(w.max())
+
+    def _set_binned(self, binned):
+        if not binned:
+            return
+        self.event_bin = bin_events(self)
+        self.num_bins = len(self.args['event_weight'])
+        self.compression = self.args['num_events']/self.num_bins
+        if self.args['subsample_size'] is not None and self.args['subsample_size'] >= self.num_bins:
+            self.args['subsample_size'] = None
+
+    def get_params(self):
+        pars = super().get_params()
+        if self.args.get('spatial_gp') == 'hsgp':
+            pars['ell_xy'] = 1
+            pars['var_xy'] = 1
+        return pars
+
+    def log_expected_likelihood(self, data):
+        """
+        Same as Point_Process_Model.log_expected_likelihood, also for weighted and binned fits.
+
+        bstpp rescales the test events into a copy of self.args, which would keep the training
+        rows' weights and bins and the SVI subsample. They are left out here, so the test
+        events are evaluated one row per event on the full-batch likelihood.
+        """
+        saved = {k: self.args.pop(k) for k in ('event_weight', 'num_events', 'binned', 'subsample_size')
+                 if k in self.args}
+        try:
+            return super().log_expected_likelihood(data)
+        finally:
+            self.args.update(saved)
+
+    def run_svi(self, num_steps, lr, num_samples=1000, resume=False, plot_loss=True,
+                auto_guide=AutoMultivariateNormal, init_strategy=init_to_median, init_params=None,
+                early_stopping=None, checkpoint=None, checkpoint_every=1000, resume_checkpoint=True):
+        """
+        Same as Point_Process_Model.run_svi, but posterior samples are drawn one at a time.
+
+        bstpp vectorizes Predictive over all draws, which would hold num_samples
+        [N, N] kernel matrices in memory at once. The draws evaluate the full likelihood
+        (subsample_size=None), so the stored 'loglik' and the expected AIC are exact rather
+        than minibatch estimates. init_params optionally
+        sets the starting guide parameters (e.g. svi_results.params of an earlier fit).
+        early_stopping is a dict of ConvergenceMonitor settings (see svi_convergence.py);
+        num_steps is then an upper bound and the report is stored as self.svi_convergence.
+        With a checkpoint file, the optimizer state is saved every checkpoint_every steps
+        and a rerun continues from it (see fit_checkpoint.py).
+        """
+        rng_key, rng_key_predict = random.split(random.PRNGKey(10))
+        rng_key, rng_key_post, rng_key_pred = random.split(rng_key, 3)
+        self.args["num_samples"] = num_samples
+        start = time.time()
+        update, svi_state = self._svi_update(rng_key, num_steps, lr, resume, auto_guide, init_strategy, init_params)
+        telemetry = fit_telemetry.active()
+        if telemetry is not None:
+            telemetry.phase("svi_init")
+            telemetry.update(num_particles=self.svi.loss.num_particles)
+        monitor = ConvergenceMonitor(num_steps, **early_stopping) if early_stopping else None
+        self.svi_convergence = None
+        losses = []
+        if checkpoint is not None:
+            from fit_cache import fit_key
+            from fit_checkpoint import load_checkpoint, save_checkpoint
+            fingerprint = fit_key(self, "svi", num_steps=num_steps, lr=lr, resume=resume, auto_guide=auto_guide,
+                                  init_strategy=init_strategy, init_params=init_params, early_stopping=early_stopping)
+            ckpt = load_checkpoint(checkpoint, fingerprint) if resume_checkpoint else None
+            if ckpt is not None:
+                treedef = jax.tree_util.tree_structure(svi_state)
+                svi_state = jax.tree_util.tree_unflatten(treedef, ckpt["state"])
+                losses = list(ckpt["losses"])
+                if monitor is not None:
+                    monitor = ckpt["monitor"]
+                    if monitor.best_state is not None:
+                        monitor.best_state = jax.tree_util.tree_unflatten(treedef, monitor.best_state)
+                if ckpt["lr"] != lr:
+                    lr = ckpt["lr"]
+                    self.svi.optim = self._svi_optimizer(lr, num_steps)
+                    update = self._svi_step()
+                print(f"[RESUMED] SVI from {checkpoint} at step {len(losses)} of {num_steps}")
+        events = self._event_arrays()
+        loop_start, start_step = time.time(), len(losses)
+        stopped = monitor is not None and monitor.stopped_step is not None
+        with tqdm.trange(start_step + 1, num_steps + 1 if not stopped else start_step + 1) as t:
+            batch = max(num_steps // 20, 1)
+            for i in t:
+                svi_state, loss = update(svi_state, events)
+                losses.append(loss)
+                if telemetry is not None:
+                    # per-step timing needs each step to finish before the next is dispatched
+                    telemetry.svi_step(loss.block_until_ready())
+                if i % batch == 0:
+                    recent = np.asarray(losses[i - batch:])
+                    t.set_postfix_str(f"init loss: {losses[0]:.4f}, avg. loss [{i - batch + 1}-{i}]: "
+                                      f"{np.nanmean(recent) if np.isfinite(recent).any() else np.nan:.4f}",
+                                      refresh=False)
+                if monitor is not None and i % monitor.check_every == 0:
+                    action = monitor.check(i, losses, svi_state)
+                    if action == "decay":
+                        lr *= monitor.lr_decay
+                        self.svi.optim = self._svi_optimizer(lr, num_steps)
+                        update = self._svi_step()
+                    stopped = action == "stop"
+                if checkpoint is not None and (i % checkpoint_every == 0 or i == num_steps or stopped):
+                    saved_monitor = copy.copy(monitor)
+                    if monitor is not None and monitor.best_state is not None:
+                        saved_monitor.best_state = jax.tree_util.tree_leaves(monitor.best_state)
+                    save_checkpoint(checkpoint, fingerprint, state=jax.tree_util.tree_leaves(svi_state),
+                                    losses=np.asarray(losses), lr=lr, monitor=saved_monitor)
+                if stopped:
+                    break
+        if monitor is not None:
+            if monitor.restore_best and monitor.best_state is not None:
+                svi_state = monitor.best_state
+            # steps restored from a checkpoint are assumed to have taken as long as the ones run here
+            loop_s = (time.time() - loop_start)*len(losses)/max(len(losses) - start_step, 1)
+            self.svi_convergence = monitor.report(len(losses), loop_s)
+            print(f"[CONVERGENCE] {monitor.format(self.svi_convergence)}")
+        self.svi_results = SVIRunResult(self.svi.get_params(svi_state), svi_state, jnp.stack(losses))
+        if telemetry is not None:
+            telemetry.phase("optimization", steps=len(losses))
+            if self.svi_convergence is not None:
+                telemetry.update(**{k: self.svi_convergence[k] for k in ("steps_saved", "seconds_saved", "best_step")})
+        sites = list(self.get_params().keys())+['loglik', 'Itot_excite', 'Itot_txy']
+        predictive = Predictive(self.model, guide=self.svi.guide, params=self.svi_results.params,
+                                return_sites=sites, num_samples=num_samples, parallel=False)
+        print("Sampling Posterior...")
+        # draws use the exact likelihood like run_mcmc, not the minibatch estimate of the steps
+        self.samples = predictive(rng_key, args=dict(self.args, subsample_size=None))
+        if telemetry is not None:
+            telemetry.phase("posterior_samples", num_samples=num_samples)
+        print("\nSVI elapsed time:", time.time() - start)
+        if plot_loss:
+            loss = np.asarray(self.svi_results.losses)
+            plt.plot(np.arange(int(.01*len(loss)), len(loss)), loss[int(.01*len(loss)):])
+            plt.xlabel("Iterations")
+            plt.ylabel("Loss")
+            plt.show()
+
+    def _svi_update(self, rng_key, num_steps, lr, resume, auto_guide, init_strategy, init_params):
+        """
+        Set up self.svi and return the jitted SVI step with its initial state.
+
+        The loop of SVI.run, with the step built here rather than inside numpyro, so that
+        compile_svi compiles exactly the program run_svi executes.
+        """
+        optimizer = self._svi_optimizer(lr, num_steps)
+        if resume:
+            self.svi.optim = optimizer
+            svi_state = self.svi_results.state
+        else:
+            guide = auto_guide(self.model, init_loc_fn=init_strategy)
+            self.svi = SVI(self.model, guide, optimizer, loss=Trace_ELBO())
+            svi_state = self.svi.init(rng_key, self.args, init_params=init_params)
+        return self._svi_step(), svi_state
+
+    @staticmethod
+    def _svi_optimizer(lr, num_steps):
+        return numpyro.optim.Adam(inverse_time_decay(lr, num_steps, 4))
+
+    def _event_arrays(self):
+        """The EVENT_ARRAYS entries of self.args, as jax arrays."""
+        return {k: jnp.asarray(self.args[k]) for k in EVENT_ARRAYS if self.args.get(k) is not None}
+
+    def _svi_step(self):
+        """
+        Jitted SVI step (svi_state, events) with the current self.svi.optim; the Adam state carries over when it changes.
+
+        Only the static entries of self.args (grid, priors, decoder weights, settings) are
+        closed over and become constants of the program. The event arrays (_event_arrays) are
+        arguments, so a refit on other events of the same count runs the same program.
+        """
+        svi = self.svi
+        static = {k: v for k, v in self.args.items() if k not in EVENT_ARRAYS}
+
+        def svi_step(svi_state, events):
+            return svi.stable_update(svi_state, dict(static, **events))
+        return jax.jit(svi_step)
+
+    def compile_svi(self, num_steps, lr, resume=False, auto_guide=AutoMultivariateNormal,
+                    init_strategy=init_to_median, init_params=None, num_events=None, **kwargs):
+        """
+        Compile the SVI step of run_svi with the same arguments, without running it.
+
+        The step is lowered from the shapes and dtypes of its inputs only (no data), so
+        num_events can ask for the program of a table with another number of events, e.g.
+        tomorrow's. With a persistent compilation cache (compile_cache.py) the program is
+        stored on disk and later run_svi calls with the same settings and event count load
+        it instead of compiling. Remaining run_svi arguments (num_samples, plot_loss,
+        early_stopping, checkpointing) are ignored; steps after a learning-rate decay are compiled by the run.
+
+        Returns
+        -------
+        dict: shape of each event array the program was compiled for
+        """
+        rng_key, _ = random.split(random.PRNGKey(10))
+        rng_key, _, _ = random.split(rng_key, 3)
+        update, svi_state = self._svi_update(rng_key, num_steps, lr, resume, auto_guide, init_strategy, init_params)
+        events = self._event_arrays()
+        if num_events is not None:
+            if any(k.startswith('pair_') for k in events):
+                raise ValueError("The pair list length of a truncated model is not set by num_events")
+            events = {k: jnp.empty(v.shape[:-1] + (num_events,), v.dtype) for k, v in events.items()}
+        shapes = jax.tree_util.tree_map(lambda x: jax.ShapeDtypeStruct(x.shape, x.dtype), (svi_state, events))
+        update.lower(*shapes).compile()
+        return {k: v.shape for k, v in events.items()}
+
+    def run_mcmc(self, batch_size=1, num_warmup=500, num_samples=1000, num_chains=1, thinning=1,
+                 checkpoint=None, checkpoint_every=100, resume_checkpoint=True):
+        """
+        Same as Point_Process_Model.run_mcmc, on the exact likelihood.
+
+        NUTS is not valid on a stochastic log density, so subsampling is switched off.
+        Warmup and sampling run as two calls, which draws the same samples as bstpp's
+        single mcmc.run, so that fit_telemetry can time each phase and count its leapfrog steps.
+        With a checkpoint file, they run in chunks of checkpoint_every iterations with the
+        sampler state and draws saved after each, and a rerun continues from the last chunk
+        (see fit_checkpoint.py).
+        """
+        subsample_size = self.args.pop('subsample_size', None)
+        try:
+            self.args.update(batch_size=batch_size, num_warmup=num_warmup, num_samples=num_samples,
+                             num_chains=num_chains, thinning=thinning)
+            rng_key, rng_key_predict = random.split(random.PRNGKey(10))
+            rng_key, rng_key_post, rng_key_pred = random.split(rng_key, 3)
+            start = time.time()
+            kernel = NUTS(self.model, init_strategy=init_to_median(num_samples=10))
+            self.mcmc = MCMC(kernel, num_warmup=num_warmup, num_samples=num_samples, num_chains=num_chains,
+                             thinning=thinning, progress_bar="NUMPYRO_SPHINXBUILD" not in os.environ)
+            telemetry = fit_telemetry.active()
+            if telemetry is not None:
+                telemetry.mark()
+            if checkpoint is not None:
+                from fit_cache import fit_key
+                from fit_checkpoint import run_mcmc_checkpointed
+                fingerprint = fit_key(self, "mcmc", num_warmup=num_warmup, num_samples=num_samples,
+                                      num_chains=num_chains, thinning=thinning)
+                run_mcmc_checkpointed(self.mcmc, rng_key_post, self.args, checkpoint, fingerprint, checkpoint_every,
+                                      resume=resume_checkpoint, extra_fields=("num_steps",), telemetry=telemetry)
+            else:
+                self.mcmc.warmup(rng_key_post, self.args, extra_fields=("num_steps",), collect_warmup=True)
+                if telemetry is not None:
+                    telemetry.mcmc_phase("warmup", self.mcmc.get_extra_fields()["num_steps"])
+                self.mcmc.run(self.mcmc.post_warmup_state.rng_key, self.args, extra_fields=("num_steps",))
+                if telemetry is not None:
+                    telemetry.mcmc_phase("sampling", self.mcmc.get_extra_fields()["num_steps"])
+            self.mcmc.print_summary()
+            print("\nMCMC elapsed time:", time.time() - start)
+            self.samples = self.mcmc.get_samples()
+        finally:
+            self.args['subsample_size'] = subsample_size
+
+
+class Minibatch_Hawkes_Model(_Minibatch_Mixin, Hawkes_Model):
+    def __init__(self, data, A, T, subsample_size=512, spatial_gp="vae", n_xy=VAE_N_XY, num_basis=20,
+                 weight_col=None, **kwargs):
+        """
+        Hawkes / Cox-Hawkes model whose SVI steps use a random subsample of events.
+
+        Parameters
+        ----------
+        data, A, T: see Hawkes_Model
+        subsample_size: int or None
+            Number of events in each SVI minibatch. None uses all events.
+        spatial_gp: str
+            Spatial field of the Cox background: 'vae' (bstpp's pretrained decoder, 25 x 25 grid
+            only) or 'hsgp' (the reduced-rank GP of lowrank_gp.py).
+        n_xy: int
+            Computational grid cells per side.
+        num_basis: int
+            Basis functions per axis of the 'hsgp' field.
+        weight_col: str or None
+            Column of data holding the number of events each row stands for, e.g. the 'weight'
+            of event_store.collapse_duplicates. The likelihood is that of the table with each
+            row repeated weight times, evaluated once per row.
+        kwargs: dict
+            parameters from Hawkes_Model
+        """
+        if kwargs.pop('binned', False):
+            raise ValueError("binned=True is only exact for the LGCP; collapse identical events with "
+                             "event_store.collapse_duplicates and weight_col for the Hawkes models")
+        super().__init__(data, A, T, **kwargs)
+        self.model = minibatch_hawkes_model
+        self.args['subsample_size'] = subsample_size
+        self._set_spatial_gp(spatial_gp, n_xy, num_basis)
+        self._set_event_weight(weight_col)
+
+
+class Minibatch_LGCP_Model(_Minibatch_Mixin, LGCP_Model):
+    def __init__(self, data, A, T, subsample_size=512, spatial_gp="vae", n_xy=VAE_N_XY, num_basis=20,
+                 weight_col=None, binned=False, **kwargs):
+        """
+        LGCP model whose SVI steps use a random subsample of events.
+
+        Parameters
+        ----------
+        data, A, T: see Point_Process_Model
+        subsample_size: int or None
+            Number of events in each SVI minibatch. None uses all events.
+        spatial_gp: str
+            Spatial field: 'vae' (bstpp's pretrained decoder, 25 x 25 grid only) or 'hsgp'
+            (the reduced-rank GP of lowrank_gp.py).
+        n_xy: int
+            Computational grid cells per side.
+        num_basis: int
+            Basis functions per axis of the 'hsgp' field.
+        weight_col: str or None
+            Column of data holding the number of events each row stands for, e.g. the 'weight'
+            of event_store.collapse_duplicates. Each row is evaluated once, counted weight times.
+        binned: bool
+            Evaluate the likelihood once per temporal GP bin, grid cell and covariate cell
+            holding events, weighted by their counts (exact; see binned_likelihood.py).
+        kwargs: dict
+            parameters from Point_Process_Model
+        """
+        super().__init__(data, A, T, **kwargs)
+        self.model = minibatch_LGCP_model
+        self.args['subsample_size'] = subsample_size
+        self._set_spatial_gp(spatial_gp, n_xy, num_basis)
+        self._set_event_weight(weight_col)
+        self._set_binned(binned)
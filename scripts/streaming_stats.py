@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""
+Single-pass descriptive statistics of event files larger than memory.
+
+london_covid_descriptive_analysis.py used to draw the epidemic curve, the cumulative
+count (np.sort of all times), the autocorrelation of the sorted times, the 2D histogram
+and the seaborn KDE from one in-memory DataFrame. EventStatistics produces the same
+figures from chunks of the event file (event_store.iter_events), keeping only:
+
+- a fine time histogram and a fine X/Y histogram (StreamingHistogram). Their bins
+  double in width whenever the data outgrow max_bins, so the memory is fixed and
+  quantiles and the cumulative curve are accurate to one fine bin. Each fine bin also
+  keeps the smallest value it received, and the coarser plotting bins place it by that
+  value, so they equal np.histogram / np.histogram2d of the raw events unless a fine
+  bin holds values on both sides of a plotting edge (never for the bundled data, whose
+  times are whole days and locations area centroids; see --check)
+- event counts per covariate cell (spatial_index.CellIndex), from which the covariate
+  summaries and correlations at the event locations are computed exactly
+- a seeded uniform reservoir sample of sample_size events for the point maps, PCA and
+  clustering, in place of events_df.sample
+
+The KDE is a binned Gaussian KDE on the X/Y histogram, with scipy's Scott bandwidth
+computed from the binned variances, drawn at seaborn's iso-proportion levels.
+
+    python streaming_stats.py ../datasets/london_covid_events.csv --chunk-rows 2000000 --out events_stats.pkl
+    python streaming_stats.py ../datasets/london_covid_events.csv --check
+
+    stats = EventStatistics.from_chunks(iter_events(EVENTS_PATH, store_dir=OUTPUT_DIR), cell_index=cell_index)
+    stats.plot_epidemic_curve(bins=50)
+    stats.covariate_summary(covariates_gdf, ["popdensity", "covid_deaths"])
+"""
+
+import argparse
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+
+class StreamingHistogram:
+    def __init__(self, ndim=1, max_bins=4096):
+        """
+        Histogram over an unknown range with at most max_bins bins per axis.
+
+        Bin b of an axis covers [b*width, (b+1)*width). When new values need more than
+        max_bins bins, the width doubles and pairs of bins are merged, which is exact
+        because bin boundaries stay multiples of the width. The smallest value of each
+        axis seen in each bin is kept next to the counts, for rebin.
+
+        Parameters
+        ----------
+        ndim: int
+        max_bins: int
+            Bins per axis; the memory is max_bins**ndim counts.
+        """
+        self.ndim = ndim
+        self.max_bins = max_bins
+        self.width = None
+        self.lo = None
+        self.counts = None
+        self.low = None
+        self.min = np.full(ndim, np.inf)
+        self.max = np.full(ndim, -np.inf)
+        self.n = 0
+        self.dropped = 0
+
+    def update(self, *values):
+        """Add one coordinate array per axis; rows with a non-finite coordinate are dropped."""
+        values = [np.asarray(v, dtype=float) for v in values]
+        keep = np.logical_and.reduce([np.isfinite(v) for v in values])
+        self.dropped += int((~keep).sum())
+        values = [v[keep] for v in values]
+        if not len(values[0]):
+            return self
+        self.min = np.minimum(self.min, [v.min() for v in values])
+        self.max = np.maximum(self.max, [v.max() for v in values])
+        if self.width is None:
+            # start at half of max_bins over the first chunk's range, leaving room to grow
+            span = self.max - self.min
+            self.width = np.where(span > 0, span/(self.max_bins//2), np.maximum(np.abs(self.max), 1.)/self.max_bins)
+            self.lo = np.floor(self.min/self.width).astype(np.int64)
+            self.counts = np.zeros((1,)*self.ndim, dtype=np.int64)
+            self.low = np.full((self.ndim,) + (1,)*self.ndim, np.inf)
+        idx = [np.floor(v/w).astype(np.int64) for v, w in zip(values, self.width)]
+        for axis in range(self.ndim):
+            lo = min(self.lo[axis], idx[axis].min())
+            hi = max(self.lo[axis] + self.counts.shape[axis] - 1, idx[axis].max())
+            while hi - lo + 1 > self.max_bins:
+                self._coarsen(axis)
+                idx[axis] //= 2
+                lo, hi = lo//2, hi//2
+            self._extend(axis, lo, hi)
+            idx[axis] -= self.lo[axis]
+        flat = np.ravel_multi_index(idx, self.counts.shape)
+        self.counts += np.bincount(flat, minlength=self.counts.size).reshape(self.counts.shape)
+        for axis, v in enumerate(values):
+            np.minimum.at(self.low[axis].reshape(-1), flat, v)
+        self.n += len(flat)
+        return self
+
+    def _coarsen(self, axis):
+        c = np.moveaxis(self.counts, axis, 0)
+        lo = self.lo[axis]
+        pad_before, pad_after = lo % 2, (lo % 2 + len(c)) % 2
+        c = np.pad(c, [(pad_before, pad_after)] + [(0, 0)]*(c.ndim - 1))
+        c = c.reshape((len(c)//2, 2) + c.shape[1:]).sum(axis=1)
+        self.counts = np.moveaxis(c, 0, axis)
+        low = np.moveaxis(self.low, axis + 1, 1)
+        low = np.pad(low, [(0, 0), (pad_before, pad_after)] + [(0, 0)]*(low.ndim - 2), constant_values=np.inf)
+        low = low.reshape(low.shape[:1] + (low.shape[1]//2, 2) + low.shape[2:]).min(axis=2)
+        self.low = np.moveaxis(low, 1, axis + 1)
+        self.lo[axis] = (lo - pad_before)//2
+        self.width[axis] *= 2
+
+    def _extend(self, axis, lo, hi):
+        pad = [(0, 0)]*self.ndim
+        pad[axis] = (self.lo[axis] - lo, hi - (self.lo[axis] + self.counts.shape[axis] - 1))
+        self.counts = np.pad(self.counts, pad)
+        self.low = np.pad(self.low, [(0, 0)] + pad, constant_values=np.inf)
+        self.lo[axis] = lo
+
+    def edges(self, axis=0):
+        return (self.lo[axis] + np.arange(self.counts.shape[axis] + 1))*self.width[axis]
+
+    def centers(self, axis=0):
+        e = self.edges(axis)
+        return (e[:-1] + e[1:])/2
+
+    def marginal(self, axis=0):
+        return self.counts.sum(axis=tuple(a for a in range(self.ndim) if a != axis))
+
+    def quantile(self, q, axis=0):
+        """Quantiles of one axis, interpolated linearly within the fine bins."""
+        cdf = np.concatenate([[0], np.cumsum(self.marginal(axis))])
+        return np.interp(np.asarray(q)*self.n, cdf, self.edges(axis))
+
+    def moments(self, axis=0):
+        """(mean, variance) of one axis from the bin centers."""
+        w, x = self.marginal(axis), self.centers(axis)
+        mean = np.average(x, weights=w)
+        return mean, np.average((x - mean)**2, weights=w)
+
+    def rebin(self, *edges):
+        """
+        Counts on coarser bins, one edges array per axis, with np.histogram's bin rule (last edge inclusive).
+
+        Each fine bin goes to the coarse bin holding the smallest value it received, so the
+        result is exact unless a fine bin holds values on both sides of a coarse edge.
+        """
+        occupied = self.counts.ravel() > 0
+        low = self.low.reshape(self.ndim, -1)[:, occupied].T
+        counts, _ = np.histogramdd(low, bins=edges, weights=self.counts.ravel()[occupied])
+        return counts
+
+
+def _weighted_quantile(values, weights, q):
+    """pandas' (linear) quantile of values repeated weights times, without repeating them."""
+    order = np.argsort(values)
+    values, cum = values[order], np.cumsum(weights[order])
+    pos = np.asarray(q)*(cum[-1] - 1)
+    below = values[np.searchsorted(cum, np.floor(pos), side="right")]
+    above = values[np.searchsorted(cum, np.ceil(pos), side="right")]
+    return below + (above - below)*(pos - np.floor(pos))
+
+
+def _quantile_to_level(density, isoprop):
+    """Density values enclosing the isoprop fractions of the mass (as seaborn's kdeplot levels)."""
+    values = np.sort(density.ravel())[::-1]
+    normalized = np.cumsum(values)/values.sum()
+    return np.take(values, np.searchsorted(normalized, 1 - np.asarray(isoprop)), mode="clip")
+
+
+class EventStatistics:
+    def __init__(self, cell_index=None, time_bins=65536, spatial_bins=1024, sample_size=10000, seed=42):
+        """
+        Bounded-memory accumulator of descriptive statistics over event chunks.
+
+        Parameters
+        ----------
+        cell_index: CellIndex or None
+            Covariate cells (in the CRS of the event coordinates) to count events in.
+        time_bins: int
+            Fine bins of the time histogram.
+        spatial_bins: int
+            Fine bins per axis of the X/Y histogram.
+        sample_size: int
+            Events kept in the uniform reservoir sample.
+        seed: int
+        """
+        self.time = StreamingHistogram(1, time_bins)
+        self.space = StreamingHistogram(2, spatial_bins)
+        self.cell_index = cell_index
+        self.cell_counts = None if cell_index is None else np.zeros(len(cell_index), dtype=np.int64)
+        self.unmatched = 0
+        self.sample_size = sample_size
+        self.rng = np.random.default_rng(seed)
+        self._sample = None
+        self.n = 0
+
+    def update(self, chunk):
+        """Add a DataFrame of events with columns 'X', 'Y', 'T'."""
+        x, y = chunk["X"].to_numpy(), chunk["Y"].to_numpy()
+        self.time.update(chunk["T"].to_numpy())
+        self.space.update(x, y)
+        if self.cell_index is not None:
+            ids = self.cell_index.cell_ids(x, y)
+            self.cell_counts += np.bincount(ids[ids >= 0], minlength=len(self.cell_counts))
+            self.unmatched += int((ids < 0).sum())
+        self._reservoir(chunk)
+        self.n += len(chunk)
+        return self
+
+    def _reservoir(self, chunk):
+        # Algorithm R: event j (1-based, over the whole stream) replaces a random slot with probability k/j
+        k, m = self.sample_size, len(chunk)
+        if not k:
+            return
+        if self._sample is None:
+            self._sample = {c: np.empty(k, dtype=chunk[c].dtype) for c in chunk.columns}
+        fill = max(min(k - self.n, m), 0)
+        slots, rows = np.arange(self.n, self.n + fill), np.arange(fill)
+        j = np.arange(self.n + fill + 1, self.n + m + 1)
+        r = self.rng.integers(0, j)
+        replace = r < k
+        # a slot replaced twice in one chunk keeps the later event, as in the sequential algorithm
+        later_slots, later_rows = r[replace][::-1], np.arange(fill, m)[replace][::-1]
+        _, last = np.unique(later_slots, return_index=True)
+        slots = np.concatenate([slots, later_slots[last]])
+        rows = np.concatenate([rows, later_rows[last]])
+        for c, values in self._sample.items():
+            values[slots] = chunk[c].to_numpy()[rows]
+
+    @classmethod
+    def from_chunks(cls, chunks, verbose=True, **kwargs):
+        """
+        Accumulate statistics over an iterable of event DataFrames in one pass.
+
+        Parameters
+        ----------
+        chunks: iterable of pd.DataFrame
+            e.g. event_store.iter_events(EVENTS_PATH, store_dir=OUTPUT_DIR)
+        verbose: bool
+            Print the progress after each chunk.
+        kwargs:
+            see EventStatistics
+        """
+        stats = cls(**kwargs)
+        start = time.time()
+        for chunk in chunks:
+            stats.update(chunk)
+            if verbose:
+                print(f"\r{stats.n:,} events in {time.time() - start:.1f}s", end="", flush=True)
+        if verbose:
+            print()
+        return stats
+
+    @property
+    def sample(self):
+        """Reservoir sample of min(n, sample_size) events, sorted by T."""
+        if self._sample is None:
+            return pd.DataFrame(columns=["X", "Y", "T"])
+        size = min(self.n, self.sample_size)
+        sample = pd.DataFrame({c: v[:size] for c, v in self._sample.items()})
+        return sample.sort_values("T", kind="stable").reset_index(drop=True)
+
+    def save(self, path):
+        """Pickle the accumulated statistics (without the cell index)."""
+        state = dict(vars(self), cell_index=None)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        stats = cls.__new__(cls)
+        with open(path, "rb") as f:
+            stats.__dict__.update(pickle.load(f))
+        return stats
+
+    # --- time ------------------------------------------------------------------------------------
+
+    def time_counts(self, bins=50):
+        """(counts, edges) of `bins` equal bins between the first and last event time."""
+        edges = np.linspace(self.time.min[0], self.time.max[0], bins + 1)
+        return self.time.rebin(edges), edges
+
+    def plot_epidemic_curve(self, bins=50, ax=None, **kwargs):
+        """Histogram of event times, as events_df['T'].hist(bins=bins)."""
+        import matplotlib.pyplot as plt
+        ax = ax or plt.gca()
+        counts, edges = self.time_counts(bins)
+        ax.hist(edges[:-1], bins=edges, weights=counts, **kwargs)
+        return ax
+
+    def plot_cumulative(self, ax=None, **kwargs):
+        """Cumulative event count over time, at the resolution of the fine time bins."""
+        import matplotlib.pyplot as plt
+        ax = ax or plt.gca()
+        edges = self.time.edges()
+        ax.plot(edges, np.concatenate([[0], np.cumsum(self.time.counts)]), **kwargs)
+        return ax
+
+    def time_autocorrelation(self, points=2000):
+        """
+        Autocorrelation of the sorted event times, as pandas' autocorrelation_plot of them.
+
+        The sorted times are approximated by `points` evenly spaced quantiles.
+
+        Returns
+        -------
+        (lags in events, autocorrelation)
+        """
+        x = self.time.quantile((np.arange(points) + 0.5)/points)
+        x = x - x.mean()
+        c0 = np.sum(x**2)/points
+        lags = np.arange(1, points)
+        acf = np.array([np.sum(x[:points - h]*x[h:])/points/c0 for h in lags])
+        return lags*self.n/points, acf
+
+    def plot_time_autocorrelation(self, points=2000, ax=None, **kwargs):
+        import matplotlib.pyplot as plt
+        ax = ax or plt.gca()
+        lags, acf = self.time_autocorrelation(points)
+        z95, z99 = 1.959963984540054, 2.5758293035489004
+        for z, style in ((z99, "--"), (z95, "-")):
+            ax.axhline(y=z/np.sqrt(self.n), linestyle=style, color="grey")
+            ax.axhline(y=-z/np.sqrt(self.n), linestyle=style, color="grey")
+        ax.axhline(y=0.0, color="black")
+        ax.plot(lags, acf, **kwargs)
+        ax.set_xlim(1, self.n)
+        ax.set_xlabel("Lag")
+        ax.set_ylabel("Autocorrelation")
+        ax.grid()
+        return ax
+
+    # --- space -----------------------------------------------------------------------------------
+
+    def spatial_counts(self, bins=50):
+        """(counts [bins, bins], x edges, y edges) between the extreme event coordinates."""
+        x_edges = np.linspace(self.space.min[0], self.space.max[0], bins + 1)
+        y_edges = np.linspace(self.space.min[1], self.space.max[1], bins + 1)
+        return self.space.rebin(x_edges, y_edges), x_edges, y_edges
+
+    def plot_hist2d(self, bins=50, ax=None, **kwargs):
+        """2D histogram, as plt.hist2d(X, Y, bins=bins). Returns the QuadMesh for a colorbar."""
+        import matplotlib.pyplot as plt
+        ax = ax or plt.gca()
+        counts, x_edges, y_edges = self.spatial_counts(bins)
+        return ax.pcolormesh(x_edges, y_edges, counts.T, **kwargs)
+
+    def density(self, bins=200, bw_adjust=1., cut=3):
+        """
+        Binned Gaussian KDE of the event locations.
+
+        Returns
+        -------
+        (density [bins, bins], x grid, y grid)
+        """
+        from scipy.ndimage import gaussian_filter
+        # Scott's rule as in scipy.stats.gaussian_kde, on the binned marginal variances
+        bw = np.array([np.sqrt(self.space.moments(a)[1]) for a in range(2)])*self.n**(-1/6)*bw_adjust
+        grids = [np.linspace(self.space.min[a] - cut*bw[a], self.space.max[a] + cut*bw[a], bins + 1)
+                 for a in range(2)]
+        counts = self.space.rebin(*grids)
+        steps = np.array([g[1] - g[0] for g in grids])
+        density = gaussian_filter(counts, sigma=bw/steps, mode="constant")/(self.space.n*np.prod(steps))
+        return density, (grids[0][:-1] + grids[0][1:])/2, (grids[1][:-1] + grids[1][1:])/2
+
+    def plot_kde(self, bw_adjust=1., thresh=0.05, levels=10, bins=200, ax=None, **kwargs):
+        """Filled density contours, as seaborn.kdeplot(x=X, y=Y, fill=True, thresh=thresh, levels=levels)."""
+        import matplotlib.pyplot as plt
+        ax = ax or plt.gca()
+        density, x, y = self.density(bins, bw_adjust)
+        lv = np.unique(np.append(_quantile_to_level(density, np.linspace(thresh, 1, levels)), density.max()))
+        return ax.contourf(x, y, density.T, levels=lv[lv > 0], **kwargs)
+
+    # --- covariates ------------------------------------------------------------------------------
+
+    def cell_table(self, covariates, columns):
+        """Covariates of the cells holding events, with the number of events in column 'events'."""
+        if self.cell_counts is None:
+            raise ValueError("EventStatistics was built without a cell_index")
+        table = pd.DataFrame(covariates[columns]).reset_index(drop=True)
+        table["events"] = self.cell_counts
+        return table[table["events"] > 0]
+
+    def covariate_summary(self, covariates, columns):
+        """
+        Summary of the covariates at the event locations, as describe() of the joined events.
+
+        Parameters
+        ----------
+        covariates: pd.DataFrame
+            One row per cell of the cell index, in the same order.
+        columns: list of str
+
+        Returns
+        -------
+        pd.DataFrame with columns Mean, Std Dev, Min, Q1, Median, Q3, Max
+        """
+        table = self.cell_table(covariates, columns)
+        rows = {}
+        for c in columns:
+            ok = table[c].notna().to_numpy()
+            x, w = table[c].to_numpy(dtype=float)[ok], table["events"].to_numpy(dtype=float)[ok]
+            mean = np.average(x, weights=w)
+            std = np.sqrt(np.sum(w*(x - mean)**2)/(w.sum() - 1))
+            q1, median, q3 = _weighted_quantile(x, w, [0.25, 0.5, 0.75])
+            rows[c] = [mean, std, x.min(), q1, median, q3, x.max()]
+        return pd.DataFrame.from_dict(rows, orient="index",
+                                      columns=["Mean", "Std Dev", "Min", "Q1", "Median", "Q3", "Max"])
+
+    def covariate_correlation(self, covariates, columns):
+        """Pearson correlation of the covariates at the event locations, as corr() of the joined events."""
+        table = self.cell_table(covariates, columns)
+        corr = pd.DataFrame(np.eye(len(columns)), index=columns, columns=columns)
+        for i, a in enumerate(columns):
+            for b in columns[i + 1:]:
+                ok = (table[a].notna() & table[b].notna()).to_numpy()
+                xa, xb = table[a].to_numpy(dtype=float)[ok], table[b].to_numpy(dtype=float)[ok]
+                w = table["events"].to_numpy(dtype=float)[ok]
+                cov = np.cov(xa, xb, fweights=w.astype(np.int64))
+                corr.loc[a, b] = corr.loc[b, a] = cov[0, 1]/np.sqrt(cov[0, 0]*cov[1, 1])
+        return corr
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Descriptive statistics of an X/Y/T events file in one pass.")
+    parser.add_argument("events", help="events CSV (an up-to-date store next to it, or in --store-dir, is used)")
+    parser.add_argument("--store-dir")
+    parser.add_argument("--chunk-rows", type=int, default=1_000_000)
+    parser.add_argument("--sample-size", type=int, default=10000)
+    parser.add_argument("--out", help="pickle of the statistics, reloadable with EventStatistics.load")
+    parser.add_argument("--check", action="store_true",
+                        help="compare the plotting histograms with np.histogram / np.histogram2d of the whole CSV")
+    opts = parser.parse_args()
+
+    import resource
+    from event_store import iter_events
+    start = time.time()
+    stats = EventStatistics.from_chunks(iter_events(opts.events, store_dir=opts.store_dir, chunk_rows=opts.chunk_rows),
+                                        sample_size=opts.sample_size)
+    print(f"{stats.n:,} events in {time.time() - start:.1f}s, "
+          f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024:.0f} MB")
+    print(f"T in [{stats.time.min[0]:.3f}, {stats.time.max[0]:.3f}], quartiles "
+          f"{np.round(stats.time.quantile([0.25, 0.5, 0.75]), 3).tolist()}")
+    print(f"X in [{stats.space.min[0]:.5f}, {stats.space.max[0]:.5f}], Y in [{stats.space.min[1]:.5f}, "
+          f"{stats.space.max[1]:.5f}]")
+    if opts.out:
+        stats.save(opts.out)
+        print(f"Statistics saved to {opts.out}")
+    if opts.check:
+        events = pd.read_csv(opts.events, usecols=["X", "Y", "T"])
+        ok = True
+        for bins in (50, 200):
+            counts, _ = stats.time_counts(bins)
+            expected, _ = np.histogram(events["T"], bins=bins)
+            t_err = np.abs(counts - expected).max()
+            counts, _, _ = stats.spatial_counts(bins)
+            expected, _, _ = np.histogram2d(events["X"], events["Y"], bins=bins)
+            xy_err = np.abs(counts - expected).max()
+            print(f"[CHECK] {bins} bins: time max |error| {t_err:.0f}, X/Y max |error| {xy_err:.0f} "
+                  f"(totals {counts.sum():.0f} of {len(events)})")
+            ok &= t_err == 0 and xy_err == 0
+        if not ok:
+            raise SystemExit("[CHECK] streamed histograms differ from np.histogram / np.histogram2d")
+
+
+if __name__ == "__main__":
+    main()
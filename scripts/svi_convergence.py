@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Early stopping and learning-rate decay on plateau for SVI.
+
+The analysis scripts run fixed budgets of 15000-20000 SVI steps, most of them after
+the ELBO has stopped improving. ConvergenceMonitor watches a moving average of the
+loss and reports when it has not improved by a relative tolerance for `patience`
+steps. It then either decays the learning rate (lr_decay) or stops the run, keeping
+the guide parameters of the best smoothed loss seen.
+
+The minibatched models of scalable_models.py take the settings as a dict, which is
+hashed into the FitCache key like any other fit kwarg and pickled into FitScheduler jobs:
+
+    early_stopping = dict(rtol=1e-4, patience=1000, lr_decay=0.5)
+    fit_cache.fit(lgcp_cov, "lgcp_cov", "svi", num_steps=15000, lr=0.02, early_stopping=early_stopping)
+    # [CONVERGENCE] stopped at step 4200 of 15000 (best smoothed loss at step 3700): saved 10800 steps, ~93.1s
+    lgcp_cov.svi_convergence  # the same report as a dict
+"""
+
+import numpy as np
+
+
+class ConvergenceMonitor:
+    def __init__(self, num_steps, rtol=1e-4, patience=1000, window=200, check_every=100, min_steps=1000,
+                 lr_decay=None, max_decays=2, restore_best=True):
+        """
+        Plateau detection on the smoothed SVI loss.
+
+        Parameters
+        ----------
+        num_steps: int
+            Step budget of the run, used to report the steps saved.
+        rtol: float
+            Minimum relative decrease of the smoothed loss that counts as an improvement.
+        patience: int
+            Steps without improvement before the learning rate is decayed or the run stops.
+        window: int
+            Steps in the moving average of the loss.
+        check_every: int
+            Steps between checks. Each check copies the last window losses to the host.
+        min_steps: int
+            Never stop before this step.
+        lr_decay: float or None
+            Factor applied to the learning rate on a plateau, at most max_decays times before
+            stopping. None stops at the first plateau.
+        max_decays: int
+        restore_best: bool
+            Return the guide parameters of the best smoothed loss rather than the last ones.
+        """
+        self.num_steps = num_steps
+        self.rtol = rtol
+        self.patience = patience
+        self.window = window
+        self.check_every = check_every
+        self.min_steps = min_steps
+        self.lr_decay = lr_decay
+        self.max_decays = max_decays if lr_decay else 0
+        self.restore_best = restore_best
+        self.best_loss = np.inf
+        self.best_step = None
+        self.best_state = None
+        self.stopped_step = None
+        self.decay_steps = []
+        self.wait = 0
+
+    def check(self, step, losses, svi_state):
+        """
+        Update the monitor after step (1-based) with the loss history of the run.
+
+        Returns
+        -------
+        str or None: 'decay' to lower the learning rate, 'stop' to end the run, else None
+        """
+        recent = np.asarray(losses[-self.window:], dtype=float)
+        if not np.isfinite(recent).any():
+            return None
+        smoothed = np.nanmean(recent)
+        if smoothed < self.best_loss - self.rtol*abs(self.best_loss) or self.best_step is None:
+            self.best_loss, self.best_step, self.best_state = smoothed, step, svi_state
+            self.wait = 0
+        else:
+            self.wait += self.check_every
+        if step < self.min_steps or self.wait < self.patience:
+            return None
+        self.wait = 0
+        if len(self.decay_steps) < self.max_decays:
+            self.decay_steps.append(step)
+            return "decay"
+        self.stopped_step = step
+        return "stop"
+
+    def report(self, steps_run, loop_s):
+        """
+        Steps and (estimated) seconds saved against the full budget.
+
+        Parameters
+        ----------
+        steps_run: int
+        loop_s: float
+            Wall time of the steps that ran; the saving assumes the same time per step.
+
+        Returns
+        -------
+        dict
+        """
+        steps_saved = self.num_steps - steps_run
+        return {"converged": self.stopped_step is not None, "steps_run": steps_run, "num_steps": self.num_steps,
+                "steps_saved": steps_saved, "seconds_saved": steps_saved*loop_s/max(steps_run, 1),
+                "best_step": self.best_step, "best_loss": float(self.best_loss), "lr_decay_steps": self.decay_steps}
+
+    @staticmethod
+    def format(report):
+        if not report["converged"]:
+            return (f"ran all {report['num_steps']} steps without converging "
+                    f"(best smoothed loss at step {report['best_step']})")
+        return (f"stopped at step {report['steps_run']} of {report['num_steps']} (best smoothed loss at step "
+                f"{report['best_step']}): saved {report['steps_saved']} steps, ~{report['seconds_saved']:.1f}s")
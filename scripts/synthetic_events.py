@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Seeded synthetic LGCP, Hawkes and Cox-Hawkes event sets at 10^5 - 10^7 events.
+
+No real dataset in the repository is larger than the 36k London events, and bstpp's
+simulate places points one by one with an unseeded generator. simulate_stpp draws events
+from the three model families in the parametrization of the fitted models, in rescaled
+units (time in [0, 50], space in the unit square):
+
+- 'lgcp': intensity exp(a_0 + f_t + f_xy), piecewise constant on the n_t temporal bins and
+  the n_xy x n_xy grid (comp_grid_id = iy*n_xy + ix), as the VAE and 'hsgp' fields are
+- 'hawkes': constant background exp(a_0) on the unit square plus the exponential-time /
+  Gaussian-space excitation alpha * exp(-dt/beta)/beta * N(ds; 0, sigmax_2 I)
+- 'cox_hawkes': the LGCP background plus the same excitation
+
+and returns X/Y/T frames with the schema of london_covid_events.csv over given spatial
+bounds and T_max. The sampler is the branching simulation of forecast.py: Poisson counts
+per (time bin x grid cell), then one vectorized generation of offspring at a time, so 10^7
+events take seconds. Several replicates of the same parameters are simulated in one call
+(simulate_replicates), each with its own seed.
+
+Parameters come either from a fitted model (posterior means, pilot_parameters) or from
+default_parameters, which draws smooth f_t and f_xy fields from the squared exponential
+GP of lowrank_gp.py. With n_events, a_0 is shifted so that the expected number of events
+is n_events: exactly for the LGCP, and from a pilot simulation for the Hawkes models, whose
+expected count is linear in exp(a_0) (to within about half a percent at alpha = 0.5).
+
+    parameters = default_parameters("cox_hawkes", alpha=0.5, beta=0.5, sigmax_2=1e-3)
+    events_df = simulate_stpp("cox_hawkes", parameters, T_max, grid_bounds, n_events=10**6, seed=1)
+
+Timing, and recovery of the scalar parameters by an SVI fit of a synthetic subset:
+
+    python synthetic_events.py --model hawkes --sizes 100000 1000000 10000000 --recover 5000
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from forecast import simulate_events
+
+SYNTHETIC_MODELS = ("lgcp", "hawkes", "cox_hawkes")
+# rescaled time horizon and number of temporal GP bins of bstpp
+T_RESCALED = 50.
+N_T = 50
+# background events of the pilot simulation calibrating a_0 of the Hawkes models
+PILOT_EVENTS = 100000
+SCALARS = ("a_0", "alpha", "beta", "sigmax_2")
+
+
+def gp_field(n, length_scale, variance, dims=2, num_basis=20, seed=0):
+    """
+    Smooth zero-mean field on the n cell centres of [0, 1] (dims=1) or the n x n grid (dims=2).
+
+    A draw of the reduced-rank squared exponential GP of lowrank_gp.py; the 2-d field is
+    indexed by comp_grid_id = iy*n + ix.
+    """
+    from lowrank_gp import sine_basis
+
+    rng = np.random.default_rng(seed)
+    phi, freqs = sine_basis(n, num_basis)
+    sqrt_s = np.sqrt(np.sqrt(2*np.pi)*length_scale*np.exp(-0.5*(length_scale*freqs)**2))
+    if dims == 1:
+        return np.sqrt(variance)*phi @ (sqrt_s*rng.standard_normal(num_basis))
+    W = np.sqrt(variance)*sqrt_s[:, None]*sqrt_s[None, :]*rng.standard_normal((num_basis, num_basis))
+    return (phi @ W @ phi.T).reshape(-1)
+
+
+def default_parameters(model, n_xy=25, n_t=N_T, alpha=0.5, beta=1., sigmax_2=1e-3, length_scale=0.2,
+                       variance=1., seed=0):
+    """
+    Parameters of a synthetic model with GP draws for f_t and f_xy.
+
+    Parameters
+    ----------
+    model: str
+        'lgcp', 'hawkes' or 'cox_hawkes'
+    n_xy, n_t: int
+        Grid cells per side and temporal bins of the background fields.
+    alpha, beta, sigmax_2: float
+        Excitation in rescaled units: mean offspring per event, mean delay and spatial variance.
+    length_scale, variance: float
+        Squared exponential GP of f_t and f_xy, on [0, 1] and the unit square.
+
+    Returns
+    -------
+    dict
+    """
+    if model not in SYNTHETIC_MODELS:
+        raise ValueError(f"model must be one of {SYNTHETIC_MODELS}, got {model!r}")
+    parameters = {"a_0": 0.}
+    if model != "hawkes":
+        parameters["f_t"] = gp_field(n_t, length_scale, variance, dims=1, seed=seed)
+        parameters["f_xy"] = gp_field(n_xy, length_scale, variance, seed=seed + 1)
+    if model != "lgcp":
+        parameters.update(alpha=alpha, beta=beta, sigmax_2=sigmax_2)
+    return parameters
+
+
+def pilot_parameters(fitted):
+    """Posterior means of the parameters simulate_stpp uses, from a fitted model."""
+    return {k: np.asarray(v).mean(axis=0) for k, v in fitted.samples.items()
+            if k in ("a_0", "f_t", "f_xy", "alpha", "beta", "sigmax_2")}
+
+
+def synthetic_inputs(model, parameters, n_datasets=1, seed=0):
+    """simulate_events inputs of n_datasets replicates, one chunk each."""
+    if model not in SYNTHETIC_MODELS:
+        raise ValueError(f"model must be one of {SYNTHETIC_MODELS}, got {model!r}")
+    a_0 = float(parameters["a_0"])
+    if model == "hawkes":
+        edges = np.array([0., T_RESCALED])
+        log_t = np.full((n_datasets, 1), a_0)
+        box, area, log_xy = np.array([[0.], [0.], [1.], [1.]]), np.ones(1), np.zeros((n_datasets, 1))
+    else:
+        f_t, f_xy = np.asarray(parameters["f_t"], dtype=float), np.asarray(parameters["f_xy"], dtype=float)
+        n_xy = int(round(np.sqrt(len(f_xy))))
+        edges = np.linspace(0., T_RESCALED, len(f_t) + 1)
+        log_t = np.repeat(a_0 + f_t[None, :], n_datasets, axis=0)
+        cells = np.arange(n_xy**2)
+        ix, iy = cells % n_xy, cells // n_xy
+        box = np.stack([ix, iy, ix + 1, iy + 1])/n_xy
+        area = np.full(n_xy**2, 1/n_xy**2)
+        log_xy = np.repeat(f_xy[None, :], n_datasets, axis=0)
+    inputs = {"edges": edges, "log_t": log_t, "log_xy": log_xy, "box": box, "area": area,
+              "chunks": np.stack([np.arange(n_datasets), np.arange(1, n_datasets + 1)], axis=1),
+              "seeds": np.random.SeedSequence(seed).generate_state(n_datasets)}
+    if model != "lgcp":
+        for k in ("alpha", "beta", "sigmax_2"):
+            inputs[k] = np.full(n_datasets, float(parameters[k]))
+    return inputs
+
+
+def background_count(inputs):
+    """Expected number of background events of each replicate."""
+    rate_t = np.exp(inputs["log_t"]) @ np.diff(inputs["edges"])
+    return rate_t*(np.exp(inputs["log_xy"]) @ inputs["area"])
+
+
+def calibrate_a_0(model, parameters, n_events, seed=0):
+    """
+    a_0 for which the expected number of events is n_events.
+
+    The expected count is proportional to exp(a_0). The background share of it is analytic;
+    for the Hawkes models the offspring factor, below 1/(1 - alpha) because of the events
+    excited beyond the unit square or T, is measured on one pilot simulation of about
+    PILOT_EVENTS background events.
+    """
+    inputs = synthetic_inputs(model, parameters)
+    expected = background_count(inputs)[0]
+    if model != "lgcp":
+        shift = np.log(PILOT_EVENTS/expected)
+        inputs["log_t"] = inputs["log_t"] + shift
+        inputs["seeds"] = np.random.SeedSequence([seed, 1]).generate_state(1)
+        expected *= len(simulate_events(inputs, 0)[0])/PILOT_EVENTS
+    return float(parameters["a_0"]) + np.log(n_events/expected)
+
+
+def _frame(t, x, y, T_max, bounds, time_resolution):
+    bounds = np.asarray(bounds, dtype=float)
+    T = t/T_RESCALED*T_max
+    if time_resolution:
+        T = np.floor(T/time_resolution)*time_resolution
+    order = np.argsort(T, kind="stable")
+    return pd.DataFrame({"X": bounds[0, 0] + x[order]*(bounds[0, 1] - bounds[0, 0]),
+                         "Y": bounds[1, 0] + y[order]*(bounds[1, 1] - bounds[1, 0]),
+                         "T": T[order]})
+
+
+def simulate_replicates(model, parameters, T_max, bounds, n_datasets, n_events=None, time_resolution=None, seed=0):
+    """
+    Independent synthetic event sets of the same parameters, simulated in one vectorized call.
+
+    Parameters
+    ----------
+    model: str
+        'lgcp', 'hawkes' or 'cox_hawkes'
+    parameters: dict
+        a_0, plus f_t [n_t] and f_xy [n_xy**2] for 'lgcp' / 'cox_hawkes' and alpha, beta,
+        sigmax_2 for 'hawkes' / 'cox_hawkes', in rescaled units; see default_parameters and
+        pilot_parameters.
+    T_max: float
+        End of the observation window; times are in [0, T_max].
+    bounds: np.ndarray [2, 2]
+        [[x_min, x_max], [y_min, y_max]] of the unit square, like a model's grid bounds.
+    n_datasets: int
+    n_events: int or None
+        Expected number of events of each replicate; shifts a_0 (calibrate_a_0).
+    time_resolution: float or None
+        Round times down to multiples of it, e.g. 1. for whole days like the London data.
+    seed: int
+
+    Returns
+    -------
+    list of pd.DataFrame with columns X, Y, T, sorted by T
+    """
+    if n_events is not None:
+        parameters = dict(parameters, a_0=calibrate_a_0(model, parameters, n_events, seed))
+    inputs = synthetic_inputs(model, parameters, n_datasets, seed)
+    frames = []
+    for i in range(n_datasets):
+        _, t, x, y = simulate_events(inputs, i)
+        frames.append(_frame(t, x, y, T_max, bounds, time_resolution))
+    return frames
+
+
+def simulate_stpp(model, parameters, T_max, bounds, n_events=None, time_resolution=None, seed=0):
+    """One synthetic event set; see simulate_replicates."""
+    return simulate_replicates(model, parameters, T_max, bounds, 1, n_events, time_resolution, seed)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="hawkes", choices=SYNTHETIC_MODELS)
+    parser.add_argument("--sizes", nargs="*", type=int, default=[10**5, 10**6, 10**7])
+    parser.add_argument("--alpha", type=float, default=0.5)
+    parser.add_argument("--beta", type=float, default=1.)
+    parser.add_argument("--sigmax-2", type=float, default=1e-3)
+    parser.add_argument("--T-max", type=float, default=140.)
+    parser.add_argument("--time-resolution", type=float, default=None)
+    parser.add_argument("--out-dir", default=None, help="write each dataset as <model>_<size>_seed<seed>.csv")
+    parser.add_argument("--recover", type=int, default=None, metavar="N",
+                        help="fit the model by SVI on an N-event dataset and compare the scalar parameters")
+    parser.add_argument("--steps", type=int, default=3000)
+    parser.add_argument("--seed", type=int, default=0)
+    opts = parser.parse_args()
+
+    # grid bounds of the London analysis
+    bounds = np.array([[-0.5, 0.3], [51.28, 51.7]])
+    parameters = default_parameters(opts.model, alpha=opts.alpha, beta=opts.beta, sigmax_2=opts.sigmax_2,
+                                    seed=opts.seed)
+    for size in opts.sizes:
+        start = time.time()
+        events_df = simulate_stpp(opts.model, parameters, opts.T_max, bounds, n_events=size,
+                                  time_resolution=opts.time_resolution, seed=opts.seed)
+        elapsed = time.time() - start
+        print(f"[SIMULATED] {opts.model}: {len(events_df)} events (target {size}) in {elapsed:.2f}s")
+        if opts.out_dir:
+            os.makedirs(opts.out_dir, exist_ok=True)
+            events_df.to_csv(os.path.join(opts.out_dir, f"{opts.model}_{size}_seed{opts.seed}.csv"), index=False)
+
+    if opts.recover:
+        import matplotlib
+        matplotlib.use("Agg")
+        import benchmark_suite
+
+        events_df = simulate_stpp(opts.model, parameters, opts.T_max, bounds, n_events=opts.recover,
+                                  time_resolution=opts.time_resolution, seed=opts.seed)
+        truth = dict(parameters, a_0=calibrate_a_0(opts.model, parameters, opts.recover, opts.seed))
+        model_name = "coxhawkes" if opts.model == "cox_hawkes" else opts.model
+        fitted = benchmark_suite.build_model(model_name, events_df, bounds, opts.T_max, 512)
+        fitted.run_svi(num_steps=opts.steps, lr=0.02, num_samples=500, plot_loss=False)
+        rows = []
+        for k in SCALARS:
+            if k in truth and k in fitted.samples:
+                draws = np.asarray(fitted.samples[k]).ravel()
+                rows.append({"parameter": k, "true": float(truth[k]), "mean": draws.mean(),
+                             "q0.05": np.quantile(draws, 0.05), "q0.95": np.quantile(draws, 0.95)})
+        print(f"\n=== Parameter recovery, {len(events_df)} events ===")
+        print(pd.DataFrame(rows).round(4).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Truncated-kernel Hawkes likelihood on a sparse list of event pairs.
+
+The dense triggering sum visits all N^2/2 ordered pairs of events. The exponential
+temporal kernel and the Gaussian spatial kernel both decay fast, so pairs further
+apart than a temporal cutoff c_t or a spatial radius r contribute almost nothing.
+Truncated_Hawkes_Model finds the remaining pairs once, with a KD-tree on the
+rescaled locations and the time order of the events. It stores them as a sparse
+pair list, and the event term becomes a segment sum over that list.
+
+The cutoffs come from a tolerance on the neglected kernel mass. Take beta_q and
+sigmax_2_q as the q-quantiles of the trigger parameters. Then
+
+    c_t = -beta_q * log(tol)              exp(-c_t/beta) <= tol
+    r   = sqrt(-2 * sigmax_2_q * log(tol))   exp(-r^2/(2 sigmax_2)) <= tol
+
+so for parameter values below their quantiles, each event loses at most a fraction
+tol of every parent's temporal and spatial kernel mass. The quantiles are taken
+from the priors, or from posterior samples of a pilot fit (cutoff_samples). Vague
+priors usually give cutoffs spanning the whole window, while a pilot fit gives much
+tighter ones. The integral term is always exact.
+
+    model = Truncated_Hawkes_Model(events_df, grid_bounds, T_max, tol=1e-3,
+                                   cutoff_samples=pilot.samples, **priors)
+"""
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+import numpyro
+from scipy.spatial import cKDTree
+
+from bstpp.main import Hawkes_Model
+from scalable_models import (_Minibatch_Mixin, constant_background, lgcp_background, excitation_integral,
+                             tied_log_lambda)
+from lowrank_gp import VAE_N_XY
+
+# refuse pair lists larger than this; above it the dense minibatched model is cheaper
+MAX_PAIRS = 200_000_000
+
+
+def kernel_cutoffs(tol, priors=None, samples=None, quantile=0.99, num_draws=10000, seed=0):
+    """
+    Temporal and spatial cutoffs (rescaled units) for the exponential / Gaussian trigger.
+
+    Parameters
+    ----------
+    tol: float
+        Neglected kernel mass per parent, in (0, 1).
+    priors: dict or None
+        numpyro priors holding 'beta' and 'sigmax_2'. Used when samples is None.
+    samples: dict or None
+        Posterior samples with 'beta' and 'sigmax_2', e.g. model.samples of a pilot fit.
+    quantile: float
+        Parameter quantile the cutoffs must cover.
+
+    Returns
+    -------
+    (float, float): temporal cutoff c_t, spatial radius r
+    """
+    if not 0 < tol < 1:
+        raise ValueError(f"tol must be in (0, 1), got {tol}")
+    if samples is None:
+        key_t, key_s = jax.random.split(jax.random.PRNGKey(seed))
+        samples = {'beta': priors['beta'].sample(key_t, (num_draws,)),
+                   'sigmax_2': priors['sigmax_2'].sample(key_s, (num_draws,))}
+    beta_q = np.quantile(np.asarray(samples['beta']), quantile)
+    sigmax_2_q = np.quantile(np.asarray(samples['sigmax_2']), quantile)
+    return -beta_q*np.log(tol), np.sqrt(-2*sigmax_2_q*np.log(tol))
+
+
+def pair_list(t_events, xy_events, t_cutoff, radius):
+    """
+    All pairs (i, j) with j < i, t_i - t_j <= t_cutoff and |xy_i - xy_j| <= radius.
+
+    Parameters
+    ----------
+    t_events: np.ndarray [N]
+        Event times sorted ascending; "preceding" means a lower index as in bstpp.
+    xy_events: np.ndarray [2, N]
+    t_cutoff, radius: float
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray): target indices i and parent indices j, sorted by i
+    """
+    t_events = np.asarray(t_events)
+    xy = np.asarray(xy_events).T
+    N = len(t_events)
+    if radius >= np.sqrt(2):
+        # the unit square fits inside the radius: only the time window prunes
+        start = np.searchsorted(t_events, t_events - t_cutoff, side='left')
+        counts = np.arange(N) - start
+        if counts.sum() > MAX_PAIRS:
+            raise MemoryError(f"{counts.sum()} pairs within the cutoffs; tighten tol or use cutoff_samples")
+        i = np.repeat(np.arange(N), counts)
+        j = i - (np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts)) - 1
+    else:
+        pairs = cKDTree(xy).query_pairs(radius, output_type='ndarray')
+        if len(pairs) > MAX_PAIRS:
+            raise MemoryError(f"{len(pairs)} pairs within the cutoffs; tighten tol or use cutoff_samples")
+        j, i = pairs.min(axis=1), pairs.max(axis=1)
+        keep = t_events[i] - t_events[j] <= t_cutoff
+        i, j = i[keep], j[keep]
+        # query_pairs returns each unordered pair once, in arbitrary order
+        order = np.lexsort((j, i))
+        i, j = i[order], j[order]
+    return i.astype(np.int32), j.astype(np.int32)
+
+
+def truncated_triggering_sum(args, t_pars, sp_pars):
+    """Triggering sum of every event over the sparse pair list. Returns jax numpy [N]."""
+    trig = (args['t_trig'].compute_trigger(t_pars, jnp.asarray(args['pair_dt'])) *
+            args['sp_trig'].compute_trigger(sp_pars, jnp.asarray(args['pair_dxy'])))
+    if 'pair_w' in args:
+        trig = trig*jnp.asarray(args['pair_w'])
+    return jax.ops.segment_sum(trig, jnp.asarray(args['pair_i']), num_segments=args["t_events"].shape[0],
+                               indices_are_sorted=True)
+
+
+def truncated_hawkes_model(args):
+    """bstpp's spatiotemporal_hawkes_model with the triggering sum restricted to the pair list."""
+    N = args["t_events"].shape[0]
+    if args['model'] == 'hawkes':
+        Itot_txy_back, log_mu = constant_background(args)
+    else:
+        Itot_t, Itot_xy, log_mu = lgcp_background(args)
+        Itot_txy_back = numpyro.deterministic("Itot_txy_back", Itot_t*Itot_xy)
+
+    alpha = numpyro.sample("alpha", args['priors']['alpha'])
+    t_pars = args['t_trig'].sample_parameters()
+    sp_pars = args['sp_trig'].sample_parameters()
+
+    lam = alpha*truncated_triggering_sum(args, t_pars, sp_pars) + jnp.exp(log_mu(jnp.arange(N)))
+    if 'event_weight' in args:
+        log_lambda = tied_log_lambda(args, lam, alpha, t_pars, sp_pars, jnp.arange(N))
+    else:
+        log_lambda = jnp.log(lam)
+    if args.get('pointwise'):
+        numpyro.deterministic('log_lambda', log_lambda)
+    ell_1 = numpyro.deterministic('ell_1', jnp.sum(log_lambda))
+
+    Itot_excite = excitation_integral(args, alpha, t_pars, sp_pars)
+    Itot_txy = numpyro.deterministic("Itot_txy", Itot_excite + Itot_txy_back)
+    loglik = numpyro.deterministic('loglik', ell_1 - Itot_txy)
+
+    numpyro.factor("t_events", loglik)
+    numpyro.factor("xy_events", loglik)
+
+
+class Truncated_Hawkes_Model(_Minibatch_Mixin, Hawkes_Model):
+    def __init__(self, data, A, T, tol=1e-3, cutoff_samples=None, cutoff_quantile=0.99, cutoffs=None,
+                 spatial_gp="vae", n_xy=VAE_N_XY, num_basis=20, weight_col=None, **kwargs):
+        """
+        Hawkes / Cox-Hawkes model whose triggering sum only visits pairs within kernel cutoffs.
+
+        Parameters
+        ----------
+        data, A, T: see Hawkes_Model
+        tol: float
+            Neglected kernel mass per parent, see kernel_cutoffs.
+        cutoff_samples: dict or None
+            Posterior samples of 'beta' and 'sigmax_2' to take the cutoffs from instead of the priors.
+        cutoff_quantile: float
+            Parameter quantile the cutoffs must cover.
+        cutoffs: (float, float) or None
+            Explicit (temporal, spatial) cutoffs in rescaled units; overrides tol.
+        spatial_gp, n_xy, num_basis, weight_col: see Minibatch_Hawkes_Model
+        kwargs: dict
+            parameters from Hawkes_Model (only the default exponential / Gaussian triggers are supported)
+        """
+        super().__init__(data, A, T, **kwargs)
+        if self.args['t_trig'].get_par_names() != ['beta'] or self.args['sp_trig'].get_par_names() != ['sigmax_2']:
+            raise ValueError("Truncated_Hawkes_Model supports the exponential / symmetric Gaussian triggers only")
+        self.model = truncated_hawkes_model
+        self._set_spatial_gp(spatial_gp, n_xy, num_basis)
+        self._set_event_weight(weight_col)
+        if cutoffs is None:
+            cutoffs = kernel_cutoffs(tol, priors=self.args['priors'], samples=cutoff_samples, quantile=cutoff_quantile)
+        self.cutoffs = tuple(float(c) for c in cutoffs)
+
+        t = np.asarray(self.args['t_events'])
+        xy = np.asarray(self.args['xy_events'])
+        i, j = pair_list(t, xy, *self.cutoffs)
+        if 'event_weight' in self.args:
+            # each parent row counts with its weight; excitation within a row is in tied_log_lambda
+            self.args['pair_w'] = np.asarray(self.args['event_weight'])[j].astype(np.float32)
+        self.args['t_cutoff'], self.args['sp_cutoff'] = self.cutoffs
+        self.args['pair_i'] = i
+        self.args['pair_dt'] = (t[i] - t[j]).astype(np.float32)
+        self.args['pair_dxy'] = (xy[:, i] - xy[:, j]).astype(np.float32)
+        self.num_pairs = len(i)
+
+    def __str__(self):
+        return f"Truncated {super().__str__()}"